@@ -19,29 +19,25 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
 import os
-import boto3
 import shutil
 import sys
 import json
 import logging
 from config import *
+import aws_clients
 
 
 def get_endpoint():
-    client = boto3.client('iot')
+    client = aws_clients.get_client('iot')
     response = client.describe_endpoint(endpointType='iot:Data-ATS')
     endpoint = response.get('endpointAddress', None)
     return endpoint
 
 def get_account_id():
-    client = boto3.client('sts')
-    aws_account_id = client.get_caller_identity()['Account']
-    return aws_account_id
+    return aws_clients.get_account_id()
 
 def get_aws_region():
-    my_session = boto3.session.Session()
-    aws_region = my_session.region_name
-    return aws_region.strip('\n')
+    return aws_clients.get_region().strip('\n')
 
 def create_policy_document_text(policy_name):
     policy_template_filename = '{}{}.templ'.format(data_dir, policy_name)
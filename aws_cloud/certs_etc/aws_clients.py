@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: aws_clients.py
+
+    Shared boto3 session and clients for the certs_etc tools.
+
+    Clients are created once per process and reused by every call in
+    cert_auth.py and device_dyn_db.py. botocore clients are thread safe,
+    and the connection pool is sized for the provisioning thread pools.
+    IoT clients are paced by rate_limit.py.
+'''
+
+import threading
+import boto3
+from botocore.config import Config
+from config import *
+import rate_limit
+
+rate_limited_services = ['iot']
+
+client_config = Config(max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+    retries={'max_attempts': AWS_MAX_ATTEMPTS})
+
+session = None
+clients = {}
+resources = {}
+account_id = None
+
+# boto3 sessions are not thread safe, so client creation is serialized
+lock = threading.Lock()
+
+def get_session():
+    global session
+    if not session:
+        session = boto3.session.Session()
+    return session
+
+'''
+    Shared low level client for service_name, e.g. 'iot', 'ssm', 'sts'
+'''
+def get_client(service_name):
+    client = clients.get(service_name, None)
+    if not client:
+        with lock:
+            client = clients.get(service_name, None)
+            if not client:
+                client = get_session().client(service_name, config=client_config)
+                if service_name in rate_limited_services:
+                    rate_limit.install(client, service_name)
+                clients[service_name] = client
+    return client
+
+'''
+    Shared resource for service_name, e.g. 'dynamodb'
+'''
+def get_resource(service_name):
+    resource = resources.get(service_name, None)
+    if not resource:
+        with lock:
+            resource = resources.get(service_name, None)
+            if not resource:
+                resource = get_session().resource(service_name, config=client_config)
+                resources[service_name] = resource
+    return resource
+
+def get_region():
+    return get_session().region_name
+
+def get_partition(region):
+    if region.startswith('cn-'):
+        return 'aws-cn'
+    if region.startswith('us-gov-'):
+        return 'aws-us-gov'
+    return 'aws'
+
+'''
+    AWS account id, fetched from STS once per process
+'''
+def get_account_id():
+    global account_id
+    if not account_id:
+        account_id = get_client('sts').get_caller_identity()['Account'].strip('\n')
+    return account_id
+
+'''
+    Certificate ARN from the cert id without a describe_certificate call:
+        arn:<partition>:iot:<region>:<account id>:cert/<cert id>
+'''
+def get_cert_arn(cert_id):
+    region = get_region()
+    return 'arn:{}:iot:{}:{}:cert/{}'.format(get_partition(region), region,
+        get_account_id(), cert_id)
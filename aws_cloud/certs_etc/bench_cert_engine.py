@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: bench_cert_engine.py
+
+    Compare device cert generation throughput of the openssl command line
+    path and the in-process cert engine. Both paths sign with the same
+    throwaway CA in a temp directory; nothing is registered with AWS.
+
+    Usage:
+        > python bench_cert_engine.py --count 50
+'''
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import logging
+from config import *
+import cert_engine
+from cert_auth import gen_dev_cert_openssl
+
+bench_ca_name = 'Bench'
+bench_subj_str = '/C=US/ST=Kansas/L=Kansas City/O=MCICoffeMaker/OU=Manufacturing/CN={}'
+
+'''
+    Time count device certs with gen_func(dev, dev_subj_str).
+    Returns devices/sec.
+'''
+def time_devices(gen_func, count, label):
+    start = time.perf_counter()
+    for i in range(count):
+        dev = '{}{:06d}_ven'.format(label, i)
+        gen_func(dev, bench_subj_str.format(dev))
+    elapsed = time.perf_counter() - start
+    return count / elapsed if elapsed else 0.0
+
+def bench(count, days):
+    out_dir = tempfile.mkdtemp(prefix='bench_cert_engine_') + '/'
+    try:
+        cert_engine.new_ca_files(bench_ca_name, bench_subj_str.format(bench_ca_name),
+            days, out_dir=out_dir)
+
+        openssl_rate = time_devices(
+            lambda dev, subj: gen_dev_cert_openssl(bench_ca_name, dev, subj, days, out_dir=out_dir,
+                stdout_filename=out_dir + 'open_ssl_stdout.txt',
+                stderr_filename=out_dir + 'open_ssl_stderr.txt'),
+            count, 'openssl')
+
+        engine = cert_engine.get_engine(bench_ca_name, out_dir)
+        python_rate = time_devices(
+            lambda dev, subj: engine.new_dev_files(dev, subj, days),
+            count, 'python')
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    print('{:<10} {:>12}'.format('engine', 'devices/sec'))
+    print('{:<10} {:>12.1f}'.format('openssl', openssl_rate))
+    print('{:<10} {:>12.1f}'.format('python', python_rate))
+    if openssl_rate:
+        print('speedup    {:>11.1f}x'.format(python_rate / openssl_rate))
+
+def main():
+    argp = argparse.ArgumentParser(description='Benchmark openssl vs in-process cert generation')
+    argp.add_argument('--count', type=int, default=20, help='--count devices per engine')
+    argp.add_argument('--days', type=int, default=180, help='--days cert validity')
+    args = argp.parse_args()
+
+    bench(args.count, args.days)
+
+if __name__ == '__main__':
+    main()
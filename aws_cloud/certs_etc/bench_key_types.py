@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: bench_key_types.py
+
+    Compare RSA 2048 and ECDSA P-256 for device provisioning:
+        - key generation rate
+        - cert signing rate (CSR signed by a CA of the same key type)
+        - PEM sizes of the key, CSR, and cert
+
+    Usage:
+        > python bench_key_types.py --count 50
+'''
+
+import argparse
+import shutil
+import tempfile
+import time
+from config import *
+from cryptography.hazmat.primitives import serialization
+from cert_engine import gen_private_key, private_key_pem, gen_csr, CertEngine, new_ca_files
+
+bench_subj_str = '/C=US/ST=Kansas/L=Kansas City/O=MCICoffeMaker/OU=Manufacturing/CN={}'
+
+'''
+    Calls per second of func over count calls
+'''
+def rate(func, count):
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    elapsed = time.perf_counter() - start
+    return count / elapsed if elapsed else 0.0
+
+def bench_key_type(key_type, count, out_dir):
+    ca_name = 'Bench_{}'.format(key_type)
+    new_ca_files(ca_name, bench_subj_str.format(ca_name), 3650, out_dir=out_dir, key_type=key_type)
+    engine = CertEngine(ca_name, out_dir)
+
+    keygen_rate = rate(lambda i: gen_private_key(key_type), count)
+
+    key = gen_private_key(key_type)
+    csr = gen_csr(key, bench_subj_str.format('bench_dev'))
+    sign_rate = rate(lambda i: engine.sign_csr(csr, 3650), count)
+
+    cert = engine.sign_csr(csr, 3650)
+    return {
+        'keygen/sec': keygen_rate,
+        'sign/sec': sign_rate,
+        'key pem bytes': len(private_key_pem(key)),
+        'csr pem bytes': len(csr.public_bytes(serialization.Encoding.PEM)),
+        'cert pem bytes': len(cert.public_bytes(serialization.Encoding.PEM)),
+        'cert der bytes': len(cert.public_bytes(serialization.Encoding.DER))
+        }
+
+def bench(count):
+    out_dir = tempfile.mkdtemp(prefix='bench_key_types_') + '/'
+    try:
+        results = {key_type: bench_key_type(key_type, count, out_dir) for key_type in key_types}
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    print('{:<16}'.format('') + ''.join('{:>12}'.format(key_type) for key_type in key_types))
+    for metric in results[key_types[0]]:
+        print('{:<16}'.format(metric) + \
+            ''.join('{:>12.1f}'.format(results[key_type][metric]) for key_type in key_types))
+
+def main():
+    argp = argparse.ArgumentParser(description='Benchmark RSA 2048 vs ECDSA P-256')
+    argp.add_argument('--count', type=int, default=20, help='--count operations per measurement')
+    args = argp.parse_args()
+
+    bench(args.count)
+
+if __name__ == '__main__':
+    main()
@@ -27,12 +27,16 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
     a device connects using a cert from CA with JITP then a message is sent
     to IoT core with the following topic '$aws/events/certificates/registered/'.
 '''
-import boto3
 import os
 import argparse
+import json
 import logging
+from botocore.exceptions import ClientError
 from config import *
-from aws_acct_vals import create_policy_document_text, get_account_id
+import cert_engine
+from key_reservoir import claim_key
+from aws_acct_vals import create_policy_document_text
+from aws_clients import get_client, get_account_id, get_cert_arn
 from device_dyn_db import read_man_cert_id, read_vendor_cert_id
 
 '''
@@ -45,128 +49,226 @@ def local_remove_file(filename):
         except:
             pass
 
+'''
+    openssl command to generate a private key of key_type
+'''
+def openssl_genkey_cmd(key_filename, key_type=default_key_type):
+    if key_type == 'ec':
+        return 'openssl ecparam -name prime256v1 -genkey -noout -out {}'.format(key_filename)
+    return 'openssl genrsa -out {} 2048'.format(key_filename)
+
 '''
     Create new CA Cert
 '''
-def new_ca(ca_name, subj_str, days, jitr=False, jitp=False):
+def new_ca(ca_name, subj_str, days, jitr=False, jitp=False, key_type=default_key_type):
     rc = True
     try: 
         # Generate RootCA private key and cert 
-        gen_ca_key_cmd = 'openssl genrsa -out {}{}_rootCA.key 2048 >> {} 2>> {} '.format(data_dir, ca_name, ssl_stdout, ssl_stderr)
         ca_subj_str = subj_str.format(ca_name)
-        gen_ca_crt_cmd = 'openssl req -x509 -new -nodes -key {}{}_rootCA.key -sha256 -days {} -out {}{}_rootCA.pem -subj \"{}\" >> {} 2>> {}'.\
-            format(data_dir, ca_name, days, data_dir, ca_name, ca_subj_str, ssl_stdout, ssl_stderr)
+        if cert_engine_name == 'python':
+            cert_engine.new_ca_files(ca_name, ca_subj_str, days, key_type=key_type)
+        else:
+            gen_ca_key_cmd = '{} >> {} 2>> {} '.format(
+                openssl_genkey_cmd('{}{}_rootCA.key'.format(data_dir, ca_name), key_type), ssl_stdout, ssl_stderr)
+            gen_ca_crt_cmd = 'openssl req -x509 -new -nodes -key {}{}_rootCA.key -sha256 -days {} -out {}{}_rootCA.pem -subj \"{}\" >> {} 2>> {}'.\
+                format(data_dir, ca_name, days, data_dir, ca_name, ca_subj_str, ssl_stdout, ssl_stderr)
 
-        os.system(gen_ca_key_cmd)
-        os.system(gen_ca_crt_cmd)
+            os.system(gen_ca_key_cmd)
+            os.system(gen_ca_crt_cmd)
 
-        # Get CA registration code from AWS
-        get_aws_ca_reg_code_cmd = 'aws iot get-registration-code --output text > temp.txt'
-        os.system(get_aws_ca_reg_code_cmd)
-        with open('temp.txt', 'r') as file:
-            reg_code = file.read().replace('\n', '')
+        client = get_client('iot')
 
-        local_remove_file('temp.txt')
+        # Get CA registration code from AWS
+        reg_code = client.get_registration_code()['registrationCode']
         logging.info('reg_code = {}'.format(reg_code))
 
         # Use reg code to generate verification key, csr, and cert
         ver_crt_subj_str = subj_str.format(reg_code)
-        gen_ver_key_cmd = 'openssl genrsa -out verificationCert.key 2048 >> {} 2>> {}'.format(ssl_stdout, ssl_stderr)
-        gen_ver_csr_cmd = 'openssl req -new -key verificationCert.key -out verificationCert.csr -subj \"{}\" >> {} 2>> {}'.\
-            format(ver_crt_subj_str, ssl_stdout, ssl_stderr)
-        gen_ver_crt_cmd = 'openssl x509 -req -in verificationCert.csr -CA {}{}_rootCA.pem -CAkey {}{}_rootCA.key -CAcreateserial -out verificationCert.pem -days {} -sha256 >> {} 2>> {}'.\
-            format(data_dir, ca_name, data_dir, ca_name, days, ssl_stdout, ssl_stderr)
+        if cert_engine_name == 'python':
+            ver_key_pem, ver_crt_pem = cert_engine.get_engine(ca_name).\
+                new_verification_cert(ver_crt_subj_str, days)
+            ver_crt_pem = ver_crt_pem.decode()
+        else:
+            gen_ver_key_cmd = '{} >> {} 2>> {}'.format(
+                openssl_genkey_cmd('verificationCert.key', key_type), ssl_stdout, ssl_stderr)
+            gen_ver_csr_cmd = 'openssl req -new -key verificationCert.key -out verificationCert.csr -subj \"{}\" >> {} 2>> {}'.\
+                format(ver_crt_subj_str, ssl_stdout, ssl_stderr)
+            gen_ver_crt_cmd = 'openssl x509 -req -in verificationCert.csr -CA {}{}_rootCA.pem -CAkey {}{}_rootCA.key -CAcreateserial -out verificationCert.pem -days {} -sha256 >> {} 2>> {}'.\
+                format(data_dir, ca_name, data_dir, ca_name, days, ssl_stdout, ssl_stderr)
 
-        os.system(gen_ver_key_cmd)
-        os.system(gen_ver_csr_cmd)
-        os.system(gen_ver_crt_cmd)
+            os.system(gen_ver_key_cmd)
+            os.system(gen_ver_csr_cmd)
+            os.system(gen_ver_crt_cmd)
 
-        # Register the CA with the verification cert 
-        reg_ca_cmd = 'aws iot register-ca-certificate --ca-certificate file://{}{}_rootCA.pem --verification-cert file://verificationCert.pem --output text | awk \'{{print $2}}\' > {}{}_ca_cert_id.txt'.\
-            format(data_dir, ca_name, data_dir, ca_name)
-        os.system(reg_ca_cmd)
+            with open('verificationCert.pem', 'r') as f:
+                ver_crt_pem = f.read()
 
-        # Remove verification cert files
-        local_remove_file('verificationCert.key')
-        local_remove_file('verificationCert.csr')
-        local_remove_file('verificationCert.pem')
+            # Remove verification cert files
+            local_remove_file('verificationCert.key')
+            local_remove_file('verificationCert.csr')
+            local_remove_file('verificationCert.pem')
+
+        # Register the CA with the verification cert 
+        with open('{}{}_rootCA.pem'.format(data_dir, ca_name), 'r') as f:
+            ca_pem = f.read()
+        response = client.register_ca_certificate(caCertificate=ca_pem,
+            verificationCertificate=ver_crt_pem)
+        ca_cert_id = response['certificateId']
 
-        # Get ca_cert-id
         ca_cert_id_file_name = '{}{}_ca_cert_id.txt'.format(data_dir, ca_name)
-        with open(ca_cert_id_file_name, 'r') as file:
-            ca_cert_id = file.read().replace('\n', '')
+        with open(ca_cert_id_file_name, 'w') as file:
+            file.write('{}\n'.format(ca_cert_id))
 
         logging.info('Root ca cert id = {}'.format(ca_cert_id))
 
-        # Activate the rootCA
-        act_root_ca_cmd = 'aws iot update-ca-certificate --certificate-id {} --new-status ACTIVE --output json'.\
-            format(ca_cert_id)
-        os.system(act_root_ca_cmd)
-
+        # Activate the rootCA, with JITR or JITP if configured
+        update_args = {'certificateId': ca_cert_id, 'newStatus': 'ACTIVE'}
         if jitr:
             # Enable Just-in-time-registration (JITR) on the CA
-            jitr_enable_cmd = 'aws iot update-ca-certificate --certificate-id {} --new-auto-registration-status ENABLE'.\
-                format(ca_cert_id)
-            os.system(jitr_enable_cmd)
+            update_args['newAutoRegistrationStatus'] = 'ENABLE'
         if jitp:
             # Enable Just-in-time-provisioning (JITP) on the CA
             logging.info('*********** JITP ***************')
 
             # Get the policy and replace current account number
-            account_id = get_account_id()
-
             with open(jitp_filename) as f:
               data = f.read()
 
-            data = data.replace('BLOG_ACCNT', account_id)
+            data = data.replace('BLOG_ACCNT', get_account_id())
 
-            with open('./temp.txt', 'w') as f:
-              f.write(data)
+            update_args['newAutoRegistrationStatus'] = 'ENABLE'
+            update_args['registrationConfig'] = json.loads(data)
 
-            jitp_enable_cmd = 'aws iot update-ca-certificate --certificate-id {} --new-auto-registration-status ENABLE --registration-config file://./temp.txt'.format(ca_cert_id)
-            os.system(jitp_enable_cmd)
-            local_remove_file('temp.txt')
+        client.update_ca_certificate(**update_args)
 
     except Exception as e:
         logging.error('new_ca(): Exception = {}'.format(str(e)))
         rc = False
     return rc
 
+'''
+    Device file name prefix, e.g. <dev>_ven or <dev>_man
+'''
+def dev_file_prefix(ca_name, dev):
+    if ca_name == 'Manufacturer':
+        return '{}_man'.format(dev)
+    return '{}_ven'.format(dev)
+
+'''
+    Random positive 159 bit cert serial number for openssl -set_serial
+'''
+def random_serial():
+    return '0x{:X}'.format(int.from_bytes(os.urandom(20), 'big') >> 1)
+
+'''
+    Generate device key, csr, and cert with the openssl command line
+'''
+def gen_dev_cert_openssl(ca_name, dev, dev_subj_str, days, out_dir=data_dir,
+        existing_key=False, key_type=default_key_type, stdout_filename=ssl_stdout,
+        stderr_filename=ssl_stderr):
+    if not existing_key:
+        gen_dev_key_cmd = '{} >> {} 2>> {} '.format(
+            openssl_genkey_cmd('{}{}.key'.format(out_dir, dev), key_type), stdout_filename, stderr_filename)
+        os.system(gen_dev_key_cmd)
+    gen_dev_csr_cmd = 'openssl req -new -key {}{}.key -out {}{}.csr -subj \"{}\">> {} 2>> {}  '.\
+        format(out_dir, dev, out_dir, dev, dev_subj_str, stdout_filename, stderr_filename)
+    # A random serial, not -CAcreateserial, so pipeline workers signing with
+    # one CA don't race on <ca_name>_rootCA.srl
+    gen_dev_crt_cmd = 'openssl x509 -req -in {}{}.csr -CA {}{}_rootCA.pem -CAkey {}{}_rootCA.key -set_serial {} -out {}{}.pem -days {} -sha256>> {} 2>> {} '.\
+        format(out_dir, dev, out_dir, ca_name, out_dir, ca_name, random_serial(), out_dir, dev, days, stdout_filename, stderr_filename)
+    os.system(gen_dev_csr_cmd)
+    os.system(gen_dev_crt_cmd)
+
+'''
+    True if dev's key and a complete cert, written after the CA's cert, are
+    already on disk, i.e. an interrupted run got this far. The cert may
+    already be registered, so it must be reused, not replaced.
+'''
+def dev_cert_files_done(ca_name, dev, out_dir=data_dir):
+    key_filename = '{}{}.key'.format(out_dir, dev)
+    cert_filename = '{}{}.pem'.format(out_dir, dev)
+    try:
+        if not os.path.getsize(key_filename) or \
+                os.path.getmtime(cert_filename) < \
+                os.path.getmtime('{}{}_rootCA.pem'.format(out_dir, ca_name)):
+            return False
+        with open(cert_filename, 'r') as f:
+            cert_engine.cert_pem_id(f.read())
+        return True
+    except Exception:
+        return False
+
+'''
+    Generate device key, csr, and cert with the configured cert engine.
+    Files left by an interrupted run are kept.
+'''
+def gen_dev_cert(ca_name, dev, subj_str, days, key_type=default_key_type):
+    dev_subj_str = subj_str.format(dev)
+    dev = dev_file_prefix(ca_name, dev)
+
+    if dev_cert_files_done(ca_name, dev):
+        logging.info('gen_dev_cert(): reusing {} cert files'.format(dev))
+        return
+
+    # Use a pre-generated key when the key pool has one
+    existing_key = claim_key('{}{}.key'.format(data_dir, dev), key_type)
+
+    if cert_engine_name == 'python':
+        cert_engine.get_engine(ca_name).new_dev_files(dev, dev_subj_str, days,
+            existing_key=existing_key, key_type=key_type)
+    else:
+        gen_dev_cert_openssl(ca_name, dev, dev_subj_str, days,
+            existing_key=existing_key, key_type=key_type)
+
+'''
+    Register and activate a device cert in AWS. Returns the cert id.
+    A cert that is already registered (e.g. by an interrupted run) is
+    not an error.
+'''
+def register_dev_cert(ca_name, dev):
+    dev = dev_file_prefix(ca_name, dev)
+
+    with open('{}{}.pem'.format(data_dir, dev), 'r') as f:
+        cert_pem = f.read()
+    with open('{}{}_rootCA.pem'.format(data_dir, ca_name), 'r') as f:
+        ca_pem = f.read()
+
+    try:
+        response = get_client('iot').register_certificate(certificatePem=cert_pem,
+            caCertificatePem=ca_pem, setAsActive=True)
+        cert_id = response['certificateId']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceAlreadyExistsException':
+            raise
+        cert_id = cert_engine.cert_pem_id(cert_pem)
+        logging.info('register_dev_cert(): {} already registered as {}'.format(dev, cert_id))
+
+    cert_id_filename = '{}{}_cert_id.txt'.format(data_dir, dev)
+    with open(cert_id_filename, 'w') as cert_id_file:
+        cert_id_file.write('{}\n'.format(cert_id))
+
+    return cert_id
+
+'''
+    Register and activate a device cert in AWS, then attach the cert policy
+'''
+def reg_dev_cert(ca_name, dev, policy_name):
+    return attach_cert_policy(register_dev_cert(ca_name, dev), policy_name)
+
 '''
     Create new Device Cert
 '''
-def new_dev(ca_name, dev, subj_str, days, policy_name, jitr=False, jitp=False):
+def new_dev(ca_name, dev, subj_str, days, policy_name, jitr=False, jitp=False,
+        key_type=default_key_type):
 
     rc = True
     try: 
         # Generate device key, csr, and cert
-        dev_subj_str = subj_str.format(dev)
-
-        if ca_name == 'Manufacturer':
-            dev = '{}_man'.format(dev)
-        else:
-            dev = '{}_ven'.format(dev)
-
-        gen_dev_key_cmd = 'openssl genrsa -out {}{}.key 2048 >> {} 2>> {} '.\
-            format(data_dir, dev, ssl_stdout, ssl_stderr)
-        gen_dev_csr_cmd = 'openssl req -new -key {}{}.key -out {}{}.csr -subj \"{}\">> {} 2>> {}  '.\
-            format(data_dir, dev, data_dir, dev, dev_subj_str, ssl_stdout, ssl_stderr)
-        gen_dev_crt_cmd = 'openssl x509 -req -in {}{}.csr -CA {}{}_rootCA.pem -CAkey {}{}_rootCA.key -CAcreateserial -out {}{}.pem -days {} -sha256>> {} 2>> {} '.\
-            format(data_dir, dev, data_dir, ca_name, data_dir, ca_name, data_dir, dev, days, ssl_stdout, ssl_stderr)
-        os.system(gen_dev_key_cmd)
-        os.system(gen_dev_csr_cmd)
-        os.system(gen_dev_crt_cmd)
+        gen_dev_cert(ca_name, dev, subj_str, days, key_type)
 
         if not jitr and not jitp:
             # Register and activate the cert in AWS unless this is a JITR cert or JITP cert
-            reg_dev_cmd = 'aws iot register-certificate --certificate-pem file://{}{}.pem --ca-certificate-pem file://{}{}_rootCA.pem --set-as-active --output text | awk \'{{print $2}}\' > {}{}_cert_id.txt'.format(data_dir, dev, data_dir, ca_name, data_dir, dev)
-            os.system(reg_dev_cmd)
-
-            cert_id_filename = '{}{}_cert_id.txt'.format(data_dir, dev)
-            with open(cert_id_filename,'r') as cert_id_file:
-                cert_id = cert_id_file.read().replace('\n', '')
-
-            attach_cert_policy(cert_id, policy_name)
+            rc = reg_dev_cert(ca_name, dev, policy_name)
 
     except Exception as e:
         logging.error('new_dev(): Exception = {}'.format(str(e)))
@@ -177,17 +279,20 @@ def new_dev(ca_name, dev, subj_str, days, policy_name, jitr=False, jitp=False):
     Attach Cert Policy to Cert
 '''
 def attach_cert_policy(cert_id, policy_name):
-    client = boto3.client('iot')
+    rc = False
+    client = get_client('iot')
 
     cert_arn = get_cert_arn(cert_id)
 
     if cert_arn:
         try:
             client.attach_policy(policyName=policy_name, target=cert_arn)
+            rc = True
         except Exception as e:
             logging.error('attach_cert_policy(): Failed attach_policy(): {}'.format(str(e)))
     else:
         logging.info('attach_cert_policy(): no arn for cert_id {}'.format(cert_id))
+    return rc
 
 '''
     Detach Cert Policy from Cert
@@ -199,7 +304,7 @@ def detach_policy(cert_id, policy_name):
     cert_arn = get_cert_arn(cert_id)
 
     if cert_arn:
-        client = boto3.client('iot')
+        client = get_client('iot')
         try:
             result = client.detach_policy(policyName=policy_name, target=cert_arn)
             logging.info('detach_policy(): result = {}'.format(result))
@@ -224,12 +329,10 @@ def del_ca(ca_name):
         logging.info('Root ca cert id = {}'.format(ca_cert_id))
 
         # Deativate and delete the rootCA on AWS
-        act_root_ca_cmd = 'aws iot update-ca-certificate --certificate-id {} --new-status INACTIVE --output json'.format(ca_cert_id)
-        os.system(act_root_ca_cmd)
+        client = get_client('iot')
+        client.update_ca_certificate(certificateId=ca_cert_id, newStatus='INACTIVE')
+        client.delete_ca_certificate(certificateId=ca_cert_id)
 
-        del_ca_cert_cmd = 'aws iot delete-ca-certificate --certificate-id {}'.format(ca_cert_id)
-        os.system(del_ca_cert_cmd)
-        
     except Exception as e:
         logging.error('del_ca(): Exception = {}'.format(str(e)))
         rc = False
@@ -278,8 +381,7 @@ def del_dev(dev, policy_name):
 def del_thing(thing_name):
     logging.info('delete thing {}'.format(thing_name))
     try: 
-        client = boto3.client('iot')
-        client.delete_thing(thingName=thing_name)
+        get_client('iot').delete_thing(thingName=thing_name)
     except Exception as e:
         logging.error('del_thing(): Thing delete exception: {}'.format(str(e)))
 
@@ -288,10 +390,7 @@ def del_thing(thing_name):
 '''
 def del_cert(cert_id, dev):
     logging.info('delete cert {} {}'.format(cert_id, dev))
-    try: 
-        client = boto3.client('iot')
-    except Exception as e:
-        logging.error('del_cert(): Failed boto3.client(): {}'.format(str(e)))
+    client = get_client('iot')
 
     cert_arn = get_cert_arn(cert_id)
 
@@ -316,46 +415,36 @@ def del_cert(cert_id, dev):
     else:
         logging.info('del_cert(): no arn for cert_id {}'.format(cert_id))
 
-def get_cert_arn(cert_id):
-    cert_arn = None
-    client = boto3.client('iot')
-    try:
-        result = client.describe_certificate(certificateId=cert_id)
-    except Exception as e:
-        logging.error('get_cert_arn(): Failed describe_certifiacte(): {}'.format(str(e)))
-        return cert_arn
-
+'''
+    Log every item of a paginated IoT list call as json
+'''
+def log_iot_list(operation_name, result_key):
     try:
-        cert_arn = result['certificateDescription']['certificateArn']
-
+        paginator = get_client('iot').get_paginator(operation_name)
+        items = []
+        for page in paginator.paginate():
+            items += page.get(result_key, [])
+        logging.info(json.dumps({result_key: items}, indent=4, default=str))
     except Exception as e:
-        logging.error('get_cert_arn(): Failed result[certificateDescription][certificateArn]: {}'.format(str(e)))
-
-    return cert_arn
+        logging.error('log_iot_list(): {} exception = {}'.format(operation_name, str(e)))
 
 '''
     List CA Certs
 '''
 def list_ca_certs():
-    # aws iot describe-ca-certificate --certificate-id <cert-id>
-    list_ca_certs_cmd = 'aws iot list-ca-certificates --output json'
-    os.system(list_ca_certs_cmd)
+    log_iot_list('list_ca_certificates', 'certificates')
 
 '''
     List Device Certs
 '''
 def list_dev_certs():
-    # aws iot describe-certificate --certificate-id <cert-id>
-    list_ca_certs_cmd = 'aws iot list-certificates --output json'
-    os.system(list_ca_certs_cmd)
+    log_iot_list('list_certificates', 'certificates')
 
 '''
     List Cert Policies
 '''
 def list_cert_policies():
-    # aws iot describe-certificate --certificate-id <cert-id>
-    list_cert_policies_cmd = 'aws iot list-policies --output json'
-    os.system(list_cert_policies_cmd)
+    log_iot_list('list_policies', 'policies')
 
 '''
     Delete from secure store 
@@ -367,7 +456,7 @@ def del_secure_store(ca_name):
         with open(ca_cert_id_file_name, 'r') as file:
             ca_cert_id = file.read().replace('\n', '')
 
-        client = boto3.client('ssm')
+        client = get_client('ssm')
         response = client.delete_parameter(Name='cr-ca-key-{}'.format(ca_cert_id))
 
         logging.info('delete_secure_store(): delete_parameter_response = {}'.format(str(response)))
@@ -384,7 +473,7 @@ def get_secure_store(ca_name):
         with open(ca_cert_id_file_name, 'r') as file:
             ca_cert_id = file.read().replace('\n', '')
 
-        client = boto3.client('ssm')
+        client = get_client('ssm')
         response = client.get_parameter(\
             Name='cr-ca-key-{}'.format(ca_cert_id),
             WithDecryption=True)
@@ -396,10 +485,10 @@ def get_secure_store(ca_name):
 
 
 '''
-    Securely store the Ca private key
+    Securely store the Ca private key. Returns False if it wasn't stored.
 '''
 def put_secure_store(ca_name):
-
+    rc = True
     try:
         with open('{}{}_rootCA.key'.format(data_dir, ca_name)) as f:
             private_key = f.read()
@@ -409,7 +498,7 @@ def put_secure_store(ca_name):
             ca_cert_id = file.read().replace('\n', '')
         file.close()
 
-        client = boto3.client('ssm')
+        client = get_client('ssm')
         response = client.put_parameter(\
             Name='cr-ca-key-{}'.format(ca_cert_id),
             Description='{} CA private key'.format(ca_name),
@@ -420,4 +509,6 @@ def put_secure_store(ca_name):
 
     except Exception as e:
         logging.error('put_secure_store(): exception = {}'.format(str(e)))
+        rc = False
+    return rc
 
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: cert_engine.py
+
+    In-process key, CSR, and certificate generation for cert_auth.py.
+    RSA 2048 and ECDSA P-256 keys are supported (see key_types in config.py).
+
+    The openssl command line path forks three processes per device and
+    re-reads the CA key for every certificate. This engine does the same
+    work with the cryptography module, loads each CA key and cert once, and
+    writes the same data_io artifacts:
+        <dev>.key, <dev>.csr, <dev>.pem
+        <ca_name>_rootCA.key, <ca_name>_rootCA.pem
+    Both paths give each cert a random serial number, so there is no
+    <ca_name>_rootCA.srl to share between processes.
+'''
+
+import os
+import datetime
+import hashlib
+import logging
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
+from config import *
+
+subj_str_oids = {
+    'C': NameOID.COUNTRY_NAME,
+    'ST': NameOID.STATE_OR_PROVINCE_NAME,
+    'L': NameOID.LOCALITY_NAME,
+    'O': NameOID.ORGANIZATION_NAME,
+    'OU': NameOID.ORGANIZATIONAL_UNIT_NAME,
+    'CN': NameOID.COMMON_NAME,
+    'emailAddress': NameOID.EMAIL_ADDRESS
+    }
+
+# Loaded CA engines by ca_name
+engines = {}
+
+'''
+    Convert an openssl -subj string (e.g. '/C=US/ST=Kansas/CN=dev1')
+    into an x509.Name
+'''
+def subj_str_to_name(subj_str):
+    name_attrs = []
+    for rdn in subj_str.strip('/').split('/'):
+        oid_name, value = rdn.split('=', 1)
+        name_attrs.append(x509.NameAttribute(subj_str_oids[oid_name], value))
+    return x509.Name(name_attrs)
+
+'''
+    Generate a private key of key_type. Same keys as:
+        rsa: openssl genrsa 2048
+        ec:  openssl ecparam -name prime256v1 -genkey -noout
+'''
+def gen_private_key(key_type=default_key_type):
+    if key_type == 'ec':
+        return ec.generate_private_key(ec.SECP256R1(), default_backend())
+    if key_type == 'rsa':
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048,
+            backend=default_backend())
+    raise ValueError('unknown key_type {}'.format(key_type))
+
+'''
+    Write bytes to a file readable only by the owner
+'''
+def write_private_file(filename, data):
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+
+def write_file(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def private_key_pem(key):
+    return key.private_bytes(encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption())
+
+def load_private_key(filename):
+    with open(filename, 'rb') as f:
+        return serialization.load_pem_private_key(f.read(), password=None,
+            backend=default_backend())
+
+def load_cert(filename):
+    with open(filename, 'rb') as f:
+        return x509.load_pem_x509_certificate(f.read(), default_backend())
+
+'''
+    AWS IoT certificate id of a PEM cert: the SHA-256 of its DER encoding
+'''
+def cert_pem_id(cert_pem):
+    if isinstance(cert_pem, str):
+        cert_pem = cert_pem.encode()
+    cert = x509.load_pem_x509_certificate(cert_pem, default_backend())
+    return hashlib.sha256(cert.public_bytes(serialization.Encoding.DER)).hexdigest()
+
+'''
+    Create a CSR signed by key for the subject in subj_str
+'''
+def gen_csr(key, subj_str):
+    builder = x509.CertificateSigningRequestBuilder()
+    builder = builder.subject_name(subj_str_to_name(subj_str))
+    return builder.sign(key, hashes.SHA256(), default_backend())
+
+'''
+    Create a self-signed CA key and cert. Equivalent to:
+        openssl genrsa -out <ca_name>_rootCA.key 2048
+        openssl req -x509 -new -nodes -key <ca_name>_rootCA.key -sha256 ...
+'''
+def new_ca_files(ca_name, subj_str, days, out_dir=data_dir, key_type=default_key_type):
+    key = gen_private_key(key_type)
+    name = subj_str_to_name(subj_str)
+    now = datetime.datetime.utcnow()
+    ski = x509.SubjectKeyIdentifier.from_public_key(key.public_key())
+
+    builder = x509.CertificateBuilder()
+    builder = builder.subject_name(name)
+    builder = builder.issuer_name(name)
+    builder = builder.public_key(key.public_key())
+    builder = builder.serial_number(x509.random_serial_number())
+    builder = builder.not_valid_before(now)
+    builder = builder.not_valid_after(now + datetime.timedelta(days=int(days)))
+    builder = builder.add_extension(ski, critical=False)
+    builder = builder.add_extension(
+        x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ski),
+        critical=False)
+    builder = builder.add_extension(
+        x509.BasicConstraints(ca=True, path_length=None), critical=True)
+    cert = builder.sign(key, hashes.SHA256(), default_backend())
+
+    write_private_file('{}{}_rootCA.key'.format(out_dir, ca_name),
+        private_key_pem(key))
+    write_file('{}{}_rootCA.pem'.format(out_dir, ca_name),
+        cert.public_bytes(serialization.Encoding.PEM))
+
+    # A new CA invalidates any engine loaded with the old key
+    engines.pop((ca_name, out_dir), None)
+
+'''
+    Signs CSRs with one CA. The CA key and cert are read from disk once.
+'''
+class CertEngine():
+    def __init__(self, ca_name, out_dir=data_dir):
+        self.ca_name = ca_name
+        self.out_dir = out_dir
+        self.ca_key = load_private_key('{}{}_rootCA.key'.format(out_dir, ca_name))
+        self.ca_cert = load_cert('{}{}_rootCA.pem'.format(out_dir, ca_name))
+
+    def key_type(self):
+        if isinstance(self.ca_key, ec.EllipticCurvePrivateKey):
+            return 'ec'
+        return 'rsa'
+
+    '''
+        Sign csr and return the cert. Equivalent to:
+            openssl x509 -req -in <csr> -CA <ca>.pem -CAkey <ca>.key
+                -set_serial <random> -days <days> -sha256
+    '''
+    def sign_csr(self, csr, days):
+        now = datetime.datetime.utcnow()
+
+        builder = x509.CertificateBuilder()
+        builder = builder.subject_name(csr.subject)
+        builder = builder.issuer_name(self.ca_cert.subject)
+        builder = builder.public_key(csr.public_key())
+        # Random serials are safe when several processes sign with one CA
+        builder = builder.serial_number(x509.random_serial_number())
+        builder = builder.not_valid_before(now)
+        builder = builder.not_valid_after(now + datetime.timedelta(days=int(days)))
+        return builder.sign(self.ca_key, hashes.SHA256(), default_backend())
+
+    '''
+        Create <dev>.key, <dev>.csr, and <dev>.pem in out_dir.
+        With existing_key, <dev>.key is already on disk (e.g. claimed from
+        the key pool) and is used instead of generating a new key.
+    '''
+    def new_dev_files(self, dev, dev_subj_str, days, existing_key=False,
+            key_type=default_key_type):
+        key_filename = '{}{}.key'.format(self.out_dir, dev)
+        if existing_key:
+            key = load_private_key(key_filename)
+        else:
+            key = gen_private_key(key_type)
+            write_private_file(key_filename, private_key_pem(key))
+
+        csr = gen_csr(key, dev_subj_str)
+        cert = self.sign_csr(csr, days)
+
+        write_file('{}{}.csr'.format(self.out_dir, dev),
+            csr.public_bytes(serialization.Encoding.PEM))
+        write_file('{}{}.pem'.format(self.out_dir, dev),
+            cert.public_bytes(serialization.Encoding.PEM))
+        return cert
+
+    '''
+        Create a verification key and cert for CA registration with the
+        registration code in the subject. Returns (key pem, cert pem).
+    '''
+    def new_verification_cert(self, ver_subj_str, days):
+        key = gen_private_key(self.key_type())
+        cert = self.sign_csr(gen_csr(key, ver_subj_str), days)
+        return private_key_pem(key), cert.public_bytes(serialization.Encoding.PEM)
+
+'''
+    Get the engine for ca_name, loading the CA on first use
+'''
+def get_engine(ca_name, out_dir=data_dir):
+    engine = engines.get((ca_name, out_dir), None)
+    if not engine:
+        engine = CertEngine(ca_name, out_dir)
+        engines[(ca_name, out_dir)] = engine
+    return engine
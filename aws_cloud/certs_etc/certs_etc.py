@@ -34,7 +34,10 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 import argparse
 from cert_auth import *
 from device_dyn_db import *
-from local_json import get_json_array_dicts
+from local_json import get_json_array_dicts, iter_device_dicts
+from provision_pipeline import provision_devices
+from teardown_pipeline import teardown_devices, iter_failed_devices
+from run_journal import RunJournal, delete_journal, STAGE_CERT, STAGE_POLICY
 import logging
 from config import *
 from manage_files import *
@@ -53,10 +56,13 @@ from manage_files import *
         device connects to IoT core to register the cert, create thing
     - Cert Policy for all Vendor certificates
     - Cert Policy for all Manufacturer certificates
+
+  Progress is recorded in journal (run_journal.py), so running --create
+  again after a crash skips the CAs and devices that are already done.
 '''
-def create_ca_dev():
+def create_ca_dev(workers=1, io_workers=PROVISION_IO_THREADS, journal=None):
+    journal = journal or RunJournal()
     ca_array_dicts = get_json_array_dicts(ca_list_filename)
-    device_array_dicts = get_json_array_dicts(device_list_filename)
     for ca_dict in ca_array_dicts:
         ca_name = ca_dict.get('ca_name', None)
         subj_str = ca_dict.get('subj_str', None)
@@ -64,26 +70,46 @@ def create_ca_dev():
         jitp = ca_dict.get('jitp', None)
         days = ca_dict.get('days', None)
         policy_name = ca_dict.get('policy_name', None)
+        key_type = ca_dict.get('key_type', default_key_type)
         if ca_name and subj_str and devices and jitp and days and policy_name:
             devices = (devices == 'True')
             jitp = (jitp == 'True')
-            new_ca(ca_name, subj_str, days, jitp=jitp)
-            if ca_name == 'Manufacturer':
-                put_secure_store(ca_name)
-                if device_array_dicts:
-                    device_dict = device_array_dicts[0]
-                    file_name = '{}{}_ca_cert_id.txt'.format(data_dir, ca_name)
-                    with open(file_name, 'r') as file:
-                        ca_cert_id = file.read().replace('\n', '')
-                    write_man_ca_cert_id(dev, ca_cert_id)
-
-            if devices:
-                for device_dict in device_array_dicts:
+            # A second new_ca would replace the CA that signed the journaled certs
+            if not journal.step_done('new_ca:{}'.format(ca_name)):
+                if not new_ca(ca_name, subj_str, days, jitp=jitp, key_type=key_type):
+                    # Not journaled, so the next --create tries the CA again
+                    logging.error('create_ca_dev(): new_ca({}) failed, skipping its devices'.\
+                        format(ca_name))
+                    continue
+                journal.record_step('new_ca:{}'.format(ca_name))
+            if ca_name == 'Manufacturer' and not journal.step_done('man_ca_setup'):
+                if put_secure_store(ca_name):
+                    device_dict = next(iter_device_dicts(device_list_filename), None)
+                    if device_dict:
+                        file_name = '{}{}_ca_cert_id.txt'.format(data_dir, ca_name)
+                        with open(file_name, 'r') as file:
+                            ca_cert_id = file.read().replace('\n', '')
+                        write_man_ca_cert_id(device_dict.get('SerialNumber', None), ca_cert_id)
+                    journal.record_step('man_ca_setup')
+                else:
+                    logging.error('create_ca_dev(): put_secure_store({}) failed'.format(ca_name))
+
+            if devices and workers > 1:
+                provision_devices(ca_name, iter_device_dicts(device_list_filename), subj_str, days,
+                    policy_name, workers, io_workers, jitp=jitp, key_type=key_type,
+                    journal=journal)
+            elif devices:
+                final_stage = STAGE_CERT if jitp else STAGE_POLICY
+                for device_dict in iter_device_dicts(device_list_filename):
                     dev = device_dict.get('SerialNumber', None)
 
-                    if dev:
+                    if dev and journal.get_stage(ca_name, dev)[0] < final_stage:
                         logging.info('new_dev({})'.format(dev))
-                        new_dev(ca_name, dev, subj_str, days, policy_name, jitp=jitp)
+                        if new_dev(ca_name, dev, subj_str, days, policy_name, jitp=jitp,
+                                key_type=key_type):
+                            journal.record(ca_name, dev, final_stage)
+                journal.commit()
+            if devices:
                 logging.info('*********** DEVICE CERTS FOR CA {} ***********'.format(ca_name))
                 list_dev_certs()
                 logging.info('*********** END DEVICE CERTS FOR CA {} *******'.format(ca_name))
@@ -107,11 +133,18 @@ def del_rule_and_lambda_permissions():
   Delete CAa, things, certificates, certificate policies, 
   attach certificate polices to certificates based on 
   ca_list_filename and device_list_filename.
+
+  Devices are torn down concurrently by teardown_pipeline.py, detaching
+  every CA's policy from each cert. retry_failures tears down only the
+  devices that failed in the last teardown manifest.
+
+  If any device fails, the CAs are kept and False is returned, so the
+  failed devices can be retried with --delete --retry_failures.
 '''
-def del_ca_dev():
+def del_ca_dev(in_flight=TEARDOWN_IN_FLIGHT, retry_failures=False):
     ca_array_dicts = get_json_array_dicts(ca_list_filename)
-    device_array_dicts = get_json_array_dicts(device_list_filename)
 
+    policy_names = []
     for ca_dict in ca_array_dicts:
         ca_name = ca_dict.get('ca_name', None)
         subj_str = ca_dict.get('subj_str', None)
@@ -120,12 +153,17 @@ def del_ca_dev():
         days = ca_dict.get('days', None)
         policy_name = ca_dict.get('policy_name', None)
         if ca_name and subj_str and devices and jitp and days and policy_name:
-            if devices:
-                for device_dict in device_array_dicts:
-                    dev = device_dict.get('SerialNumber', None)
+            if policy_name not in policy_names:
+                policy_names.append(policy_name)
 
-                    if dev:
-                        del_dev(dev, policy_name)
+    if retry_failures:
+        device_dicts = iter_failed_devices()
+    else:
+        device_dicts = iter_device_dicts(device_list_filename)
+    if not teardown_devices(device_dicts, policy_names, in_flight):
+        logging.error('del_ca_dev(): teardown failed for some devices, keeping the CAs. '
+            'Run --delete --retry_failures')
+        return False
 
     for ca_dict in ca_array_dicts:
         ca_name = ca_dict.get('ca_name', None)
@@ -150,6 +188,7 @@ def del_ca_dev():
     logging.info('*********** CERT POLICIES ***********')
     list_cert_policies()
     logging.info('*********** END CERT POLICIES ***********')
+    return True
 
 '''
     Entry point for everything in this directory related to Cert Rotation blog.
@@ -158,23 +197,31 @@ def main():
     argp = argparse.ArgumentParser(description='AWS Cert Rotation Blog')
     argp.add_argument('--create', action='store_true', help='--create Create Vendor and Manufacturer self-signed CAs, etc.')
     argp.add_argument('--delete', action='store_true', help='--delete Delete Vendor and Manufacturer self-signed CAs, etc.')
+    argp.add_argument('--workers', type=int, default=1, help='--workers key/CSR/cert processes for --create, 1 = sequential')
+    argp.add_argument('--io_workers', type=int, default=PROVISION_IO_THREADS, help='--io_workers register and attach policy threads for --create')
+    argp.add_argument('--in_flight', type=int, default=TEARDOWN_IN_FLIGHT, help='--in_flight devices torn down at once for --delete')
+    argp.add_argument('--retry_failures', action='store_true', help='--retry_failures with --delete, only devices that failed in the last teardown manifest')
 
     args = argp.parse_args()
 
-    logging.info('create = {create}, delete = {delete}'.\
-        format(create=args.create, delete=args.delete))
+    logging.info('create = {create}, delete = {delete}, workers = {workers}'.\
+        format(create=args.create, delete=args.delete, workers=args.workers))
 
     if args.create != args.delete:
         if args.create:
-            load_devices_into_dyn_db()
-            create_ca_dev()
+            journal = RunJournal()
+            load_devices_into_dyn_db(journal)
+            create_ca_dev(args.workers, args.io_workers, journal)
+            journal.close()
             gen_files()
             copy_files()
 
         if args.delete:
-            del_ca_dev()
-            delete_devices_from_dyn_db()
-            remove_files()
+            # The rows, CA ids, and journal are needed to retry failed devices
+            if del_ca_dev(args.in_flight, args.retry_failures):
+                delete_devices_from_dyn_db()
+                remove_files()
+                delete_journal()
 
     else:
         argp.print_help()
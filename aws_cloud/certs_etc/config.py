@@ -36,6 +36,50 @@ LAMBDA_ROLE_NAME='cert_rotation_lambda_role'
 DDB_NAME='CertRotationDevices'
 ###################################
 
+# Shared boto3 clients (aws_clients.py)
+AWS_MAX_POOL_CONNECTIONS = 64 # keep >= PROVISION_IO_THREADS
+AWS_MAX_ATTEMPTS = 5
+
+# AWS IoT control plane rate limits in calls/sec (rate_limit.py). These
+# follow the default AWS IoT Core quotas; set them to the account's quotas.
+IOT_API_RATES = {
+    'RegisterCACertificate': 10,
+    'UpdateCACertificate': 10,
+    'DeleteCACertificate': 10,
+    'RegisterCertificate': 15,
+    'UpdateCertificate': 15,
+    'DeleteCertificate': 15,
+    'AttachPolicy': 15,
+    'DetachPolicy': 15,
+    'AttachThingPrincipal': 15,
+    'DetachThingPrincipal': 15,
+    'DeleteThing': 15,
+    'DescribeCertificate': 10,
+    'DescribeCACertificate': 10
+    }
+IOT_DEFAULT_RATE = 10 # APIs not in IOT_API_RATES
+RATE_LIMIT_DECREASE = 0.5 # rate multiplier on throttling
+RATE_LIMIT_INCREASE = 0.1 # fraction of the configured rate added back
+RATE_LIMIT_COOLDOWN = 1.0 # seconds between rate changes
+RATE_LIMIT_MIN_RATE = 0.5 # calls/sec
+
+# Resumable --create runs (run_journal.py)
+JOURNAL_COMMIT_RECORDS = 500 # commit after this many device records
+JOURNAL_COMMIT_SEC = 1.0 # or after this many seconds
+
+# Batched DynamoDB whitelist loads (device_dyn_db.py)
+DDB_BATCH_SIZE = 25 # BatchWriteItem maximum
+DDB_BATCH_WRITERS = 8 # parallel BatchWriteItem threads
+DDB_BATCH_MAX_ATTEMPTS = 10 # re-submissions of UnprocessedItems per batch
+DDB_ON_DEMAND_START_RATE = 1000 # starting write units/sec for on-demand tables
+DDB_MIN_WRITE_RATE = 1 # write units/sec
+DDB_MAX_WRITE_RATE = 40000 # write units/sec
+DDB_WRITE_RATE_INCREASE = 100 # write units/sec added per second without throttling
+DDB_BATCH_GET_SIZE = 100 # BatchGetItem maximum
+
+# Concurrent teardown for certs_etc.py --delete (teardown_pipeline.py)
+TEARDOWN_IN_FLIGHT = 32 # devices being torn down at once
+
 ###################################
 # Date input and output variables
 ###################################
@@ -44,9 +88,36 @@ ca_list_filename = '{}ca_list.json'.format(data_dir)
 #ca_list_filename = '{}ca_list_test1.json'.format(data_dir) # Test 2 of 4 jitr & device option
 #ca_list_filename = '{}ca_list_test2.json'.format(data_dir) # Test 2 of 4 jitr & device option
 device_list_filename = '{}device_list.json'.format(data_dir)
+#device_list_filename = '{}device_list.jsonl'.format(data_dir) # one JSON object per line
+#device_list_filename = '{}device_list.csv'.format(data_dir) # SerialNumber,CrState header row
+teardown_manifest_filename = '{}teardown_manifest.jsonl'.format(data_dir)
+run_journal_filename = '{}run_journal.sqlite3'.format(data_dir)
 jitp_filename = '{}jitp.txt'.format(data_dir)
 
 ssl_stdout = '{}open_ssl_stdout.txt'.format(data_dir)
 ssl_stderr = '{}open_ssl_stderr.txt'.format(data_dir)
 
+# Key, CSR, and cert generation: 'python' runs in-process (cert_engine.py),
+# 'openssl' forks the openssl command line for each step.
+cert_engine_name = 'python'
+
+# Key types for CAs and device keys. ca_list.json entries select one with
+# "key_type"; entries without it use default_key_type.
+#   'rsa' - RSA 2048
+#   'ec'  - ECDSA P-256 (prime256v1)
+key_types = ['rsa', 'ec']
+default_key_type = 'rsa'
+
+# Bulk provisioning pipeline (provision_pipeline.py)
+# certs_etc.py --workers sets the number of key/CSR/cert processes.
+PROVISION_IO_THREADS = 16 # register and attach policy threads
+PROVISION_QUEUE_DEPTH = 2 # in-flight devices per worker before back-pressure
+
+# Pre-generated device key pool (key_reservoir.py)
+use_key_pool = True # claim device keys from the pool, generate inline when empty
+key_pool_dir = '{}key_pool/'.format(data_dir)
+KEY_POOL_LOW_WATERMARK = 1000
+KEY_POOL_HIGH_WATERMARK = 10000
+KEY_POOL_FILL_INTERVAL = 60 # seconds between --watch checks
+
 serial_number = 'IUQWXALODJESC1'
@@ -26,24 +26,39 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
     Actions:
         - add all devices in the device_list_filename to the dynamoDB table
         - remove all devices in the device_list_filename from the dynamoDB table
+
+    Whitelist loads and deletes use 25 item BatchWriteItem calls from parallel
+    writer threads. UnprocessedItems are re-submitted with backoff, and the
+    write rate follows the capacity DynamoDB reports as consumed.
 '''
 
-import boto3
 import json
 import logging
 from config import *
 import argparse
 import os
-from local_json import get_json_array_dicts
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.exceptions import ClientError
+from local_json import iter_device_dicts
+from aws_clients import get_resource
+
+ddb_table = None
+
+# Errors that mean slow down and try again
+DDB_THROTTLE_CODES = ['ProvisionedThroughputExceededException', 'ThrottlingException',
+    'RequestLimitExceeded']
 
 def get_table():
-    ddb_table = None
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        ddb_table = dynamodb.Table(DDB_NAME)
-    except Exception as e:
-        ddb_table = None
-        logging.error("get_table(): Exception: {}".format(str(e)))
+    global ddb_table
+    if not ddb_table:
+        try:
+            ddb_table = get_resource('dynamodb').Table(DDB_NAME)
+        except Exception as e:
+            ddb_table = None
+            logging.error("get_table(): Exception: {}".format(str(e)))
     return(ddb_table)
 
 '''
@@ -94,56 +109,254 @@ def del_device(ddb_table, device_dict):
     return rc
 
 '''
-    Load all devices in the device_list_filename to the dynamo db table.
+    Paces batch writes to a write unit rate. The rate grows by
+    DDB_WRITE_RATE_INCREASE per second while DynamoDB processes every item
+    and halves when it returns UnprocessedItems or throttles, so loads settle
+    at the table's sustainable rate. The increase is by elapsed time, not per
+    batch, so it doesn't scale with the number of writer threads.
 '''
-def load_devices_into_dyn_db():
+class WriteRateController():
+    def __init__(self, start_rate, max_rate=DDB_MAX_WRITE_RATE):
+        self.rate = float(start_rate)
+        self.max_rate = float(max_rate)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.last_adjust = self.last
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    '''
+        Block until units write units may be sent
+    '''
+    def acquire(self, units):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= min(units, self.rate):
+                    self.tokens -= units
+                    return
+                wait_sec = (min(units, self.rate) - self.tokens) / self.rate
+            time.sleep(wait_sec)
+
+    '''
+        Settle the estimate against consumed units and adapt the rate
+    '''
+    def on_result(self, estimated_units, consumed_units, throttled):
+        with self.lock:
+            self.tokens -= consumed_units - estimated_units
+            now = time.monotonic()
+            if throttled:
+                self.rate = max(DDB_MIN_WRITE_RATE, self.rate / 2)
+            else:
+                self.rate = min(self.max_rate,
+                    self.rate + (now - self.last_adjust) * DDB_WRITE_RATE_INCREASE)
+            self.last_adjust = now
 
-    device_array_dicts = get_json_array_dicts(device_list_filename)
+'''
+    Starting write rate: provisioned WCU, or DDB_ON_DEMAND_START_RATE
+    for on-demand tables
+'''
+def get_start_write_rate(ddb_table):
+    try:
+        table = ddb_table.meta.client.describe_table(TableName=DDB_NAME)['Table']
+        billing_mode = table.get('BillingModeSummary', {}).get('BillingMode', 'PROVISIONED')
+        wcu = table.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0)
+        if billing_mode == 'PROVISIONED' and wcu:
+            return wcu
+    except Exception as e:
+        logging.error('get_start_write_rate(): Exception = {}'.format(str(e)))
+    return DDB_ON_DEMAND_START_RATE
 
-    logging.info('load_devices_into_dyn_db(): Loading devices')
-    logging.info(device_array_dicts)
+'''
+    Write one batch of up to 25 requests, re-submitting UnprocessedItems.
+    Returns the requests DynamoDB never processed.
+'''
+def write_batch(ddb_resource, write_requests, controller):
+    for attempt in range(DDB_BATCH_MAX_ATTEMPTS):
+        estimated_units = len(write_requests)
+        controller.acquire(estimated_units)
+        try:
+            response = ddb_resource.batch_write_item(
+                RequestItems={DDB_NAME: write_requests},
+                ReturnConsumedCapacity='TOTAL')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in DDB_THROTTLE_CODES:
+                raise
+            controller.on_result(estimated_units, estimated_units, True)
+        else:
+            consumed_units = sum(c.get('CapacityUnits', 0) for c in response.get('ConsumedCapacity', []))
+            unprocessed = response.get('UnprocessedItems', {}).get(DDB_NAME, [])
+            controller.on_result(estimated_units, consumed_units, bool(unprocessed))
+            if not unprocessed:
+                return []
+            write_requests = unprocessed
+        # Full jitter backoff before re-submitting
+        time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+    return write_requests
 
-    devices_loaded = 0
+'''
+    Split device dicts into batches of write requests, one request per serial number
+'''
+def gen_write_batches(device_dicts, make_request):
+    batch = {}
+    for device_dict in device_dicts:
+        serial_number = device_dict.get('SerialNumber', None)
+        if not serial_number:
+            continue
+        # BatchWriteItem rejects two requests for one key in a batch
+        batch[serial_number] = make_request(device_dict)
+        if len(batch) == DDB_BATCH_SIZE:
+            yield list(batch.values())
+            batch = {}
+    if batch:
+        yield list(batch.values())
 
+'''
+    Write all device_dicts with parallel batch writers. on_written, if set,
+    is called in this thread with the serial numbers of each written batch.
+    Returns (requests written, requests failed).
+'''
+def batch_write_devices(device_dicts, make_request, writers=DDB_BATCH_WRITERS,
+        on_written=None):
     ddb_table = get_table()
+    ddb_resource = get_resource('dynamodb')
+    controller = WriteRateController(get_start_write_rate(ddb_table))
+    written = 0
+    failed = 0
+    inflight = {}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=writers) as pool:
+        for write_requests in gen_write_batches(device_dicts, make_request):
+            if len(inflight) >= writers * 2:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_written, batch_failed = collect_batch(future, inflight.pop(future))
+                    written += len(batch_written)
+                    failed += batch_failed
+                    if on_written and batch_written:
+                        on_written(batch_written)
+            future = pool.submit(write_batch, ddb_resource, write_requests, controller)
+            inflight[future] = write_requests
+
+        for future in list(inflight):
+            batch_written, batch_failed = collect_batch(future, inflight.pop(future))
+            written += len(batch_written)
+            failed += batch_failed
+            if on_written and batch_written:
+                on_written(batch_written)
+
+    elapsed = time.perf_counter() - start
+    logging.info('batch_write_devices(): written = {}, failed = {}, {:.1f} items/sec, final rate = {:.0f} WCU/sec'.\
+        format(written, failed, written / elapsed if elapsed else 0.0, controller.rate))
+    return written, failed
 
-    for device_dict in device_array_dicts:
-        if add_device(ddb_table, device_dict):
-            logging.info('Loaded Device: SerialNumber = {}'.\
-                    format(device_dict.get('SerialNumber',None)))
-            devices_loaded += 1
-        else:
-            logging.info('Device load failed: SerialNumber = {}'.\
-                    format(device_dict.get('SerialNumber',None)))
+'''
+    (serial numbers written, failed count) for a finished write_batch future
+'''
+def collect_batch(future, write_requests):
+    try:
+        unprocessed = future.result()
+    except Exception as e:
+        logging.error('batch_write_devices(): Exception = {}'.format(str(e)))
+        unprocessed = write_requests
+    unprocessed_serial_numbers = set(request_serial_number(r) for r in unprocessed)
+    written = [request_serial_number(r) for r in write_requests
+        if request_serial_number(r) not in unprocessed_serial_numbers]
+    return written, len(unprocessed)
+
+def request_serial_number(write_request):
+    if 'PutRequest' in write_request:
+        return write_request['PutRequest']['Item']['SerialNumber']
+    return write_request['DeleteRequest']['Key']['SerialNumber']
 
-    logging.info('Total Devices Loaded = {}'.format(devices_loaded))
+'''
+    Read the rows for serial_numbers with BatchGetItem, 100 keys per call.
+    UnprocessedKeys and throttling are retried with backoff, as in
+    write_batch(). Returns ({SerialNumber: item}, [serial numbers not read]).
+    Serial numbers read but without a row are in neither.
+'''
+def batch_read_devices(serial_numbers,
+        projection='SerialNumber, ManufacturerCertId, VendorCertId'):
+    ddb_resource = get_resource('dynamodb')
+    items = {}
+    unread = []
+    serial_numbers = list(dict.fromkeys(serial_numbers))
+
+    for i in range(0, len(serial_numbers), DDB_BATCH_GET_SIZE):
+        keys = [{'SerialNumber':sn} for sn in serial_numbers[i:i + DDB_BATCH_GET_SIZE]]
+        for attempt in range(DDB_BATCH_MAX_ATTEMPTS):
+            try:
+                response = ddb_resource.batch_get_item(RequestItems={DDB_NAME:
+                    {'Keys':keys, 'ProjectionExpression':projection}})
+            except ClientError as e:
+                if e.response['Error']['Code'] not in DDB_THROTTLE_CODES:
+                    logging.error('batch_read_devices(): Exception = {}'.format(str(e)))
+                    break
+            except Exception as e:
+                logging.error('batch_read_devices(): Exception = {}'.format(str(e)))
+                break
+            else:
+                for item in response.get('Responses', {}).get(DDB_NAME, []):
+                    items[item['SerialNumber']] = item
+                keys = response.get('UnprocessedKeys', {}).get(DDB_NAME, {}).get('Keys', [])
+                if not keys:
+                    break
+            time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+        if keys:
+            logging.error('batch_read_devices(): {} keys unread'.format(len(keys)))
+            unread += [key['SerialNumber'] for key in keys]
+
+    return items, unread
+
+def put_request(device_dict):
+    return {'PutRequest': {'Item': {
+        'SerialNumber':device_dict.get('SerialNumber',None),
+        'CrState':device_dict.get('CrState',None)
+        }}}
+
+def delete_request(device_dict):
+    return {'DeleteRequest': {'Key': {
+        'SerialNumber':device_dict.get('SerialNumber',None)
+        }}}
+
+'''
+    Load all devices in the device_list_filename to the dynamo db table.
+    With a run journal, rows written by an earlier run are skipped.
+'''
+def load_devices_into_dyn_db(journal=None):
+
+    logging.info('load_devices_into_dyn_db(): Loading devices')
+
+    device_dicts = iter_device_dicts(device_list_filename)
+    on_written = None
+    if journal:
+        device_dicts = (d for d in device_dicts
+            if not journal.ddb_row_done(d.get('SerialNumber', None)))
+        on_written = journal.record_ddb_rows
+
+    devices_loaded, devices_failed = batch_write_devices(device_dicts, put_request,
+        on_written=on_written)
+    if journal:
+        journal.commit()
+
+    logging.info('Total Devices Loaded = {}, Failed = {}'.format(devices_loaded, devices_failed))
     
 '''
     Delete all devices in the device_list_filename from the dynamo db table.
 '''
 def delete_devices_from_dyn_db():
 
-    device_array_dicts = get_json_array_dicts(device_list_filename)
-
     logging.info('delete_devices_from_dyn_db(): Deleting devices')
-    logging.info(device_array_dicts)
-
-    devices_deleted = 0
-
-    ddb_table = get_table()
 
-    for device_dict in device_array_dicts:
-        response = ddb_table.delete_item(Key={'SerialNumber':\
-            device_dict.get('SerialNumber',None)})
-        if response:
-            logging.info('Device: SerialNumber = {}'.\
-                    format(device_dict.get('SerialNumber',None)))
-            devices_deleted += 1
-        else:
-            logging.info('Device load failed: SerialNumber = {}'.\
-                    format(device_dict.get('SerialNumber',None)))
+    devices_deleted, devices_failed = batch_write_devices(
+        iter_device_dicts(device_list_filename), delete_request)
 
-    logging.info('Total Devices Deleted = {}'.format(devices_deleted))
+    logging.info('Total Devices Deleted = {}, Failed = {}'.format(devices_deleted, devices_failed))
 
 def read_man_cert_id(serial_number):
     cert_id = None
@@ -174,16 +387,19 @@ def read_vendor_cert_id(serial_number):
 def write_man_ca_cert_id(serial_number, ca_cert_id):
     ddb_table = get_table()
     try:
-        print('write_man_ca_cert_id(): ca_cert_id = {}'.format(ca_cert_id))
-        response = ddb_table.get_item(Key={'SerialNumber':serial_number})
-        item = response.get('Item', None)
-        if item:
-            item.update({'ManufacturerCaCertId':ca_cert_id})
-            ddb_table.put_item(Item=item)
-        else:
-            print('write_man_ca_cert_id(): get_item failed for serial_number = {}'.\
+        logging.info('write_man_ca_cert_id(): ca_cert_id = {}'.format(ca_cert_id))
+        # One round trip; only update rows that are already whitelisted
+        ddb_table.update_item(Key={'SerialNumber':serial_number},
+            UpdateExpression='SET ManufacturerCaCertId = :ca_cert_id',
+            ConditionExpression='attribute_exists(SerialNumber)',
+            ExpressionAttributeValues={':ca_cert_id':ca_cert_id})
+
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logging.info('write_man_ca_cert_id(): no item for serial_number = {}'.\
                     format(serial_number))
-
+        else:
+            logging.error('write_man_ca_cert_id(): Exception = {}'.format(str(e)))
     except Exception as e:
         logging.error('write_man_ca_cert_id(): Exception = {}'.format(str(e)))
 
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: key_reservoir.py
+
+    On-disk pool of pre-generated device private keys.
+
+    Key generation dominates new_dev() time. The filler generates keys ahead
+    of time (e.g. overnight) so provisioning runs only move files.
+
+    Layout per key type (directory mode 0700, key files mode 0600):
+        data_io/key_pool/<key_type>/tmp/    keys being written by the filler
+        data_io/key_pool/<key_type>/ready/  keys ready to claim, oldest name first
+
+    Key file names are <microseconds>-<filler pid>-<seq>.key. A filler that
+    starts removes tmp/ files left by fillers that are no longer running.
+
+    A key is claimed with a rename from ready/ to the device key file.
+    Rename is atomic, so concurrent provisioning processes never get the
+    same key; a process that loses the race moves on to the next name.
+
+    Usage:
+        > python key_reservoir.py --fill            # fill to high watermark if below low
+        > python key_reservoir.py --fill --watch    # keep filling in the background
+        > python key_reservoir.py --fill --key_type ec
+        > python key_reservoir.py --stats
+'''
+
+import argparse
+import itertools
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from config import *
+from cert_engine import gen_private_key, private_key_pem, write_private_file
+
+class KeyReservoir():
+    def __init__(self, key_type=default_key_type, pool_dir=key_pool_dir,
+            low=KEY_POOL_LOW_WATERMARK, high=KEY_POOL_HIGH_WATERMARK):
+        self.key_type = key_type
+        self.pool_dir = pool_dir
+        self.low = low
+        self.high = high
+        self.ready_dir = os.path.join(pool_dir, key_type, 'ready')
+        self.tmp_dir = os.path.join(pool_dir, key_type, 'tmp')
+        self.candidates = []
+        self.seq = itertools.count()
+
+    def make_dirs(self):
+        for dir_name in [self.pool_dir, os.path.dirname(self.ready_dir),
+                self.ready_dir, self.tmp_dir]:
+            os.makedirs(dir_name, mode=0o700, exist_ok=True)
+
+    def list_ready(self):
+        try:
+            return sorted(name for name in os.listdir(self.ready_dir) if name.endswith('.key'))
+        except FileNotFoundError:
+            return []
+
+    def count(self):
+        return len(self.list_ready())
+
+    '''
+        Move one ready key to key_filename. Returns True if a key was
+        claimed, False if the pool is empty.
+    '''
+    def claim(self, key_filename):
+        for attempt in range(2):
+            while self.candidates:
+                name = self.candidates.pop()
+                try:
+                    os.rename(os.path.join(self.ready_dir, name), key_filename)
+                    return True
+                except FileNotFoundError:
+                    # Claimed by another process
+                    continue
+            # Refill the local candidate list once per directory listing
+            self.candidates = list(reversed(self.list_ready()))
+        return False
+
+    '''
+        Add key pem bytes to the pool. Written to tmp/ then renamed into
+        ready/ so a claim never sees a partial file.
+    '''
+    def add(self, key_pem):
+        name = '{:020d}-{}-{}.key'.format(int(time.time() * 1e6), os.getpid(), next(self.seq))
+        tmp_filename = os.path.join(self.tmp_dir, name)
+        write_private_file(tmp_filename, key_pem)
+        os.rename(tmp_filename, os.path.join(self.ready_dir, name))
+
+    '''
+        Remove partial keys in tmp/ written by fillers that are no longer
+        running, e.g. one killed mid-fill. Returns the number removed.
+    '''
+    def clean_tmp(self):
+        removed = 0
+        try:
+            names = os.listdir(self.tmp_dir)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            try:
+                pid = int(name.split('-')[1])
+            except (IndexError, ValueError):
+                pid = None
+            if pid and pid_running(pid):
+                continue
+            try:
+                os.remove(os.path.join(self.tmp_dir, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        if removed:
+            logging.info('clean_tmp(): removed {} partial keys from {}'.format(removed, self.tmp_dir))
+        return removed
+
+    '''
+        If the pool is at or below the low watermark, generate keys until it
+        reaches the high watermark. Returns the number of keys added.
+    '''
+    def fill(self, workers=None):
+        self.make_dirs()
+        count = self.count()
+        if count > self.low:
+            logging.info('fill(): {} keys ready, above low watermark {}'.format(count, self.low))
+            return 0
+
+        needed = self.high - count
+        logging.info('fill(): {} keys ready, generating {}'.format(count, needed))
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for key_pem in pool.map(gen_key_pem, [self.key_type] * needed, chunksize=64):
+                self.add(key_pem)
+        elapsed = time.perf_counter() - start
+        logging.info('fill(): added {} keys in {:.1f} sec'.format(needed, elapsed))
+        return needed
+
+    def stats(self):
+        names = self.list_ready()
+        now = int(time.time() * 1e6)
+        oldest_sec = (now - int(names[0].split('-')[0])) / 1e6 if names else 0
+        return {
+            'pool_dir': self.pool_dir,
+            'key_type': self.key_type,
+            'ready': len(names),
+            'low_watermark': self.low,
+            'high_watermark': self.high,
+            'below_low_watermark': len(names) <= self.low,
+            'oldest_key_age_sec': int(oldest_sec)
+            }
+
+'''
+    True if a process with pid exists on this host
+'''
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+'''
+    Process pool worker: one private key as pem bytes
+'''
+def gen_key_pem(key_type):
+    return private_key_pem(gen_private_key(key_type))
+
+# Per process reservoirs by key type
+reservoirs = {}
+
+'''
+    Per process reservoir used by new_dev()
+'''
+def get_reservoir(key_type=default_key_type):
+    reservoir = reservoirs.get(key_type, None)
+    if not reservoir:
+        reservoir = KeyReservoir(key_type)
+        reservoirs[key_type] = reservoir
+    return reservoir
+
+'''
+    Claim a pooled key into key_filename if the pool is enabled.
+    Returns False when the caller must generate the key itself.
+'''
+def claim_key(key_filename, key_type=default_key_type):
+    if not use_key_pool:
+        return False
+    try:
+        return get_reservoir(key_type).claim(key_filename)
+    except Exception as e:
+        logging.error('claim_key(): Exception = {}'.format(str(e)))
+        return False
+
+def main():
+    argp = argparse.ArgumentParser(description='Pre-generated device key pool')
+    argp.add_argument('--fill', action='store_true', help='--fill generate keys up to the high watermark when at or below the low watermark')
+    argp.add_argument('--watch', action='store_true', help='--watch with --fill, check the pool every --interval seconds')
+    argp.add_argument('--interval', type=int, default=KEY_POOL_FILL_INTERVAL, help='--interval seconds between --watch checks')
+    argp.add_argument('--low', type=int, default=KEY_POOL_LOW_WATERMARK, help='--low watermark')
+    argp.add_argument('--high', type=int, default=KEY_POOL_HIGH_WATERMARK, help='--high watermark')
+    argp.add_argument('--workers', type=int, default=None, help='--workers key generation processes, default all cores')
+    argp.add_argument('--key_type', choices=key_types, default=default_key_type, help='--key_type pool to fill or report')
+    argp.add_argument('--stats', action='store_true', help='--stats print pool statistics')
+    args = argp.parse_args()
+
+    pool = KeyReservoir(args.key_type, low=args.low, high=args.high)
+    if args.fill:
+        pool.clean_tmp()
+        while True:
+            pool.fill(args.workers)
+            if not args.watch:
+                break
+            time.sleep(args.interval)
+    elif args.stats:
+        for key, value in pool.stats().items():
+            print('{:<20} {}'.format(key, value))
+    else:
+        argp.print_help()
+
+if __name__ == '__main__':
+    main()
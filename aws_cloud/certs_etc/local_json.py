@@ -21,10 +21,19 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
     filename: local_json.py
 
     Extract json from various files then put into a usable form.
+
+    Device lists can have millions of rows, so iter_device_dicts() streams
+    them instead of loading the whole file.
 '''
 
+import csv
 import json
+import logging
 import os
+import re
+
+JSON_CHUNK_SIZE = 64 * 1024
+WHITESPACE = re.compile(r'\s*')
 
 def get_json_array_dicts(file_name):
     json_str = None
@@ -34,4 +43,89 @@ def get_json_array_dicts(file_name):
 
     return json_array_dicts
 
+'''
+    Yield the device dicts in file_name one at a time, in constant memory.
+    The format follows the extension:
+        .jsonl / .ndjson - one JSON object per line
+        .csv             - header row of field names, one device per row
+        anything else    - a JSON array of objects, parsed incrementally
+'''
+def iter_device_dicts(file_name, chunk_size=JSON_CHUNK_SIZE):
+    if not os.path.exists(file_name):
+        logging.error('iter_device_dicts(): {} does not exist'.format(file_name))
+        return
+
+    extension = os.path.splitext(file_name)[1].lower()
+    with open(file_name, 'r', newline='') as f:
+        if extension in ['.jsonl', '.ndjson']:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        elif extension == '.csv':
+            for row in csv.DictReader(f):
+                # Empty CSV fields read like keys missing from a JSON object
+                yield {k.strip():v.strip() for k, v in row.items() if k and v}
+        else:
+            for device_dict in iter_json_array(f, chunk_size):
+                yield device_dict
+
+'''
+    Yield the elements of the JSON array in file object f, reading
+    chunk_size characters at a time.
+'''
+def iter_json_array(f, chunk_size=JSON_CHUNK_SIZE):
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    expect = '['
+
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                raise ValueError('iter_json_array(): unexpected end of JSON array')
+            # Drop what has been consumed, then read the next chunk
+            buf = f.read(chunk_size)
+            pos = 0
+            eof = not buf
+            continue
+
+        ch = buf[pos]
+        if expect == '[':
+            if ch != '[':
+                raise ValueError('iter_json_array(): expected [ but found {}'.format(ch))
+            pos += 1
+            expect = 'first'
+        elif expect == 'first' and ch == ']':
+            return
+        elif expect in ['first', 'value']:
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+                # A number cut at the buffer end ('1', '1.', '1e') continues
+                # in the next chunk
+                complete = eof or (end < len(buf) and buf[end] not in '.eE+-')
+            except ValueError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                # Element spans the chunk boundary
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield element
+            pos = end
+            expect = ','
+        elif ch == ',':
+            pos += 1
+            expect = 'value'
+        elif ch == ']':
+            return
+        else:
+            raise ValueError('iter_json_array(): expected , or ] but found {}'.format(ch))
+
 
@@ -62,6 +62,7 @@ def gen_linux_device_filename_lists(remove=False):
         filename_list.append('{}_man.key'.format(serial_number))
         filename_list.append('{}_man.pem'.format(serial_number))
         filename_list.append('{}_man_cert_id.txt'.format(serial_number))
+        filename_list.append('{}_rotate.json'.format(serial_number))
         filename_list.append('{}_man_fake.key'.format(serial_number))
         filename_list.append('{}_man_fake.pem'.format(serial_number))
         filename_list.append('ManufacturerDeviceCertAndCACert.pem')
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: provision_pipeline.py
+
+    Bulk device provisioning pipeline for certs_etc.py --create.
+
+    Stage 1 (process pool): device key, CSR, and cert. CPU bound.
+    Stage 2 (thread pool):  register cert and attach cert policy. Network bound.
+
+    Each stage has a bound on in-flight devices. New devices are only fed
+    into stage 1 while stage 2 has room, so a slow network throttles key
+    generation instead of piling up certs in memory.
+
+    With a run journal (run_journal.py) the main process records each
+    device's stages; devices already done are skipped and devices with a
+    cert but no policy go straight to stage 2. Stage 1 keeps cert files a
+    previous run wrote (gen_dev_cert()), so a device whose journal record
+    was lost registers the same cert again.
+'''
+
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import *
+from cert_auth import gen_dev_cert, register_dev_cert, attach_cert_policy
+from cert_engine import get_engine
+from rate_limit import log_stats as log_rate_limit_stats
+from run_journal import STAGE_CERT, STAGE_REGISTERED, STAGE_POLICY
+
+'''
+    Counters and timing for the throughput summary
+'''
+class PipelineStats():
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.submitted = 0
+        self.certs = 0
+        self.registered = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def log_summary(self, ca_name, jitp):
+        elapsed = time.perf_counter() - self.start
+        completed = self.registered if not jitp else self.certs
+        rate = completed / elapsed if elapsed else 0.0
+        logging.info('*********** PROVISIONING SUMMARY FOR CA {} ***********'.format(ca_name))
+        logging.info('devices = {}, certs = {}, registered = {}, skipped = {}, failed = {}'.\
+            format(self.submitted, self.certs, self.registered, self.skipped, self.failed))
+        logging.info('elapsed = {:.1f} sec, throughput = {:.1f} devices/sec'.\
+            format(elapsed, rate))
+        log_rate_limit_stats()
+        logging.info('*********** END PROVISIONING SUMMARY ***********')
+
+'''
+    Process pool initializer: load the CA once per worker process
+'''
+def init_cpu_worker(ca_name):
+    if cert_engine_name == 'python':
+        get_engine(ca_name)
+
+'''
+    Stage 1 in a worker process. Returns dev so stage 2 knows which device completed.
+'''
+def cpu_stage(ca_name, dev, subj_str, days, key_type):
+    gen_dev_cert(ca_name, dev, subj_str, days, key_type)
+    return dev
+
+'''
+    Stage 2 in a worker thread. cert_id is set when a previous run already
+    registered the cert. Returns (cert_id, policy attached).
+'''
+def io_stage(ca_name, dev, policy_name, cert_id=None):
+    if not cert_id:
+        cert_id = register_dev_cert(ca_name, dev)
+    return cert_id, attach_cert_policy(cert_id, policy_name)
+
+'''
+    Provision every device in device_dicts for one CA.
+
+    workers    - stage 1 processes
+    io_workers - stage 2 threads
+    jitp/jitr  - certs for JITP/JITR CAs are registered on first connect,
+                 so stage 2 is skipped
+    journal    - optional RunJournal to resume from and record into
+'''
+def provision_devices(ca_name, device_dicts, subj_str, days, policy_name,
+        workers, io_workers=PROVISION_IO_THREADS, jitr=False, jitp=False,
+        key_type=default_key_type, journal=None):
+    stats = PipelineStats()
+    register = not jitr and not jitp
+    final_stage = STAGE_POLICY if register else STAGE_CERT
+    cpu_limit = workers * PROVISION_QUEUE_DEPTH
+    io_limit = io_workers * PROVISION_QUEUE_DEPTH
+    cpu_inflight = {}
+    io_inflight = {}
+    devices = iter(device_dicts)
+    exhausted = False
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_cpu_worker,
+            initargs=(ca_name,)) as cpu_pool, \
+            ThreadPoolExecutor(max_workers=io_workers) as io_pool:
+        while True:
+            # Feed stage 1 while both stages have room (back-pressure)
+            while not exhausted and len(cpu_inflight) < cpu_limit and \
+                    len(io_inflight) < io_limit:
+                device_dict = next(devices, None)
+                if device_dict is None:
+                    exhausted = True
+                    break
+                dev = device_dict.get('SerialNumber', None)
+                if not dev:
+                    continue
+                stats.submitted += 1
+                stage, cert_id = journal.get_stage(ca_name, dev) if journal else (0, None)
+                if stage >= final_stage:
+                    stats.skipped += 1
+                elif stage >= STAGE_CERT:
+                    io_future = io_pool.submit(io_stage, ca_name, dev, policy_name, cert_id)
+                    io_inflight[io_future] = dev
+                else:
+                    future = cpu_pool.submit(cpu_stage, ca_name, dev, subj_str, days, key_type)
+                    cpu_inflight[future] = dev
+
+            if not cpu_inflight and not io_inflight:
+                break
+
+            # Don't let stage 1 results run ahead of a full stage 2
+            if len(io_inflight) >= io_limit:
+                pending = set(io_inflight)
+            else:
+                pending = set(cpu_inflight) | set(io_inflight)
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future in cpu_inflight:
+                    dev = cpu_inflight.pop(future)
+                    try:
+                        future.result()
+                        stats.certs += 1
+                        if journal:
+                            journal.record(ca_name, dev, STAGE_CERT)
+                        if register:
+                            io_future = io_pool.submit(io_stage, ca_name, dev, policy_name)
+                            io_inflight[io_future] = dev
+                    except Exception as e:
+                        logging.error('provision_devices(): cert {} exception = {}'.format(dev, str(e)))
+                        stats.failed += 1
+                else:
+                    dev = io_inflight.pop(future)
+                    try:
+                        cert_id, attached = future.result()
+                        if journal:
+                            journal.record(ca_name, dev,
+                                STAGE_POLICY if attached else STAGE_REGISTERED, cert_id)
+                        if attached:
+                            stats.registered += 1
+                        else:
+                            logging.error('provision_devices(): register {} failed'.format(dev))
+                            stats.failed += 1
+                    except Exception as e:
+                        logging.error('provision_devices(): register {} exception = {}'.format(dev, str(e)))
+                        stats.failed += 1
+
+    if journal:
+        journal.commit()
+    stats.log_summary(ca_name, not register)
+    return stats
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: rate_limit.py
+
+    Per-API token bucket rate limits for AWS IoT control plane calls.
+
+    install() hooks the limiter into a botocore client's events, so every
+    call through aws_clients.get_client('iot') is paced, retries included:
+        before-send - take a token for the operation
+        needs-retry - a throttling error lowers the operation's rate
+        after-call  - rates recover toward the configured rate while
+                      calls succeed
+
+    Rates come from IOT_API_RATES in config.py and should match the
+    account's quotas, so runs settle at the highest rate that is not
+    throttled.
+'''
+
+import threading
+import time
+import logging
+from config import *
+
+THROTTLE_CODES = ['ThrottlingException', 'Throttling', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'ProvisionedThroughputExceededException']
+
+'''
+    Token bucket for one API. rate is in calls/sec, burst is the bucket size.
+'''
+class TokenBucket():
+    def __init__(self, name, rate, burst=None):
+        self.name = name
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.last_change = self.last
+        self.calls = 0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.calls += 1
+                    return
+                wait_sec = (1 - self.tokens) / self.rate
+            time.sleep(wait_sec)
+
+    '''
+        Multiplicative decrease, at most once per RATE_LIMIT_COOLDOWN so a
+        burst of throttled in-flight calls counts as one signal
+    '''
+    def on_throttle(self):
+        with self.lock:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self.last_change >= RATE_LIMIT_COOLDOWN:
+                self.rate = max(RATE_LIMIT_MIN_RATE, self.rate * RATE_LIMIT_DECREASE)
+                self.tokens = min(self.tokens, 0)
+                self.last_change = now
+                logging.info('rate_limit: {} throttled, rate = {:.1f}/sec'.\
+                    format(self.name, self.rate))
+
+    '''
+        Additive increase back toward the configured rate
+    '''
+    def on_success(self):
+        if self.rate >= self.max_rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_change >= RATE_LIMIT_COOLDOWN:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_LIMIT_INCREASE)
+                self.last_change = now
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+'''
+    Shared bucket for an operation name, e.g. 'RegisterCertificate'
+'''
+def get_bucket(operation_name):
+    bucket = buckets.get(operation_name, None)
+    if not bucket:
+        with buckets_lock:
+            bucket = buckets.get(operation_name, None)
+            if not bucket:
+                bucket = TokenBucket(operation_name,
+                    IOT_API_RATES.get(operation_name, IOT_DEFAULT_RATE))
+                buckets[operation_name] = bucket
+    return bucket
+
+def operation_from_event(event_name):
+    # e.g. before-send.iot.RegisterCertificate
+    return event_name.rsplit('.', 1)[-1]
+
+def on_before_send(event_name, **kwargs):
+    get_bucket(operation_from_event(event_name)).acquire()
+
+def on_needs_retry(event_name, response=None, **kwargs):
+    if response:
+        http_response, parsed = response
+        code = parsed.get('Error', {}).get('Code', '')
+        if code in THROTTLE_CODES or getattr(http_response, 'status_code', 0) == 429:
+            get_bucket(operation_from_event(event_name)).on_throttle()
+    # Never answer the retry question, botocore's retry handler does that
+    return None
+
+def on_after_call(event_name, http_response=None, **kwargs):
+    if http_response is not None and http_response.status_code < 400:
+        get_bucket(operation_from_event(event_name)).on_success()
+
+'''
+    Pace every call made by client. service_id is the event name prefix,
+    e.g. 'iot'.
+'''
+def install(client, service_id='iot'):
+    events = client.meta.events
+    events.register('before-send.{}'.format(service_id), on_before_send)
+    # Ahead of botocore's retry handler, which ends the needs-retry chain
+    events.register_first('needs-retry.{}'.format(service_id), on_needs_retry)
+    events.register('after-call.{}'.format(service_id), on_after_call)
+    return client
+
+def log_stats():
+    for name in sorted(buckets):
+        bucket = buckets[name]
+        logging.info('rate_limit: {} calls = {}, throttles = {}, rate = {:.1f}/{:.1f} per sec'.\
+            format(name, bucket.calls, bucket.throttles, bucket.rate, bucket.max_rate))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: run_journal.py
+
+    SQLite journal of a certs_etc.py --create run, so a run that dies
+    partway can be started again and skip the work already done.
+
+    Per device and CA it records the last completed stage:
+        STAGE_CERT       - key, CSR, and signed cert files
+        STAGE_REGISTERED - cert registered in IoT (cert id kept)
+        STAGE_POLICY     - cert policy attached
+    DynamoDB whitelist rows are recorded per device, and one-off steps
+    (CA registration, secure store, ...) by name.
+
+    Only the main process writes to the journal. Records are buffered and
+    committed in batches, so a crash loses at most the last batch. That is
+    safe because every stage can be repeated: gen_dev_cert() keeps cert
+    files an earlier run wrote, so a device whose record was lost
+    registers the same cert again (ResourceAlreadyExists gives its id)
+    instead of orphaning it with a new one.
+
+    certs_etc.py --delete removes the journal.
+'''
+
+import os
+import time
+import sqlite3
+import logging
+from config import *
+
+STAGE_NONE = 0
+STAGE_CERT = 1
+STAGE_REGISTERED = 2
+STAGE_POLICY = 3
+
+class RunJournal():
+    def __init__(self, filename=run_journal_filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS devices (ca_name TEXT, dev TEXT, '
+            'stage INTEGER, cert_id TEXT, PRIMARY KEY (ca_name, dev))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS ddb_rows (dev TEXT PRIMARY KEY)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS steps (name TEXT PRIMARY KEY)')
+        self.conn.commit()
+        # Records not yet committed
+        self.pending_devices = {}
+        self.pending_ddb_rows = set()
+        self.last_commit = time.monotonic()
+
+    '''
+        (stage, cert_id) of dev for ca_name, (STAGE_NONE, None) if not started
+    '''
+    def get_stage(self, ca_name, dev):
+        pending = self.pending_devices.get((ca_name, dev), None)
+        if pending:
+            return pending
+        row = self.conn.execute('SELECT stage, cert_id FROM devices WHERE ca_name = ? AND dev = ?',
+            (ca_name, dev)).fetchone()
+        return row if row else (STAGE_NONE, None)
+
+    '''
+        Record that dev reached stage. Stages never go backwards.
+    '''
+    def record(self, ca_name, dev, stage, cert_id=None):
+        current_stage, current_cert_id = self.get_stage(ca_name, dev)
+        if stage > current_stage:
+            self.pending_devices[(ca_name, dev)] = (stage, cert_id or current_cert_id)
+            self.maybe_commit()
+
+    def ddb_row_done(self, dev):
+        if dev in self.pending_ddb_rows:
+            return True
+        return self.conn.execute('SELECT 1 FROM ddb_rows WHERE dev = ?', (dev,)).fetchone() is not None
+
+    def record_ddb_rows(self, devs):
+        self.pending_ddb_rows.update(devs)
+        self.maybe_commit()
+
+    def step_done(self, name):
+        return self.conn.execute('SELECT 1 FROM steps WHERE name = ?', (name,)).fetchone() is not None
+
+    '''
+        One-off steps are committed right away
+    '''
+    def record_step(self, name):
+        self.conn.execute('INSERT OR IGNORE INTO steps (name) VALUES (?)', (name,))
+        self.commit()
+
+    def maybe_commit(self):
+        if len(self.pending_devices) + len(self.pending_ddb_rows) >= JOURNAL_COMMIT_RECORDS or \
+                time.monotonic() - self.last_commit >= JOURNAL_COMMIT_SEC:
+            self.commit()
+
+    def commit(self):
+        self.conn.executemany('INSERT OR REPLACE INTO devices (ca_name, dev, stage, cert_id) '
+            'VALUES (?, ?, ?, ?)', [(ca_name, dev, stage, cert_id)
+                for (ca_name, dev), (stage, cert_id) in self.pending_devices.items()])
+        self.conn.executemany('INSERT OR IGNORE INTO ddb_rows (dev) VALUES (?)',
+            [(dev,) for dev in self.pending_ddb_rows])
+        self.conn.commit()
+        self.pending_devices = {}
+        self.pending_ddb_rows = set()
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+'''
+    Remove the journal so the next --create starts from scratch
+'''
+def delete_journal(filename=run_journal_filename):
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+    logging.info('delete_journal(): {} removed'.format(filename))
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: teardown_pipeline.py
+
+    Concurrent device teardown for certs_etc.py --delete.
+
+    Device rows are read once, 100 at a time with BatchGetItem. For each
+    device the Manufacturer and Vendor cert run as separate tasks (detach
+    policies, detach from thing, deactivate, delete); the thing is deleted
+    once both certs are done. A bounded number of devices is in flight.
+
+    Each finished device is written to teardown_manifest_filename as one
+    JSON line. Re-run only the failures with:
+        > python teardown_pipeline.py --retry_failures
+'''
+
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.exceptions import ClientError
+from config import *
+from aws_clients import get_client, get_cert_arn
+from rate_limit import log_stats as log_rate_limit_stats
+from device_dyn_db import batch_read_devices
+from local_json import get_json_array_dicts, iter_device_dicts
+
+'''
+    Counters and timing for the teardown summary
+'''
+class TeardownStats():
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.devices = 0
+        self.certs = 0
+        self.failed = 0
+
+    def log_summary(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.devices / elapsed if elapsed else 0.0
+        logging.info('*********** TEARDOWN SUMMARY ***********')
+        logging.info('devices = {}, certs = {}, failed devices = {}'.\
+            format(self.devices, self.certs, self.failed))
+        logging.info('elapsed = {:.1f} sec, throughput = {:.1f} devices/sec'.\
+            format(elapsed, rate))
+        log_rate_limit_stats()
+        logging.info('*********** END TEARDOWN SUMMARY ***********')
+
+'''
+    Run one IoT call. A resource that is already gone counts as done,
+    so a re-run can repeat every step.
+'''
+def iot_step(operation_name, **kwargs):
+    try:
+        getattr(get_client('iot'), operation_name)(**kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+
+'''
+    Tear down one cert of device dev. Returns the failed steps, [] on success.
+'''
+def teardown_cert(dev, cert_id, policy_names):
+    cert_arn = get_cert_arn(cert_id)
+    steps = [('detach_policy', {'policyName':policy_name, 'target':cert_arn})
+        for policy_name in policy_names]
+    steps += [
+        ('detach_thing_principal', {'thingName':dev, 'principal':cert_arn}),
+        ('update_certificate', {'certificateId':cert_id, 'newStatus':'INACTIVE'}),
+        ('delete_certificate', {'certificateId':cert_id, 'forceDelete':True})
+        ]
+
+    for operation_name, kwargs in steps:
+        try:
+            iot_step(operation_name, **kwargs)
+        except Exception as e:
+            logging.error('teardown_cert(): {} {} {} failed: {}'.\
+                format(dev, cert_id, operation_name, str(e)))
+            # Later steps depend on this one
+            return ['{}:{}'.format(operation_name, cert_id)]
+    return []
+
+'''
+    Delete the thing once its certs are detached
+'''
+def teardown_thing(dev):
+    try:
+        iot_step('delete_thing', thingName=dev)
+    except Exception as e:
+        logging.error('teardown_thing(): {} failed: {}'.format(dev, str(e)))
+        return ['delete_thing']
+    return []
+
+'''
+    Yield (SerialNumber, ManufacturerCertId, VendorCertId, read ok) for
+    device_dicts. Dicts that already carry cert ids (a teardown manifest) are
+    used as is, the rest are read from DynamoDB in batches. read ok is False
+    when the row couldn't be read.
+'''
+def iter_device_certs(device_dicts):
+    batch = []
+
+    def read_batch():
+        items, unread = batch_read_devices([d['SerialNumber'] for d in batch])
+        unread = set(unread)
+        for device_dict in batch:
+            item = items.get(device_dict['SerialNumber'], {})
+            yield device_dict['SerialNumber'], item.get('ManufacturerCertId', None), \
+                item.get('VendorCertId', None), device_dict['SerialNumber'] not in unread
+
+    for device_dict in device_dicts:
+        dev = device_dict.get('SerialNumber', None)
+        if not dev:
+            continue
+        if 'ManufacturerCertId' in device_dict or 'VendorCertId' in device_dict:
+            yield dev, device_dict.get('ManufacturerCertId', None), \
+                device_dict.get('VendorCertId', None), True
+            continue
+        batch.append(device_dict)
+        if len(batch) == DDB_BATCH_GET_SIZE:
+            yield from read_batch()
+            batch = []
+    if batch:
+        yield from read_batch()
+
+'''
+    Tear down every device in device_dicts, detaching each of policy_names
+    from its certs, with at most in_flight devices at once.
+    Returns True when every device was torn down.
+'''
+def teardown_devices(device_dicts, policy_names, in_flight=TEARDOWN_IN_FLIGHT,
+        manifest_filename=teardown_manifest_filename):
+
+    stats = TeardownStats()
+    records = {}    # dev -> manifest record while in flight
+    inflight = {}   # future -> (dev, 'cert' | 'thing')
+    manifest_tmp = '{}.tmp'.format(manifest_filename)
+
+    with ThreadPoolExecutor(max_workers=in_flight * 2) as pool, \
+            open(manifest_tmp, 'w') as manifest:
+
+        def start_thing(dev):
+            inflight[pool.submit(teardown_thing, dev)] = (dev, 'thing')
+
+        def finish(done):
+            for future in done:
+                dev, kind = inflight.pop(future)
+                record = records[dev]
+                record['failed_steps'] += future.result()
+                if kind == 'cert':
+                    record['pending'] -= 1
+                    if record['pending'] == 0:
+                        start_thing(dev)
+                    continue
+                del records[dev]
+                del record['pending']
+                record['ok'] = not record['failed_steps']
+                manifest.write(json.dumps(record) + '\n')
+                stats.devices += 1
+                stats.failed += not record['ok']
+
+        for dev, man_cert_id, vendor_cert_id, read_ok in iter_device_certs(device_dicts):
+            if not read_ok:
+                # No cert id keys, so --retry_failures reads the row again
+                manifest.write(json.dumps({'SerialNumber':dev,
+                    'failed_steps':['batch_get_item'], 'ok':False}) + '\n')
+                stats.devices += 1
+                stats.failed += 1
+                continue
+            while len(records) >= in_flight:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                finish(done)
+            if dev in records:
+                continue
+
+            cert_ids = [cert_id for cert_id in [man_cert_id, vendor_cert_id] if cert_id]
+            records[dev] = {'SerialNumber':dev, 'ManufacturerCertId':man_cert_id,
+                'VendorCertId':vendor_cert_id, 'failed_steps':[], 'pending':len(cert_ids)}
+            for cert_id in cert_ids:
+                inflight[pool.submit(teardown_cert, dev, cert_id, policy_names)] = (dev, 'cert')
+                stats.certs += 1
+            if not cert_ids:
+                start_thing(dev)
+
+        while inflight:
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            finish(done)
+
+    os.replace(manifest_tmp, manifest_filename)
+    stats.log_summary()
+    logging.info('teardown_devices(): manifest = {}'.format(manifest_filename))
+    return stats.failed == 0
+
+'''
+    Devices that failed in a previous teardown manifest
+'''
+def iter_failed_devices(manifest_filename=teardown_manifest_filename):
+    for record in iter_device_dicts(manifest_filename):
+        if not record.get('ok', False):
+            yield record
+
+'''
+    Policy names of the CAs in ca_list_filename
+'''
+def get_policy_names():
+    policy_names = []
+    for ca_dict in get_json_array_dicts(ca_list_filename):
+        policy_name = ca_dict.get('policy_name', None)
+        if policy_name and policy_name not in policy_names:
+            policy_names.append(policy_name)
+    return policy_names
+
+def main():
+    argp = argparse.ArgumentParser(description='Concurrent device teardown')
+    argp.add_argument('--retry_failures', action='store_true', help='--retry_failures only devices that failed in the last manifest')
+    argp.add_argument('--in_flight', type=int, default=TEARDOWN_IN_FLIGHT, help='--in_flight devices torn down at once')
+    args = argp.parse_args()
+
+    if args.retry_failures:
+        # The manifest is only replaced when the run finishes
+        device_dicts = iter_failed_devices()
+    else:
+        device_dicts = iter_device_dicts(device_list_filename)
+
+    teardown_devices(device_dicts, get_policy_names(), args.in_flight)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_cert_engine.py
+
+    In-process CA and device cert generation, checked against the openssl
+    command line path when openssl is installed
+'''
+import os
+import shutil
+import stat
+import pytest
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+import cert_engine
+from cert_auth import gen_dev_cert_openssl
+from config import data_dir
+
+SUBJ_STR = '/C=US/ST=Kansas/L=Kansas City/O=Test/OU=Test/CN={}'
+
+def read_cert(filename):
+    return cert_engine.load_cert(filename)
+
+def test_subj_str_to_name():
+    name = cert_engine.subj_str_to_name('/C=US/O=A=B/CN=dev1')
+
+    assert name.get_attributes_for_oid(NameOID.COUNTRY_NAME)[0].value == 'US'
+    assert name.get_attributes_for_oid(NameOID.ORGANIZATION_NAME)[0].value == 'A=B'
+    assert name.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value == 'dev1'
+
+@pytest.mark.parametrize('key_type, key_class', [('rsa', rsa.RSAPrivateKey),
+    ('ec', ec.EllipticCurvePrivateKey)])
+def test_new_ca_files(work_dir, key_type, key_class):
+    cert_engine.new_ca_files('Ca', SUBJ_STR.format('Ca'), 30, key_type=key_type)
+
+    key_filename = '{}Ca_rootCA.key'.format(data_dir)
+    assert stat.S_IMODE(os.stat(key_filename).st_mode) == 0o600
+    assert isinstance(cert_engine.load_private_key(key_filename), key_class)
+    cert = read_cert('{}Ca_rootCA.pem'.format(data_dir))
+    assert cert.subject == cert.issuer
+    assert cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+    cert.verify_directly_issued_by(cert)
+
+def test_new_dev_files_signed_by_ca(test_ca):
+    engine = cert_engine.get_engine(test_ca)
+    engine.new_dev_files('dev1_ven', SUBJ_STR.format('dev1'), 30, key_type='ec')
+    engine.new_dev_files('dev2_ven', SUBJ_STR.format('dev2'), 30, key_type='ec')
+
+    ca_cert = read_cert('{}{}_rootCA.pem'.format(data_dir, test_ca))
+    certs = [read_cert('{}dev{}_ven.pem'.format(data_dir, i)) for i in [1, 2]]
+    for i, cert in enumerate(certs, 1):
+        cert.verify_directly_issued_by(ca_cert)
+        assert cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value == 'dev{}'.format(i)
+    assert certs[0].serial_number != certs[1].serial_number
+    assert stat.S_IMODE(os.stat('{}dev1_ven.key'.format(data_dir)).st_mode) == 0o600
+    with open('{}dev1_ven.csr'.format(data_dir), 'rb') as f:
+        assert x509.load_pem_x509_csr(f.read()).is_signature_valid
+
+def test_new_dev_files_existing_key(test_ca):
+    key = cert_engine.gen_private_key('ec')
+    key_filename = '{}dev1_ven.key'.format(data_dir)
+    cert_engine.write_private_file(key_filename, cert_engine.private_key_pem(key))
+
+    cert = cert_engine.get_engine(test_ca).new_dev_files('dev1_ven', SUBJ_STR.format('dev1'), 30,
+        existing_key=True)
+
+    assert cert.public_key().public_numbers() == key.public_key().public_numbers()
+
+def test_new_ca_replaces_loaded_engine(test_ca):
+    engine = cert_engine.get_engine(test_ca)
+    assert cert_engine.get_engine(test_ca) is engine
+
+    cert_engine.new_ca_files(test_ca, SUBJ_STR.format(test_ca), 30, key_type='ec')
+
+    assert cert_engine.get_engine(test_ca) is not engine
+
+def test_cert_pem_id_matches_der_sha256(test_ca):
+    cert = cert_engine.get_engine(test_ca).new_dev_files('dev1_ven', SUBJ_STR.format('dev1'), 30,
+        key_type='ec')
+    with open('{}dev1_ven.pem'.format(data_dir), 'r') as f:
+        cert_pem = f.read()
+
+    assert cert_engine.cert_pem_id(cert_pem) == cert.fingerprint(cert_engine.hashes.SHA256()).hex()
+
+@pytest.mark.skipif(not shutil.which('openssl'), reason='no openssl command')
+def test_openssl_path_signs_with_same_ca(test_ca):
+    gen_dev_cert_openssl(test_ca, 'dev1_ven', SUBJ_STR.format('dev1'), 30, key_type='ec',
+        stdout_filename='openssl.out', stderr_filename='openssl.err')
+    gen_dev_cert_openssl(test_ca, 'dev2_ven', SUBJ_STR.format('dev2'), 30, key_type='ec',
+        stdout_filename='openssl.out', stderr_filename='openssl.err')
+
+    ca_cert = read_cert('{}{}_rootCA.pem'.format(data_dir, test_ca))
+    certs = [read_cert('{}dev{}_ven.pem'.format(data_dir, i)) for i in [1, 2]]
+    for cert in certs:
+        cert.verify_directly_issued_by(ca_cert)
+    assert certs[0].serial_number != certs[1].serial_number
+    # No serial file to race on
+    assert not os.path.exists('{}{}_rootCA.srl'.format(data_dir, test_ca))
+    assert not os.path.exists('{}open_ssl_stdout.txt'.format(data_dir))
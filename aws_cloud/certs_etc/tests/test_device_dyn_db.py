@@ -0,0 +1,169 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_device_dyn_db.py
+
+    Whitelist batch writes against a stubbed DynamoDB resource: adaptive
+    write rate, UnprocessedItems, throttling, and journal resume
+'''
+import json
+import threading
+import time
+import pytest
+from botocore.exceptions import ClientError
+import device_dyn_db
+from device_dyn_db import WriteRateController, write_batch, gen_write_batches, put_request
+from run_journal import RunJournal
+from config import *
+
+'''
+    batch_write_item returns the queued responses in order, then succeeds.
+    A queued exception is raised instead of returned. Batches with a serial
+    number in fail_serial_numbers always raise a ValidationException.
+'''
+class FakeResource():
+    def __init__(self, *responses, fail_serial_numbers=()):
+        self.responses = list(responses)
+        self.fail_serial_numbers = set(fail_serial_numbers)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity):
+        requests = RequestItems[DDB_NAME]
+        with self.lock:
+            self.calls.append(requests)
+            if self.fail_serial_numbers & set(request_serial_numbers(requests)):
+                raise client_error('ValidationException')
+            response = self.responses.pop(0) if self.responses else None
+        if isinstance(response, Exception):
+            raise response
+        return response or {'ConsumedCapacity': [{'CapacityUnits': len(requests)}]}
+
+def request_serial_numbers(batch):
+    return [device_dyn_db.request_serial_number(r) for r in batch]
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'BatchWriteItem')
+
+def requests(*serial_numbers):
+    return [put_request({'SerialNumber':sn, 'CrState':'whitelisted'}) for sn in serial_numbers]
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(device_dyn_db.random, 'uniform', lambda a, b: 0)
+
+def test_rate_halves_on_throttle_down_to_the_minimum():
+    controller = WriteRateController(8)
+
+    controller.on_result(1, 1, True)
+    assert controller.rate == 4
+    for i in range(10):
+        controller.on_result(1, 1, True)
+    assert controller.rate == DDB_MIN_WRITE_RATE
+
+def test_rate_grows_by_elapsed_time_up_to_the_maximum():
+    controller = WriteRateController(100, max_rate=400)
+
+    controller.last_adjust = time.monotonic() - 1.0
+    controller.on_result(1, 1, False)
+    assert 100 + DDB_WRITE_RATE_INCREASE <= controller.rate < 100 + 2 * DDB_WRITE_RATE_INCREASE
+    # Back to back results add almost nothing, however many threads report
+    rate = controller.rate
+    for i in range(100):
+        controller.on_result(1, 1, False)
+    assert controller.rate < rate + DDB_WRITE_RATE_INCREASE
+
+    controller.last_adjust = time.monotonic() - 60.0
+    controller.on_result(1, 1, False)
+    assert controller.rate == 400
+
+def test_consumed_units_settle_the_estimate():
+    controller = WriteRateController(100)
+    controller.acquire(10)
+    tokens = controller.tokens
+
+    controller.on_result(10, 25, False)
+
+    assert controller.tokens == pytest.approx(tokens - 15, abs=1)
+
+def test_write_batch_resubmits_unprocessed_items():
+    batch = requests('SN1', 'SN2', 'SN3')
+    resource = FakeResource({'UnprocessedItems': {DDB_NAME: batch[1:]},
+        'ConsumedCapacity': [{'CapacityUnits': 1}]})
+    controller = WriteRateController(1000)
+
+    assert write_batch(resource, batch, controller) == []
+    assert resource.calls == [batch, batch[1:]]
+    assert controller.rate == pytest.approx(500, abs=1)
+
+def test_write_batch_retries_throttle_errors():
+    batch = requests('SN1')
+    resource = FakeResource(client_error('ProvisionedThroughputExceededException'))
+
+    assert write_batch(resource, batch, WriteRateController(1000)) == []
+    assert len(resource.calls) == 2
+
+def test_write_batch_raises_other_errors():
+    resource = FakeResource(client_error('ValidationException'))
+
+    with pytest.raises(ClientError):
+        write_batch(resource, requests('SN1'), WriteRateController(1000))
+
+def test_write_batch_returns_what_was_never_processed():
+    batch = requests('SN1', 'SN2')
+    resource = FakeResource(*[{'UnprocessedItems': {DDB_NAME: batch[1:]}}] * DDB_BATCH_MAX_ATTEMPTS)
+
+    assert write_batch(resource, batch, WriteRateController(DDB_ON_DEMAND_START_RATE)) == batch[1:]
+    assert len(resource.calls) == DDB_BATCH_MAX_ATTEMPTS
+
+def test_gen_write_batches_dedupes_serial_numbers_in_a_batch():
+    device_dicts = [{'SerialNumber':'SN{}'.format(i % 30)} for i in range(60)] + [{'CrState':'x'}]
+
+    batches = list(gen_write_batches(device_dicts, put_request))
+
+    assert [len(batch) for batch in batches] == [DDB_BATCH_SIZE, DDB_BATCH_SIZE, 10]
+    for batch in batches:
+        serial_numbers = [r['PutRequest']['Item']['SerialNumber'] for r in batch]
+        assert len(set(serial_numbers)) == len(serial_numbers)
+
+def test_load_skips_rows_journaled_by_an_earlier_run(work_dir, monkeypatch):
+    with open('{}devices.json'.format(data_dir), 'w') as f:
+        json.dump([{'SerialNumber':'SN{}'.format(i), 'CrState':'whitelisted'} for i in range(30)], f)
+    resource = FakeResource(fail_serial_numbers=['SN29'])
+    monkeypatch.setattr(device_dyn_db, 'device_list_filename', '{}devices.json'.format(data_dir))
+    monkeypatch.setattr(device_dyn_db, 'get_table', lambda: None)
+    monkeypatch.setattr(device_dyn_db, 'get_resource', lambda service_name: resource)
+    monkeypatch.setattr(device_dyn_db, 'get_start_write_rate', lambda ddb_table: 1000)
+    journal = RunJournal('{}journal.sqlite3'.format(data_dir))
+
+    device_dyn_db.load_devices_into_dyn_db(journal)
+
+    # The SN25..SN29 batch failed with a non-throttle error
+    assert not journal.ddb_row_done('SN25')
+    assert all(journal.ddb_row_done('SN{}'.format(i)) for i in range(25))
+    journal.close()
+
+    resource = FakeResource()
+    journal = RunJournal('{}journal.sqlite3'.format(data_dir))
+    device_dyn_db.load_devices_into_dyn_db(journal)
+
+    assert [request_serial_numbers(batch) for batch in resource.calls] == \
+        [['SN{}'.format(i) for i in range(25, 30)]]
+    assert all(journal.ddb_row_done('SN{}'.format(i)) for i in range(30))
+    journal.close()
@@ -0,0 +1,119 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_key_reservoir.py
+
+    Pre-generated key pool: add, claim, fill watermarks, and tmp/ cleanup
+'''
+import os
+import stat
+import key_reservoir
+from key_reservoir import KeyReservoir
+from cert_engine import gen_private_key, private_key_pem, load_private_key
+from config import data_dir
+
+def new_reservoir(low=1, high=3):
+    reservoir = KeyReservoir('ec', '{}key_pool'.format(data_dir), low=low, high=high)
+    reservoir.make_dirs()
+    return reservoir
+
+def test_add_then_claim_moves_the_key(work_dir):
+    reservoir = new_reservoir()
+    key_pem = private_key_pem(gen_private_key('ec'))
+    reservoir.add(key_pem)
+    key_filename = '{}dev1.key'.format(data_dir)
+
+    assert reservoir.claim(key_filename)
+
+    with open(key_filename, 'rb') as f:
+        assert f.read() == key_pem
+    assert stat.S_IMODE(os.stat(key_filename).st_mode) == 0o600
+    assert reservoir.count() == 0
+    assert os.listdir(reservoir.tmp_dir) == []
+
+def test_claim_takes_oldest_first_and_fails_when_empty(work_dir):
+    reservoir = new_reservoir()
+    pems = [private_key_pem(gen_private_key('ec')) for i in range(2)]
+    for pem in pems:
+        reservoir.add(pem)
+
+    claimed = []
+    for i in range(2):
+        assert reservoir.claim('{}dev{}.key'.format(data_dir, i))
+        with open('{}dev{}.key'.format(data_dir, i), 'rb') as f:
+            claimed.append(f.read())
+
+    assert claimed == pems
+    assert not reservoir.claim('{}dev2.key'.format(data_dir))
+
+def test_claim_skips_keys_taken_by_another_process(work_dir):
+    reservoir = new_reservoir()
+    for i in range(2):
+        reservoir.add(private_key_pem(gen_private_key('ec')))
+    reservoir.candidates = list(reversed(reservoir.list_ready()))
+    # Another process claims the oldest key first
+    os.remove(os.path.join(reservoir.ready_dir, reservoir.candidates[-1]))
+
+    assert reservoir.claim('{}dev1.key'.format(data_dir))
+    assert reservoir.count() == 0
+
+def test_fill_to_high_watermark_only_at_or_below_low(work_dir):
+    reservoir = new_reservoir(low=1, high=3)
+
+    assert reservoir.fill(workers=1) == 3
+    assert reservoir.count() == 3
+    load_private_key(os.path.join(reservoir.ready_dir, reservoir.list_ready()[0]))
+    # Above the low watermark
+    assert reservoir.fill(workers=1) == 0
+
+    for i in range(2):
+        reservoir.claim('{}dev{}.key'.format(data_dir, i))
+    assert reservoir.fill(workers=1) == 2
+    assert reservoir.count() == 3
+
+def test_stats_report_the_configured_watermarks(work_dir):
+    reservoir = new_reservoir(low=5, high=7)
+    reservoir.add(private_key_pem(gen_private_key('ec')))
+
+    stats = reservoir.stats()
+
+    assert (stats['ready'], stats['low_watermark'], stats['high_watermark']) == (1, 5, 7)
+    assert stats['below_low_watermark']
+    assert stats['key_type'] == 'ec'
+
+def test_clean_tmp_removes_keys_of_stopped_fillers(work_dir, monkeypatch):
+    reservoir = new_reservoir()
+    names = ['00000000000000000001-{}-0.key'.format(os.getpid()),
+        '00000000000000000002-99999999-0.key', 'garbage.key']
+    for name in names:
+        with open(os.path.join(reservoir.tmp_dir, name), 'w') as f:
+            f.write('partial')
+    monkeypatch.setattr(key_reservoir, 'pid_running', lambda pid: pid == os.getpid())
+
+    assert reservoir.clean_tmp() == 2
+    assert os.listdir(reservoir.tmp_dir) == [names[0]]
+
+def test_pid_running():
+    assert key_reservoir.pid_running(os.getpid())
+
+def test_claim_key_disabled(work_dir, monkeypatch):
+    monkeypatch.setattr(key_reservoir, 'use_key_pool', False)
+
+    assert not key_reservoir.claim_key('{}dev1.key'.format(data_dir), 'ec')
+    assert key_reservoir.reservoirs == {}
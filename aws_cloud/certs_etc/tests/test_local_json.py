@@ -0,0 +1,83 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_local_json.py
+
+    Streaming device list parsing, with chunks small enough to split every
+    token across a read
+'''
+import io
+import json
+import pytest
+from local_json import iter_json_array, iter_device_dicts
+
+DEVICES = [
+    {'SerialNumber': 'SN1', 'CrState': 'whitelisted'},
+    {'SerialNumber': 'S,N]2', 'Note': 'has [brackets], {braces} and \\"quotes\\"'},
+    {'SerialNumber': 'SN3', 'Count': 12345, 'Ratio': -1.25e-3, 'Tags': [1, [2, 3], {}]},
+    {'SerialNumber': 'SN4', 'Active': True, 'Parent': None, 'Name': 'café'}
+    ]
+
+def parse(text, chunk_size):
+    return list(iter_json_array(io.StringIO(text), chunk_size))
+
+@pytest.mark.parametrize('chunk_size', range(1, 8))
+def test_chunk_boundaries(chunk_size):
+    assert parse(json.dumps(DEVICES), chunk_size) == DEVICES
+    assert parse(json.dumps(DEVICES, indent=4), chunk_size) == DEVICES
+
+@pytest.mark.parametrize('chunk_size', range(1, 8))
+def test_numbers_split_at_the_boundary(chunk_size):
+    values = [1, 12, 123456789, 1.5, -0.25, 1e10, 2.5E-7, 0, -7]
+
+    assert parse(json.dumps(values), chunk_size) == values
+    assert parse('[123456789]', 3) == [123456789]
+
+@pytest.mark.parametrize('text', ['[]', '  [ ]  ', '\n[\n]\n'])
+def test_empty_array(text):
+    assert parse(text, 1) == []
+
+@pytest.mark.parametrize('text', ['', '{"SerialNumber": "SN1"}', '[{"a": 1} {"b": 2}]',
+    '[{"a": 1},', '[{"a": 1', '[{"a": tru}]', '[1,,2]'])
+def test_malformed_input_raises(text):
+    for chunk_size in [1, 3, 64]:
+        with pytest.raises(ValueError):
+            parse(text, chunk_size)
+
+def test_elements_are_yielded_before_the_end_is_read():
+    elements = iter_json_array(io.StringIO('[{"a": 1}, {"b": 2}, garbage'), 4)
+
+    assert next(elements) == {'a': 1}
+    assert next(elements) == {'b': 2}
+    with pytest.raises(ValueError):
+        next(elements)
+
+def test_device_list_formats(work_dir):
+    with open('devices.json', 'w') as f:
+        json.dump(DEVICES, f)
+    with open('devices.jsonl', 'w') as f:
+        f.write('\n'.join(json.dumps(d) for d in DEVICES) + '\n\n')
+    with open('devices.csv', 'w') as f:
+        f.write('SerialNumber,CrState\r\nSN1, whitelisted\r\nSN2,\r\n')
+
+    assert list(iter_device_dicts('devices.json', chunk_size=5)) == DEVICES
+    assert list(iter_device_dicts('devices.jsonl')) == DEVICES
+    assert list(iter_device_dicts('devices.csv')) == [
+        {'SerialNumber': 'SN1', 'CrState': 'whitelisted'}, {'SerialNumber': 'SN2'}]
+    assert list(iter_device_dicts('missing.json')) == []
@@ -0,0 +1,159 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_provision_pipeline.py
+
+    Two stage provisioning with a stubbed IoT client: journal resume,
+    cert file reuse, and registration failures
+'''
+import os
+import threading
+import pytest
+from botocore.exceptions import ClientError
+import aws_clients
+import cert_auth
+import cert_engine
+import provision_pipeline
+from run_journal import RunJournal, STAGE_CERT, STAGE_REGISTERED, STAGE_POLICY
+from config import data_dir
+
+SUBJ_STR = '/C=US/ST=Kansas/L=Kansas City/O=Test/OU=Test/CN={}'
+POLICY = 'test-policy'
+
+'''
+    Just enough of the IoT client for register_dev_cert and attach_cert_policy.
+    Stage 2 runs in threads of the test process, so calls are seen here.
+'''
+class FakeIot():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.registered = {}
+        self.register_calls = 0
+        self.attached = []
+        # attach_policy calls left to fail
+        self.attach_failures = 0
+
+    def register_certificate(self, certificatePem, caCertificatePem, setAsActive):
+        cert_id = cert_engine.cert_pem_id(certificatePem)
+        with self.lock:
+            self.register_calls += 1
+            if cert_id in self.registered:
+                raise ClientError({'Error': {'Code': 'ResourceAlreadyExistsException',
+                    'Message': 'exists'}}, 'RegisterCertificate')
+            self.registered[cert_id] = certificatePem
+        return {'certificateId': cert_id}
+
+    def attach_policy(self, policyName, target):
+        with self.lock:
+            fail = self.attach_failures > 0
+            self.attach_failures -= fail
+        if fail:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}},
+                'AttachPolicy')
+        with self.lock:
+            self.attached.append((policyName, target))
+
+@pytest.fixture
+def iot(test_ca, monkeypatch):
+    fake = FakeIot()
+    monkeypatch.setitem(aws_clients.clients, 'iot', fake)
+    monkeypatch.setattr(cert_auth, 'get_cert_arn', lambda cert_id: cert_id)
+    return fake
+
+@pytest.fixture
+def journal(work_dir):
+    journal = RunJournal('{}journal.sqlite3'.format(data_dir))
+    yield journal
+    journal.close()
+
+def devices(count):
+    return [{'SerialNumber': 'SN{}'.format(i)} for i in range(count)]
+
+def provision(ca_name, device_dicts, journal, jitp=False):
+    return provision_pipeline.provision_devices(ca_name, device_dicts, SUBJ_STR, 30, POLICY,
+        workers=1, io_workers=2, jitp=jitp, key_type='ec', journal=journal)
+
+def test_jitp_certs_journaled_and_skipped_on_rerun(test_ca, journal):
+    stats = provision(test_ca, devices(3) + [{'CrState': 'no serial number'}], journal, jitp=True)
+
+    assert (stats.submitted, stats.certs, stats.skipped, stats.failed) == (3, 3, 0, 0)
+    for i in range(3):
+        assert os.path.exists('{}SN{}_ven.pem'.format(data_dir, i))
+        assert journal.get_stage(test_ca, 'SN{}'.format(i)) == (STAGE_CERT, None)
+
+    stats = provision(test_ca, devices(3), journal, jitp=True)
+
+    assert (stats.submitted, stats.certs, stats.skipped) == (3, 0, 3)
+
+def test_register_and_attach(iot, journal):
+    stats = provision('Test', devices(2), journal)
+
+    assert (stats.certs, stats.registered, stats.failed) == (2, 2, 0)
+    assert len(iot.registered) == 2
+    assert sorted(target for policy, target in iot.attached) == sorted(iot.registered)
+    stage, cert_id = journal.get_stage('Test', 'SN0')
+    assert stage == STAGE_POLICY and cert_id in iot.registered
+
+def test_failed_attach_resumes_without_registering_again(iot, journal):
+    iot.attach_failures = 1
+
+    stats = provision('Test', devices(1), journal)
+
+    assert (stats.registered, stats.failed) == (0, 1)
+    stage, cert_id = journal.get_stage('Test', 'SN0')
+    assert stage == STAGE_REGISTERED and cert_id in iot.registered
+    mtime = os.path.getmtime('{}SN0_ven.pem'.format(data_dir))
+
+    stats = provision('Test', devices(1), journal)
+
+    assert (stats.certs, stats.registered, stats.failed) == (0, 1, 0)
+    assert iot.register_calls == 1
+    assert iot.attached == [(POLICY, cert_id)]
+    assert journal.get_stage('Test', 'SN0') == (STAGE_POLICY, cert_id)
+    assert os.path.getmtime('{}SN0_ven.pem'.format(data_dir)) == mtime
+
+def test_lost_journal_reuses_cert_files_and_registration(iot, work_dir):
+    first = RunJournal('{}first.sqlite3'.format(data_dir))
+    provision('Test', devices(1), first)
+    first.close()
+    with open('{}SN0_ven.pem'.format(data_dir), 'r') as f:
+        cert_pem = f.read()
+
+    # A run that crashed before its journal commit starts from nothing
+    second = RunJournal('{}second.sqlite3'.format(data_dir))
+    stats = provision('Test', devices(1), second)
+    second.close()
+
+    assert (stats.certs, stats.registered, stats.failed) == (1, 1, 0)
+    with open('{}SN0_ven.pem'.format(data_dir), 'r') as f:
+        assert f.read() == cert_pem
+    # The second register call hit ResourceAlreadyExists and kept the cert id
+    assert iot.register_calls == 2
+    assert len(iot.registered) == 1
+
+def test_register_error_is_counted_failed(iot, journal, monkeypatch):
+    def register_certificate(**kwargs):
+        raise ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'no'}},
+            'RegisterCertificate')
+    monkeypatch.setattr(iot, 'register_certificate', register_certificate)
+
+    stats = provision('Test', devices(1), journal)
+
+    assert (stats.certs, stats.registered, stats.failed) == (1, 0, 1)
+    assert journal.get_stage('Test', 'SN0') == (STAGE_CERT, None)
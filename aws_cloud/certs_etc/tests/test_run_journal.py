@@ -0,0 +1,152 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_run_journal.py
+
+    Run journal stages and commits, and reuse of device cert files left
+    by an interrupted run
+'''
+import os
+import time
+import pytest
+import cert_auth
+import cert_engine
+import run_journal
+from run_journal import RunJournal, delete_journal, STAGE_NONE, STAGE_CERT, STAGE_REGISTERED, \
+    STAGE_POLICY
+from config import data_dir
+
+SUBJ_STR = '/C=US/ST=Kansas/L=Kansas City/O=Test/OU=Test/CN={}'
+
+@pytest.fixture
+def filename(work_dir):
+    return '{}journal.sqlite3'.format(data_dir)
+
+def test_stages_never_go_backwards(filename):
+    journal = RunJournal(filename)
+    assert journal.get_stage('Test', 'SN1') == (STAGE_NONE, None)
+
+    journal.record('Test', 'SN1', STAGE_CERT)
+    journal.record('Test', 'SN1', STAGE_REGISTERED, 'c1')
+    # The cert id is kept when a later stage doesn't pass one
+    journal.record('Test', 'SN1', STAGE_POLICY)
+    journal.record('Test', 'SN1', STAGE_CERT, 'c2')
+
+    assert journal.get_stage('Test', 'SN1') == (STAGE_POLICY, 'c1')
+    journal.commit()
+    assert journal.get_stage('Test', 'SN1') == (STAGE_POLICY, 'c1')
+    assert journal.get_stage('Other', 'SN1') == (STAGE_NONE, None)
+    journal.close()
+
+def test_committed_records_survive_a_reopen(filename):
+    journal = RunJournal(filename)
+    journal.record('Test', 'SN1', STAGE_REGISTERED, 'c1')
+    journal.record_ddb_rows(['SN1', 'SN2'])
+    journal.record_step('ca:Test')
+    journal.close()
+
+    journal = RunJournal(filename)
+
+    assert journal.get_stage('Test', 'SN1') == (STAGE_REGISTERED, 'c1')
+    assert journal.ddb_row_done('SN2') and not journal.ddb_row_done('SN3')
+    assert journal.step_done('ca:Test') and not journal.step_done('ca:Other')
+    journal.close()
+
+def test_uncommitted_records_are_lost(filename, monkeypatch):
+    monkeypatch.setattr(run_journal, 'JOURNAL_COMMIT_SEC', 3600)
+    journal = RunJournal(filename)
+    journal.record('Test', 'SN1', STAGE_CERT)
+    journal.record_ddb_rows(['SN1'])
+    assert journal.ddb_row_done('SN1')
+
+    # A crash before the commit: the device is started again from scratch
+    journal.conn.close()
+    journal = RunJournal(filename)
+
+    assert journal.get_stage('Test', 'SN1') == (STAGE_NONE, None)
+    assert not journal.ddb_row_done('SN1')
+    journal.close()
+
+def test_commit_by_record_count_and_age(filename, monkeypatch):
+    monkeypatch.setattr(run_journal, 'JOURNAL_COMMIT_SEC', 3600)
+    monkeypatch.setattr(run_journal, 'JOURNAL_COMMIT_RECORDS', 3)
+    journal = RunJournal(filename)
+
+    journal.record('Test', 'SN1', STAGE_CERT)
+    journal.record('Test', 'SN2', STAGE_CERT)
+    assert journal.pending_devices
+    journal.record_ddb_rows(['SN1'])
+    assert not journal.pending_devices and not journal.pending_ddb_rows
+
+    journal.last_commit = time.monotonic() - 3600
+    journal.record('Test', 'SN3', STAGE_CERT)
+    assert not journal.pending_devices
+    journal.close()
+
+def test_delete_journal(filename):
+    RunJournal(filename).close()
+
+    delete_journal(filename)
+
+    assert not [name for name in os.listdir(data_dir) if name.startswith('journal')]
+    # Nothing to remove is not an error
+    delete_journal(filename)
+
+def dev_files(ca_name, dev):
+    return ['{}{}.{}'.format(data_dir, cert_auth.dev_file_prefix(ca_name, dev), ext)
+        for ext in ['key', 'pem']]
+
+def test_dev_cert_files_done(test_ca):
+    dev = cert_auth.dev_file_prefix(test_ca, 'SN1')
+    assert not cert_auth.dev_cert_files_done(test_ca, dev)
+
+    cert_engine.get_engine(test_ca).new_dev_files(dev, SUBJ_STR.format('SN1'), 30, key_type='ec')
+    assert cert_auth.dev_cert_files_done(test_ca, dev)
+
+    key_filename, cert_filename = dev_files(test_ca, 'SN1')
+    with open(cert_filename, 'w') as f:
+        f.write('-----BEGIN CERTIFICATE-----\ntruncated')
+    assert not cert_auth.dev_cert_files_done(test_ca, dev)
+
+def test_dev_cert_files_older_than_the_ca_are_not_reused(test_ca):
+    dev = cert_auth.dev_file_prefix(test_ca, 'SN1')
+    cert_engine.get_engine(test_ca).new_dev_files(dev, SUBJ_STR.format('SN1'), 30, key_type='ec')
+    key_filename, cert_filename = dev_files(test_ca, 'SN1')
+    ca_mtime = os.path.getmtime('{}{}_rootCA.pem'.format(data_dir, test_ca))
+    os.utime(cert_filename, (ca_mtime - 10, ca_mtime - 10))
+
+    assert not cert_auth.dev_cert_files_done(test_ca, dev)
+
+def test_gen_dev_cert_reuses_files(test_ca):
+    cert_auth.gen_dev_cert(test_ca, 'SN1', SUBJ_STR, 30, key_type='ec')
+    key_filename, cert_filename = dev_files(test_ca, 'SN1')
+    with open(cert_filename, 'r') as f:
+        cert_pem = f.read()
+
+    cert_auth.gen_dev_cert(test_ca, 'SN1', SUBJ_STR, 30, key_type='ec')
+
+    with open(cert_filename, 'r') as f:
+        assert f.read() == cert_pem
+
+    # An empty key file from a crash mid-write is replaced
+    open(key_filename, 'w').close()
+    cert_auth.gen_dev_cert(test_ca, 'SN1', SUBJ_STR, 30, key_type='ec')
+    assert os.path.getsize(key_filename)
+    with open(cert_filename, 'r') as f:
+        assert f.read() != cert_pem
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+
+'''
+    filename: bench_cold_start.py
+
+    Cold start benchmark for cert_rotation_lambda. Each run starts a fresh
+    interpreter, the way a new lambda container does, and measures:
+        import    - importing the handler module, which with CR_PREWARM
+                    (--prewarm) also imports boto3 and creates the clients
+        first     - the first invocation, including any boto3 import and
+                    client creation left to it
+        warm      - a second, identical invocation
+    and which heavy packages are loaded after each step.
+
+    AWS isn't called: a botocore 'before-call' hook answers every API call
+    with a canned response, so the times are the lambda's own code.
+
+    Usage:
+        > python bench_cold_start.py --runs 10
+        > python bench_cold_start.py --runs 10 --prewarm
+        > python bench_cold_start.py --scenario ack --handler sqs_handler.sqs_cert_rotation_lambda
+
+    Run it with the lambda runtime's Python version (python3.6), and with
+    cert_rotation_lambda/package on PYTHONPATH to time the shipped pyOpenSSL.
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+lambda_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cert_rotation_lambda')
+heavy_modules = ['boto3', 'botocore', 'OpenSSL', 'cryptography']
+scenarios = ['ack', 're-ack', 'create']
+
+serial_number = 'BenchDevice0001'
+ca_cert_id = 'a' * 64
+vendor_cert_id = 'b' * 64
+man_cert_id = 'c' * 64
+
+'''
+    Device row, as DynamoDB returns it, for each scenario
+'''
+def get_row(scenario):
+    row = {
+        'SerialNumber': {'S': serial_number},
+        'ManufacturerCaCertId': {'S': ca_cert_id},
+        'VendorCertId': {'S': vendor_cert_id}
+        }
+    if scenario == 'create':
+        row['CrState'] = {'S': 'CR_THING_CREATED'}
+    else:
+        row['ManufacturerCertId'] = {'S': man_cert_id}
+        row['CrState'] = {'S': 'CR_MAN_CERT_CREATED' if scenario == 'ack'
+            else 'CR_CERT_ROTATION_COMPLETED'}
+    return row
+
+def get_event(scenario, csr_pem):
+    if scenario == 'create':
+        return {'topic': '/cert-rotation/create-man-cert/{}/rqst'.format(serial_number),
+            'data': {'csr': csr_pem}}
+    return {'topic': '/cert-rotation/ack-man-cert/{}/rqst'.format(serial_number),
+        'data': {'cert_id': man_cert_id}}
+
+'''
+    Throwaway Manufacturer CA and device CSR for the create scenario,
+    made in the parent so the child's timings don't include them
+'''
+def gen_test_pems():
+    from OpenSSL import crypto
+    ca_key = crypto.PKey()
+    ca_key.generate_key(crypto.TYPE_RSA, 2048)
+    ca = crypto.X509()
+    ca.get_subject().CN = 'BenchManCA'
+    ca.set_issuer(ca.get_subject())
+    ca.set_pubkey(ca_key)
+    ca.gmtime_adj_notBefore(0)
+    ca.gmtime_adj_notAfter(24 * 60 * 60)
+    ca.sign(ca_key, 'sha256')
+
+    dev_key = crypto.PKey()
+    dev_key.generate_key(crypto.TYPE_RSA, 2048)
+    csr = crypto.X509Req()
+    csr.get_subject().CN = serial_number
+    csr.set_pubkey(dev_key)
+    csr.sign(dev_key, 'sha256')
+
+    return {
+        'ca_pem': crypto.dump_certificate(crypto.FILETYPE_PEM, ca).decode(),
+        'ca_key_pem': crypto.dump_privatekey(crypto.FILETYPE_PEM, ca_key).decode(),
+        'csr_pem': crypto.dump_certificate_request(crypto.FILETYPE_PEM, csr).decode()
+        }
+
+'''
+    Canned parsed responses by operation name
+'''
+def get_responses(scenario, pems):
+    row = get_row(scenario)
+    return {
+        'GetItem': {'Item': row},
+        'BatchGetItem': {'Responses': {'CertRotationDevices': [row]}, 'UnprocessedKeys': {}},
+        'UpdateItem': {'Attributes': row},
+        'DescribeCACertificate': {'certificateDescription': {'certificatePem': pems.get('ca_pem', '')}},
+        'GetParameter': {'Parameter': {'Value': pems.get('ca_key_pem', '')}},
+        'RegisterCertificate': {'certificateId': man_cert_id,
+            'certificateArn': 'arn:aws:iot:us-east-1:123456789012:cert/{}'.format(man_cert_id)},
+        'DescribeCertificate': {'certificateDescription': {
+            'certificateArn': 'arn:aws:iot:us-east-1:123456789012:cert/{}'.format(vendor_cert_id),
+            'certificatePem': ''}},
+        'SendMessage': {'MessageId': '1', 'MD5OfMessageBody': ''},
+        }
+
+'''
+    One cold start, in a fresh interpreter. Prints a JSON result.
+'''
+def child(scenario, handler_name, pems, prewarm):
+    timings = {}
+    sys.path.insert(0, lambda_dir)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+    if prewarm:
+        os.environ['CR_PREWARM'] = 'true'
+
+    module_name, func_name = handler_name.rsplit('.', 1)
+    start = time.perf_counter()
+
+    # Answer every API call from the table, without touching the network.
+    # Hooked before the handler import, which may create clients.
+    import clients
+    responses = get_responses(scenario, pems)
+    get_session = clients.get_session
+    def hooked_get_session():
+        new_session = clients.session is None
+        session = get_session()
+        if new_session:
+            from botocore.awsrequest import AWSResponse
+            def canned(model, **kwargs):
+                return AWSResponse(None, 200, {}, None), json.loads(json.dumps(
+                    responses.get(model.name, {})))
+            session.events.register('before-call', canned)
+        return session
+    clients.get_session = hooked_get_session
+
+    module = __import__(module_name)
+    timings['import'] = time.perf_counter() - start
+    loaded = {'import': [m for m in heavy_modules if m in sys.modules]}
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    event = get_event(scenario, pems.get('csr_pem', ''))
+    if module_name == 'sqs_handler':
+        event = {'Records': [{'messageId': '1', 'body': json.dumps(event)}]}
+    handler = getattr(module, func_name)
+
+    for step in ['first', 'warm']:
+        start = time.perf_counter()
+        handler(event, None)
+        timings[step] = time.perf_counter() - start
+        loaded[step] = [m for m in heavy_modules if m in sys.modules]
+
+    print(json.dumps({'timings': timings, 'loaded': loaded}))
+
+def run_child(scenario, handler_name, pems, prewarm):
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', scenario, '--handler', handler_name] +
+            (['--prewarm'] if prewarm else []),
+        input=json.dumps(pems), stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def bench(scenario_list, handler_name, runs, prewarm):
+    pems = gen_test_pems() if 'create' in scenario_list else {}
+
+    print('{} x {} runs, {}{}'.format(handler_name, runs, sys.version.split()[0],
+        ', prewarm' if prewarm else ''))
+    print('{:<8} {:>10} {:>10} {:>10}   {}'.format('scenario', 'import ms', 'first ms', 'warm ms',
+        'loaded after import / first'))
+    for scenario in scenario_list:
+        results = [run_child(scenario, handler_name, pems, prewarm) for i in range(runs)]
+        medians = [statistics.median(r['timings'][step] for r in results) * 1000
+            for step in ['import', 'first', 'warm']]
+        loaded = results[-1]['loaded']
+        print('{:<8} {:>10.1f} {:>10.1f} {:>10.1f}   {} / {}'.format(scenario, *medians,
+            ','.join(loaded['import']) or '-', ','.join(loaded['first']) or '-'))
+
+def main():
+    argp = argparse.ArgumentParser(description='Benchmark cert_rotation_lambda cold starts')
+    argp.add_argument('--runs', type=int, default=5, help='--runs fresh interpreters per scenario')
+    argp.add_argument('--scenario', choices=scenarios, help='--scenario one scenario, default all')
+    argp.add_argument('--handler', default='cert_rotation_lambda.cert_rotation_lambda',
+        help='--handler module.function, as in the lambda Handler setting')
+    argp.add_argument('--prewarm', action='store_true', help='--prewarm create clients at import, as with CR_PREWARM')
+    argp.add_argument('--child', choices=scenarios, help=argparse.SUPPRESS)
+    args = argp.parse_args()
+
+    if args.child:
+        child(args.child, args.handler, json.loads(sys.stdin.read() or '{}'), args.prewarm)
+    else:
+        bench([args.scenario] if args.scenario else scenarios, args.handler, args.runs, args.prewarm)
+
+if __name__ == "__main__":
+    main()
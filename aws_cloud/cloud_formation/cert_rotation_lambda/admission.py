@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: admission.py
+
+    Front gate for rotation requests, run before any AWS call so a
+    malformed or misbehaving device can't spend DynamoDB, SSM, or IoT
+    calls. A create-man-cert request is rejected when:
+        - its serial number sent more than ADMISSION_RATE_MAX requests in
+          the last ADMISSION_RATE_WINDOW seconds
+        - it has no CSR, or one over ADMISSION_MAX_CSR_BYTES
+        - the CSR doesn't parse or isn't signed by its own key
+        - the CSR CN isn't the serial number in the topic
+        - the CSR key type and size aren't in ADMISSION_KEY_SIZES
+    ack-man-cert requests are only rate limited.
+
+    The rate limit counts per container, so with N warm containers a
+    serial number gets at most N times the limit. SQS redeliveries of a
+    failed message aren't counted; the device sent the request once. Each
+    rejection is counted as the Rejected metric with its Reason.
+'''
+import threading
+import time
+import metrics
+from config import *
+from certs import get_crypto
+
+REJECT_RATE = 'rate_limited'
+REJECT_NO_CSR = 'no_csr'
+REJECT_CSR_SIZE = 'csr_too_large'
+REJECT_CSR_MALFORMED = 'csr_malformed'
+REJECT_CSR_SIGNATURE = 'csr_signature'
+REJECT_CN = 'cn_mismatch'
+REJECT_KEY = 'key_not_allowed'
+
+'''
+    serial number -> [window start, requests in window]
+'''
+request_counts = {}
+request_counts_lock = threading.Lock()
+
+'''
+    Count a request from serial_number. False when it is over the limit.
+'''
+def count_request(serial_number, now=None):
+    now = now or time.monotonic()
+    with request_counts_lock:
+        if len(request_counts) > ADMISSION_RATE_MAX_SERIALS:
+            # Drop expired windows so the table can't grow without bound
+            for sn in [sn for sn, (start, n) in request_counts.items()
+                    if now - start >= ADMISSION_RATE_WINDOW]:
+                del request_counts[sn]
+
+        window = request_counts.get(serial_number, None)
+        if not window or now - window[0] >= ADMISSION_RATE_WINDOW:
+            window = [now, 0]
+            request_counts[serial_number] = window
+        window[1] += 1
+        return window[1] <= ADMISSION_RATE_MAX
+
+'''
+    Reject reason for a create-man-cert CSR, None if it is acceptable.
+    Only parse and signature errors reject the CSR; anything else (e.g. a
+    pyOpenSSL without load_certificate_request) is raised so the request
+    fails and is retried instead of blaming the device.
+'''
+def check_csr(serial_number, csr_pem_string):
+    if not csr_pem_string or not isinstance(csr_pem_string, str):
+        return REJECT_NO_CSR
+    if len(csr_pem_string) > ADMISSION_MAX_CSR_BYTES:
+        return REJECT_CSR_SIZE
+
+    crypto = get_crypto()
+    try:
+        csr_obj = crypto.load_certificate_request(crypto.FILETYPE_PEM, csr_pem_string)
+        pkey_obj = csr_obj.get_pubkey()
+    except (crypto.Error, ValueError) as e:
+        logging.info('check_csr(): {} CSR malformed: {}'.format(serial_number, str(e)))
+        return REJECT_CSR_MALFORMED
+
+    try:
+        if not csr_obj.verify(pkey_obj):
+            return REJECT_CSR_SIGNATURE
+    except crypto.Error as e:
+        logging.info('check_csr(): {} CSR signature: {}'.format(serial_number, str(e)))
+        return REJECT_CSR_SIGNATURE
+
+    if csr_obj.get_subject().CN != serial_number:
+        return REJECT_CN
+
+    key_type_names = {crypto.TYPE_RSA: 'rsa', getattr(crypto, 'TYPE_EC', None): 'ec'}
+    key_type = key_type_names.get(pkey_obj.type(), None)
+    if pkey_obj.bits() not in ADMISSION_KEY_SIZES.get(key_type, []):
+        return REJECT_KEY
+
+    return None
+
+'''
+    Reject reason for a rotation request event, None to admit it.
+    Events other than create-man-cert and ack-man-cert requests are admitted.
+    redelivered is True for an event already counted on an earlier delivery.
+'''
+def admit(event, serial_number, redelivered=False):
+    if not ADMISSION_ENABLED or not serial_number:
+        return None
+
+    topic = event.get('topic', '') or ''
+    data = event.get('data', None) or {}
+    reason = None
+
+    if '/cert-rotation/create-man-cert/{}/rqst'.format(serial_number) in topic:
+        if not redelivered and not count_request(serial_number):
+            reason = REJECT_RATE
+        else:
+            reason = check_csr(serial_number, data.get('csr', None))
+    elif '/cert-rotation/ack-man-cert/{}/rqst'.format(serial_number) in topic:
+        if not redelivered and not count_request(serial_number):
+            reason = REJECT_RATE
+
+    if reason:
+        logging.info('admit(): {} rejected, {}'.format(serial_number, reason))
+        metrics.count('Rejected', {'Reason':reason})
+    return reason
@@ -24,7 +24,6 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
     IoT rules trigger this lambda. Descriptions for 
     each is below. 
 '''
-import boto3
 import datetime
 from dyn_db import *
 import logging
@@ -32,8 +31,36 @@ from config import *
 from cr_rules import *
 from cr_rules_misc import *
 from certs import *
+from admission import admit
+import clients
+
+if LAMBDA_PREWARM:
+    clients.prewarm(LAMBDA_PREWARM_SERVICES + (['sqs'] if CR_CLEANUP_QUEUE_URL else []),
+        [ddb_table_name])
 
 def cert_rotation_lambda(event, context):
+    seed_arn_parts(context)
+    process_event(event)
+    return
+
+'''
+    Serial number an event is for, from the request topic. None for
+    '$aws/events/certificates/registered' events, which only carry the cert id.
+'''
+def get_event_serial_number(event):
+    topic = event.get('topic', None)
+    if not topic or '$aws/events/certificates/registered' in topic:
+        return None
+    return topic.split('/')[-2]
+
+'''
+    Process one IoT rule event. device_record is the device's DeviceRecord
+    when the caller has already read it (e.g. sqs_handler.py), admitted is
+    True when the caller has already run it through admission.admit().
+    Returns False when the event should be delivered again.
+'''
+def process_event(event, device_record=None, admitted=False):
+    rc = True
     topic = event.get('topic', None)
     data = event.get('data', None)
     client_id = event.get('client_id', None)
@@ -49,39 +76,59 @@ def cert_rotation_lambda(event, context):
             # Note: client_id not available, thus serial number not easily availale
             # Extract serial number from the cert pem file.
             cert_id = data.get('certificateId', None)
-            cert_pem_string = get_cert_pem(cert_id)
-            serial_number = get_cert_CN(cert_pem_string)
-            cr_state = read_state(serial_number)
-            if cr_state == CR_WHITELISTED :
-                write_state(serial_number, CR_THING_CREATED)
-                write_vendor_cert_id(serial_number, cert_id)
+            description = describe_cert(cert_id)
+            serial_number = get_cert_CN(description.get('certificatePem', None))
+            # One conditional write; a duplicate event finds CR_THING_CREATED.
+            # The ARN is kept so the ack needn't describe the cert again.
+            result = transition(serial_number, CR_WHITELISTED, CR_THING_CREATED,
+                {'VendorCertId':cert_id, 'VendorCertArn':description.get('certificateArn', None)})
+            logging.info('registered: {} transition = {}'.format(serial_number, result.status))
+            rc = result.status != UPDATE_ERROR
 
         else:
-            topic_arr = topic.split('/')
-            serial_number = topic_arr[-2]
-            cr_state = read_state(serial_number)
+            serial_number = get_event_serial_number(event)
+            # Cheap checks before any AWS call. A rejected request isn't
+            # retried here; the device sends it again.
+            if not admitted and admit(event, serial_number):
+                return rc
+
+            # One row read serves the whole invocation
+            device_record = device_record or DeviceRecord.load(serial_number)
+            if not device_record.read_ok:
+                # Not the same as no row; have the request delivered again
+                return False
+            cr_state = device_record.state
 
             if '/cert-rotation/create-man-cert/{}/rqst'.format(serial_number) in topic:
                 if cr_state == CR_THING_CREATED :
-                    if cr_rule_create_man_cert(data.get('csr', None), serial_number):
-                        write_state(serial_number, CR_MAN_CERT_CREATED)
+                    # Moves the device to CR_MAN_CERT_CREATED
+                    rc = cr_rule_create_man_cert(data.get('csr', None), serial_number,
+                        device_record=device_record)
                 elif cr_state == CR_MAN_CERT_CREATED:
                     # Device didn't get the response  message, republish response
-                    cr_rule_create_man_cert(data.get('csr', None), serial_number, re_pub=True)
+                    rc = cr_rule_create_man_cert(data.get('csr', None), serial_number, re_pub=True,
+                        device_record=device_record)
+                elif cr_state == CR_WHITELISTED:
+                    # The registered event hasn't been processed yet. Fail, so
+                    # the SQS entry point has the request delivered again.
+                    logging.info('create-man-cert before registered event, state = {}'.format(cr_state))
+                    rc = False
                 else: 
                     logging.info('CR_THING_CREATED topic, but state not correct')
 
             elif '/cert-rotation/ack-man-cert/{}/rqst'.format(serial_number) in topic:
                 if cr_state == CR_MAN_CERT_CREATED:
-                    if cr_rule_ack_man_cert(serial_number, data.get('cert_id', None)):
-                        write_state(serial_number, CR_CERT_ROTATION_COMPLETED)
+                    # Moves the device to CR_CERT_ROTATION_COMPLETED
+                    rc = cr_rule_ack_man_cert(serial_number, data.get('cert_id', None),
+                        device_record=device_record)
                 elif cr_state == CR_CERT_ROTATION_COMPLETED:
                     # Device didn't get the message, republish
-                    cr_rule_ack_man_cert(serial_number, data.get('cert_id', None), re_pub=True)
+                    rc = cr_rule_ack_man_cert(serial_number, data.get('cert_id', None), re_pub=True,
+                        device_record=device_record)
                 else: 
                     logging.info('CR_MAN_CERT_CREATED topic, but state not correct')
 
             else:
                 logging.info('Error. None of the topics matched the rules.')
 
-    return
+    return rc
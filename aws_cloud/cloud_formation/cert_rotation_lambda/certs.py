@@ -17,18 +17,35 @@ HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTIO
 OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
-import boto3
 import logging
 from config import *
+from clients import get_client
 from dyn_db import *
-import OpenSSL 
 import os
+import time
+from collections import namedtuple
 
+'''
+    Manufacturer CA cert and key, parsed once and kept across warm
+    invocations by ca_cert_id, so signing a CSR needs no
+    describe_ca_certificate or SSM get_parameter call.
+'''
+CaEntry = namedtuple('CaEntry', ['ca_cert_id', 'cert_pem', 'cert_obj', 'key_obj', 'expires'])
+ca_cache = {}
+
+'''
+    pyOpenSSL is imported on first use, not at cold start, since the ack
+    requests never sign or parse a cert.
+'''
+def get_crypto():
+    from OpenSSL import crypto
+    return crypto
 
 def get_cert_CN(cert_pem_string):
     cn = ''
     try:
-        x_509_cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, cert_pem_string)
+        crypto = get_crypto()
+        x_509_cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert_pem_string)
         subj_obj = x_509_cert.get_subject()
         cn = subj_obj.CN
     except Exception as e:
@@ -36,68 +53,127 @@ def get_cert_CN(cert_pem_string):
 
     return cn
 
-def get_ca_cert_pem_string(serial_number):
+'''
+    Key type name ('rsa', 'ec', ...) of a pyOpenSSL PKey for logging
+'''
+def get_key_type_name(pkey_obj):
+    crypto = get_crypto()
+    key_type_names = {
+        crypto.TYPE_RSA: 'rsa',
+        crypto.TYPE_DSA: 'dsa',
+        getattr(crypto, 'TYPE_EC', None): 'ec'
+        }
+    return '{}{}'.format(key_type_names.get(pkey_obj.type(), 'unknown'), pkey_obj.bits())
+
+def describe_ca_cert_pem_string(ca_cert_id):
     ca_cert_pem_string = ''
-    ca_cert_id =  read_man_ca_cert_id(serial_number)
-    if ca_cert_id:
-        try:
-            client = boto3.client('iot')
-            response = client.describe_ca_certificate(certificateId=ca_cert_id)
-            certificateDescription = response.get('certificateDescription', None)
+    try:
+        client = get_client('iot')
+        response = client.describe_ca_certificate(certificateId=ca_cert_id)
+        certificateDescription = response.get('certificateDescription', None)
 
-            if certificateDescription:
-                ca_cert_pem_string = certificateDescription.get('certificatePem', None)
-            else:
-                logging.error('get_ca_cert_pem_string(): bad certDescription')
+        if certificateDescription:
+            ca_cert_pem_string = certificateDescription.get('certificatePem', None)
+        else:
+            logging.error('describe_ca_cert_pem_string(): bad certDescription')
 
-        except Exception as e:
-            logging.error('get_ca_cert_pem_string(): Exception = {}'.format(str(e)))
-    else:
-        logging.error('get_ca_cert_pem_string(): bad ca_cert_id')
+    except Exception as e:
+        logging.error('describe_ca_cert_pem_string(): Exception = {}'.format(str(e)))
 
     return ca_cert_pem_string
 
-def get_ca_key_pem_string(serial_number):
-    ca_cert_id =  read_man_ca_cert_id(serial_number)
-    return get_secure_store(ca_cert_id)
+'''
+    CaEntry for ca_cert_id from the cache, loading and parsing the CA cert
+    and key on a miss or after CA_CACHE_TTL. None if either can't be loaded.
+'''
+def get_ca(ca_cert_id):
+    if not ca_cert_id:
+        logging.error('get_ca(): bad ca_cert_id')
+        return None
+
+    ca = ca_cache.get(ca_cert_id, None)
+    if ca and ca.expires > time.monotonic():
+        return ca
+
+    ca_cert_pem_string = describe_ca_cert_pem_string(ca_cert_id)
+    ca_key_pem_string = get_secure_store(ca_cert_id)
+    if not ca_cert_pem_string or not ca_key_pem_string:
+        logging.error('get_ca(): no cert or key for ca_cert_id = {}'.format(ca_cert_id))
+        return None
+
+    try:
+        crypto = get_crypto()
+        ca = CaEntry(ca_cert_id, ca_cert_pem_string,
+            crypto.load_certificate(crypto.FILETYPE_PEM, ca_cert_pem_string),
+            crypto.load_privatekey(crypto.FILETYPE_PEM, ca_key_pem_string),
+            time.monotonic() + CA_CACHE_TTL)
+    except Exception as e:
+        logging.error('get_ca(): Exception = {}'.format(str(e)))
+        return None
 
+    ca_cache[ca_cert_id] = ca
+    logging.info('get_ca(): loaded ca_cert_id = {}'.format(ca_cert_id))
+    return ca
 
-def create_cert_pem_string(serial_number, csr_pem_string):
+'''
+    Drop one CA, or all of them, e.g. after the Manufacturer CA is rotated
+'''
+def invalidate_ca_cache(ca_cert_id=None):
+    if ca_cert_id:
+        ca_cache.pop(ca_cert_id, None)
+    else:
+        ca_cache.clear()
+
+'''
+    Manufacturer CA of the device with serial_number. Pass the invocation's
+    DeviceRecord to avoid reading the row again.
+'''
+def get_man_ca(serial_number, device_record=None):
+    if device_record:
+        return get_ca(device_record.man_ca_cert_id)
+    return get_ca(read_man_ca_cert_id(serial_number))
+
+'''
+    Sign csr_pem_string with the Manufacturer CA. ca is the device's CaEntry,
+    looked up from serial_number when not given.
+'''
+def create_cert_pem_string(serial_number, csr_pem_string, ca=None):
     man_cert_pem_str = ''
-    ca_cert_pem_string = get_ca_cert_pem_string(serial_number)
-    ca_key_pem_string = get_ca_key_pem_string(serial_number)
+    ca = ca or get_man_ca(serial_number)
 
-    if ca_cert_pem_string and ca_key_pem_string:
+    if ca:
         try:
+            crypto = get_crypto()
             # create csr object from csr_pem_string
-            csr_obj = OpenSSL.crypto.load_certificate_request(OpenSSL.crypto.FILETYPE_PEM, csr_pem_string)
-            # create ca cert object from ca_cert_pem_string
-            ca_cert_obj = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, 
-                ca_cert_pem_string)
-            # create ca key object from ca_key_pem_string
-            ca_key_obj = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, 
-                ca_key_pem_string)
+            csr_obj = crypto.load_certificate_request(crypto.FILETYPE_PEM, csr_pem_string)
+            ca_cert_obj = ca.cert_obj
+            ca_key_obj = ca.key_obj
 
             # create blank man cert object then add to it
-            man_cert_obj = OpenSSL.crypto.X509()
+            man_cert_obj = crypto.X509()
+            # Random positive 159 bit serial, so re-signing the same CSR
+            # never yields a cert that is already registered
+            man_cert_obj.set_serial_number(int.from_bytes(os.urandom(20), 'big') >> 1)
             man_cert_obj.gmtime_adj_notBefore(0)
             man_cert_obj.gmtime_adj_notAfter(10 * 365 * 24 * 60 * 60) # Expires in 10 years
             man_cert_obj.set_issuer(ca_cert_obj.get_subject())
             man_cert_obj.set_subject(csr_obj.get_subject())
             man_cert_obj.set_pubkey(csr_obj.get_pubkey())
-            man_cert_obj.sign(ca_key_obj, 'sha256')
+            # The digest pairs with either key type: sha256WithRSAEncryption
+            # for an RSA CA key, ecdsa-with-SHA256 for an EC CA key.
+            man_cert_obj.sign(ca_key_obj, man_cert_sign_digest)
+            logging.info('create_cert_pem_string(): ca key = {}, csr key = {}'.\
+                format(get_key_type_name(ca_key_obj), get_key_type_name(csr_obj.get_pubkey())))
 
             # Generate serialized pem string from cert object
-            man_cert_pem_bytes = OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, man_cert_obj)
+            man_cert_pem_bytes = crypto.dump_certificate(crypto.FILETYPE_PEM, man_cert_obj)
             man_cert_pem_str = man_cert_pem_bytes.decode()
             man_cert_pem_str = man_cert_pem_str.replace('\\n', '\n')
             
         except Exception as e:
             logging.error('create_cert_pem_string(): Exception = {}'.format(str(e)))
     else:
-        logging.error('create_cert_pem_string(): bad pem string.')
-        logging.error('\tcert pem = {}'.format(ca_cert_pem_string))
-        logging.error('\tkey pem = {}'.format(ca_key_pem_string))
+        logging.error('create_cert_pem_string(): no Manufacturer CA for {}'.format(serial_number))
 
     return man_cert_pem_str
 
@@ -109,7 +185,7 @@ def get_secure_store(ca_cert_id):
     value = ''
 
     try:
-        client = boto3.client('ssm')
+        client = get_client('ssm')
         response = client.get_parameter(\
             Name='cr-ca-key-{}'.format(ca_cert_id),
             WithDecryption=True)
@@ -126,22 +202,3 @@ def get_secure_store(ca_cert_id):
         logging.error('get_secure_store(): exception = {}'.format(str(e)))
 
     return value
-
-
-def get_cert_arn(cert_id):
-    cert_arn = None
-    client = boto3.client('iot')
-    try:
-        result = client.describe_certificate(certificateId=cert_id)
-    except Exception as e:
-        logging.error('get_cert_arn(): Failed describe_certifiacte(): {}'.format(str(e)))
-        return cert_arn
-
-    try:
-        cert_arn = result['certificateDescription']['certificateArn']
-
-    except Exception as e:
-        logging.error('get_cert_arn(): Failed result[certificateDescription][certificateArn]: {}'.format(str(e)))
-
-    return cert_arn
-
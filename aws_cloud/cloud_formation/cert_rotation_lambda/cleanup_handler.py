@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+
+'''
+    filename: cleanup_handler.py
+
+    Consumes the cleanup queue cr_rule_ack_man_cert() writes to when
+    CR_CLEANUP_QUEUE_URL is set. Work here is off the device's critical
+    path: the device already has its ack.
+
+    Each message is
+        {'action':'teardown_vendor_cert', 'serial_number':..., 'cert_id':...,
+         'cert_arn':...}
+    The vendor cert is detached, deactivated, and deleted, then VendorCertId
+    is removed from the device row. Both steps are idempotent, so duplicate
+    messages are harmless. Failed messages are reported as
+    batchItemFailures and retried by SQS.
+'''
+import json
+import logging
+from config import *
+from cr_rules_misc import teardown_vendor_cert, seed_arn_parts
+from dyn_db import update_device, UPDATE_ERROR, ddb_table_name
+import clients
+
+if LAMBDA_PREWARM:
+    clients.prewarm(['iot'], [ddb_table_name])
+
+'''
+    Process one cleanup message body. Returns False to have it retried.
+'''
+def process_cleanup(message):
+    action = message.get('action', None)
+    serial_number = message.get('serial_number', None)
+    cert_id = message.get('cert_id', None)
+
+    if action != 'teardown_vendor_cert' or not serial_number or not cert_id:
+        logging.error('process_cleanup(): dropping bad message {}'.format(message))
+        return True
+
+    if not teardown_vendor_cert(serial_number, cert_id, message.get('cert_arn', None)):
+        return False
+
+    # A conflict means the row has moved on, e.g. a new rotation; leave it be
+    result = update_device(serial_number, {'VendorCertId':None, 'VendorCertArn':None},
+        expected_state=CR_CERT_ROTATION_COMPLETED)
+    logging.info('process_cleanup(): {} cert_id = {:.10} {}'.format(serial_number, cert_id,
+        result.status))
+    return result.status != UPDATE_ERROR
+
+def cleanup_lambda(event, context):
+    seed_arn_parts(context)
+    failed = []
+    for record in event.get('Records', []):
+        message_id = record.get('messageId', None)
+        try:
+            rc = process_cleanup(json.loads(record.get('body', '')))
+        except Exception as e:
+            logging.error('cleanup_lambda(): {} Exception = {}'.format(message_id, str(e)))
+            rc = False
+        if not rc:
+            failed.append(message_id)
+
+    logging.info('cleanup_lambda(): {} messages, {} failed'.format(
+        len(event.get('Records', [])), len(failed)))
+
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]}
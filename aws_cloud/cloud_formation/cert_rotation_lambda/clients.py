@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: clients.py
+
+    Shared boto3 clients, resources, and DynamoDB tables for the cert
+    rotation lambda.
+
+    Each is created on first use and kept at module scope, so warm
+    invocations of the same container reuse them and their open
+    connections instead of building a new client per call.
+
+    Tests can replace any of them with local stubs:
+        clients.set_client('iot', stubbed_iot_client)
+        clients.set_table('CertRotationDevices', fake_table)
+        clients.reset()
+
+    boto3 and botocore are imported by the first get_*() call rather than
+    at module import, so the handler's import time doesn't include them.
+'''
+import threading
+from config import *
+
+session = None
+clients = {}
+resources = {}
+tables = {}
+
+# boto3 sessions are not thread safe, so creation is serialized
+lock = threading.Lock()
+
+def get_session():
+    global session
+    if not session:
+        import boto3.session
+        session = boto3.session.Session()
+    return session
+
+def get_config(service_name=None):
+    from botocore.config import Config
+    return Config(**client_configs.get(service_name, client_config))
+
+'''
+    Error code of a botocore ClientError, '' for any other exception.
+    Lets callers check codes without importing botocore.exceptions.
+'''
+def error_code(e):
+    return getattr(e, 'response', {}).get('Error', {}).get('Code', '')
+
+'''
+    Shared client for service_name, e.g. 'iot', 'iot-data', 'ssm', 'sts'
+'''
+def get_client(service_name):
+    client = clients.get(service_name, None)
+    if not client:
+        with lock:
+            client = clients.get(service_name, None)
+            if not client:
+                client = get_session().client(service_name, config=get_config(service_name))
+                clients[service_name] = client
+    return client
+
+'''
+    Shared resource for service_name, e.g. 'dynamodb'
+'''
+def get_resource(service_name):
+    resource = resources.get(service_name, None)
+    if not resource:
+        with lock:
+            resource = resources.get(service_name, None)
+            if not resource:
+                resource = get_session().resource(service_name, config=get_config())
+                resources[service_name] = resource
+    return resource
+
+'''
+    Shared DynamoDB Table for table_name
+'''
+def get_table(table_name):
+    table = tables.get(table_name, None)
+    if not table:
+        table = get_resource('dynamodb').Table(table_name)
+        tables[table_name] = table
+    return table
+
+'''
+    Create the clients for service_names and the tables for table_names now
+'''
+def prewarm(service_names, table_names=[]):
+    try:
+        for service_name in service_names:
+            get_client(service_name)
+        for table_name in table_names:
+            get_table(table_name)
+    except Exception as e:
+        logging.error('prewarm(): Exception = {}'.format(str(e)))
+
+def get_region():
+    return get_session().region_name
+
+'''
+    Test hooks
+'''
+def set_client(service_name, client):
+    clients[service_name] = client
+
+def set_resource(service_name, resource):
+    resources[service_name] = resource
+    tables.clear()
+
+def set_table(table_name, table):
+    tables[table_name] = table
+
+def reset():
+    global session
+    with lock:
+        session = None
+        clients.clear()
+        resources.clear()
+        tables.clear()
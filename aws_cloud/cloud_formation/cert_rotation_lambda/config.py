@@ -23,7 +23,7 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
     All config variables and constants for the all lambda processing
 '''
 
-from botocore.config import Config
+import os
 
 import logging
 #logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
@@ -52,4 +52,83 @@ cr_states = [
 cert_pol_name_in_prog  = 'CrInProgressCertPolicy'
 cert_pol_name_complete  = 'CrCertRotationCompleteCertPolicy'
 
-pub_retries = Config(retries={'max_attempts': 4})
+pub_retries = {'retries': {'max_attempts': 4}}
+
+######################
+# Shared boto3 clients (clients.py), kept across warm invocations.
+# botocore.config.Config arguments; clients.py builds the Config on first
+# use so importing config doesn't load botocore.
+LAMBDA_MAX_POOL_CONNECTIONS = 16
+client_config = {'max_pool_connections': LAMBDA_MAX_POOL_CONNECTIONS}
+client_configs = {
+    'iot-data': dict(client_config, **pub_retries)
+    }
+
+# With CR_PREWARM, the handler modules import boto3 and create these
+# clients during init, where lambda runs them at full CPU and provisioned
+# concurrency absorbs them, instead of in the first request. Off unless the
+# environment sets it, e.g. from cfn_cert_rotation_sqs.json, since it undoes
+# the lazy imports for containers that only ever see acks and replays.
+LAMBDA_PREWARM = os.environ.get('CR_PREWARM', 'false').lower() == 'true'
+LAMBDA_PREWARM_SERVICES = ['iot', 'iot-data', 'ssm']
+
+######################
+# Device row reads (dyn_db.DeviceRecord). The rows drive the rotation state
+# machine, so reads are strongly consistent: a stale CR_THING_CREATED would
+# skip the stored response replay and sign and register a second cert, only
+# to discard it on the conditional write. A consistent read of a row this
+# small is 1 RCU instead of 0.5, once per request.
+DDB_CONSISTENT_READ = True
+
+######################
+# SQS batch handler (sqs_handler.py). Rows for a batch are read with
+# BatchGetItem, at most DDB_BATCH_GET_SIZE keys per call. Serial numbers
+# are processed on up to SQS_MAX_WORKERS threads, each serial's events in order.
+DDB_BATCH_GET_SIZE = 100
+DDB_BATCH_GET_MAX_ATTEMPTS = 5
+DDB_BATCH_GET_BACKOFF = 0.05 # seconds, doubled per UnprocessedKeys retry
+SQS_MAX_WORKERS = 8
+
+######################
+# Fast path (cr_rules.py). With CR_OVERLAP_IO, the create rule runs
+# attach_policy and attach_thing_principal at the same time, then the
+# DynamoDB transition. With CR_CLEANUP_QUEUE_URL, the ack rule publishes as soon
+# as CR_CERT_ROTATION_COMPLETED is written and queues the vendor cert
+# teardown for cleanup_handler.py. Both are off unless the environment
+# sets them, e.g. from cfn_cert_rotation_sqs.json.
+CR_OVERLAP_IO = os.environ.get('CR_OVERLAP_IO', 'false').lower() == 'true'
+CR_CLEANUP_QUEUE_URL = os.environ.get('CR_CLEANUP_QUEUE_URL', '')
+CR_IO_WORKERS = 4
+
+######################
+# CloudWatch metrics (metrics.py), written as Embedded Metric Format logs
+METRICS_ENABLED = True
+METRICS_NAMESPACE = 'CertRotation'
+
+######################
+# Admission gate (admission.py), run before any AWS call. A serial number
+# may send ADMISSION_RATE_MAX requests per ADMISSION_RATE_WINDOW seconds
+# to each container; devices retry every 10 seconds, 5 times.
+ADMISSION_ENABLED = True
+ADMISSION_RATE_WINDOW = 60
+ADMISSION_RATE_MAX = 8
+ADMISSION_RATE_MAX_SERIALS = 10000 # windows kept before expired ones are dropped
+ADMISSION_MAX_CSR_BYTES = 8192
+ADMISSION_KEY_SIZES = {
+    'rsa': [2048, 3072, 4096],
+    'ec': [256, 384]
+    }
+
+######################
+# Certificate descriptions cached per container (cr_rules_misc.describe_cert)
+CERT_CACHE_SIZE = 1000
+
+######################
+# Parsed Manufacturer CA cert and key are cached per container (certs.py).
+# A rotated CA is picked up after at most this many seconds, or at once
+# with certs.invalidate_ca_cache().
+CA_CACHE_TTL = 300
+
+######################
+# Manufacturer cert signing. Used for both RSA and EC (P-256) Manufacturer CA keys.
+man_cert_sign_digest = 'sha256'
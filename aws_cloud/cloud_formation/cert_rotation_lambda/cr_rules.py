@@ -22,13 +22,60 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
     Jitr rule processing
 '''
-import boto3
 import logging
 from config import *
+from clients import get_client
 from cr_rules_misc import *
 from certs import *
 import json
-from dyn_db import write_man_cert_id, read_man_cert_id, write_vendor_cert_id, read_vendor_cert_id
+import metrics
+from dyn_db import DeviceRecord, UPDATE_OK, UPDATE_CONFLICT
+
+'''
+    create-man-cert response payload. Stored on the device row with the
+    CR_MAN_CERT_CREATED transition and published as is on every repeat.
+'''
+def man_cert_response(man_cert_id, man_cert_pem_string):
+    return json.dumps({'pem':man_cert_pem_string, 'cert_id':man_cert_id})
+
+
+'''
+    Register the man cert, then attach its policy and attach it to the thing
+    at the same time (CR_OVERLAP_IO). CR_MAN_CERT_CREATED is written only
+    once both attaches succeed, so a repeated request never replays a cert
+    the device can't connect with. Returns the response payload, or ''.
+'''
+def create_man_cert_overlapped(csr, serial_number, device_record):
+    thing_name = serial_number
+    man_cert_arn, man_cert_id, man_cert_pem_string = register_man_cert(csr, serial_number,
+        device_record)
+    if not man_cert_id:
+        return ''
+
+    policy_ok, thing_ok = run_overlapped(
+        lambda: attach_policy(man_cert_id, cert_pol_name_complete, man_cert_arn),
+        lambda: attach_thing_principal(thing_name, man_cert_arn))
+    if not (policy_ok and thing_ok):
+        # Nothing names the cert yet
+        logging.info('create_man_cert_overlapped(): attach failed, discarding {}'.format(man_cert_id))
+        discard_cert(thing_name, man_cert_arn, man_cert_id)
+        return ''
+
+    response = man_cert_response(man_cert_id, man_cert_pem_string)
+    result = device_record.transition(CR_MAN_CERT_CREATED,
+        {'ManufacturerCertId':man_cert_id, 'ManufacturerCertArn':man_cert_arn,
+            'ManCertResponse':response},
+        expected_state=CR_THING_CREATED)
+    if result.status == UPDATE_CONFLICT:
+        # A concurrent retry of this request created its cert first
+        logging.info('create_man_cert_overlapped(): lost race, discarding {}'.format(man_cert_id))
+        discard_cert(thing_name, man_cert_arn, man_cert_id)
+        return ''
+    elif result.status != UPDATE_OK:
+        # The write may still have landed; the cert is usable either way
+        logging.error('create_man_cert_overlapped(): transition failed for {}'.format(man_cert_id))
+        return ''
+    return response
 
 '''
     cr_rule_create_man_cert():
@@ -36,29 +83,49 @@ from dyn_db import write_man_cert_id, read_man_cert_id, write_vendor_cert_id, re
         generate new certificate
         register cert
         attach policy to cert
-        write cert id to DB
+        write cert id, response, and CR_MAN_CERT_CREATED to DB in one
+            conditional update
         publish new certificate to '/cert-rotation/create-man-cert/{}/rspn'.\
+
+        With CR_OVERLAP_IO set, the two attaches run at once, then the DB write.
+
+        On re-pub the stored response is published again as is.
+
+        device_record is the invocation's DeviceRecord, read here if not given.
 '''
-def cr_rule_create_man_cert(csr, serial_number, re_pub=False):
+def cr_rule_create_man_cert(csr, serial_number, re_pub=False, device_record=None):
 
     logging.info('Enter cr_rule_create_man_cert')
 
     rc = False
     thing_name = serial_number
+    device_record = device_record or DeviceRecord.load(serial_number)
+    if not device_record.read_ok:
+        return rc
 
     man_cert_arn = ''
     man_cert_pem_string = ''
+    response = ''
+    path = 'first'
 
-    man_cert_id = read_man_cert_id(serial_number)
+    man_cert_id = device_record.man_cert_id
 
-    if man_cert_id == '' and not re_pub:
+    if man_cert_id == '' and not re_pub and CR_OVERLAP_IO:
+        response = create_man_cert_overlapped(csr, serial_number, device_record)
+        if response == '':
+            return rc
+
+    elif man_cert_id == '' and not re_pub:
         # No stored cert id and no rep, so go create the man cert
-        man_cert_arn, man_cert_id, man_cert_pem_string = create_man_cert(csr, serial_number)
+        man_cert_arn, man_cert_id, man_cert_pem_string = create_man_cert(csr, serial_number,
+            device_record)
+        if man_cert_id == '':
+            return rc
 
         try:
-            client = boto3.client('iot')
+            client = get_client('iot')
         except Exception as e:
-            logging.error('cr_rule_create_man_cert(): Failed to boto3.client: {}'.format(str(e)))
+            logging.error('cr_rule_create_man_cert(): Failed to get_client: {}'.format(str(e)))
             return rc
 
         try:
@@ -67,89 +134,123 @@ def cr_rule_create_man_cert(csr, serial_number, re_pub=False):
             logging.error('cr_rule_create_man_cert(): Failed attach_thing_principal(): {}'.format(str(e)))
             return rc
 
-        write_man_cert_id(serial_number, man_cert_id)
+        response = man_cert_response(man_cert_id, man_cert_pem_string)
+        result = device_record.transition(CR_MAN_CERT_CREATED,
+            {'ManufacturerCertId':man_cert_id, 'ManufacturerCertArn':man_cert_arn,
+                'ManCertResponse':response},
+            expected_state=CR_THING_CREATED)
+        if result.status == UPDATE_CONFLICT:
+            # A concurrent retry of this request created its cert first
+            logging.info('cr_rule_create_man_cert(): lost race, discarding {}'.format(man_cert_id))
+            discard_cert(thing_name, man_cert_arn, man_cert_id)
+            return rc
+        elif result.status != UPDATE_OK:
+            return rc
+
+    elif man_cert_id != '' and re_pub and device_record.man_cert_response:
+        # Answered from the row already read, no IoT calls
+        response = device_record.man_cert_response
+        path = 'replay'
 
     elif man_cert_id != '' and re_pub:
+        # Row written before responses were stored, rebuild it
         man_cert_pem_string  = get_cert_pem(man_cert_id)
-        if man_cert_pem_string == '':
+        if not man_cert_pem_string:
             logging.info('cr_rule_create_man_cert(): No man cert key or pem on re-pub. Unknown state.')
             return rc
+        response = man_cert_response(man_cert_id, man_cert_pem_string)
+        path = 'rebuilt'
     else:
         logging.info('cr_rule_create_man_cert(): No man cert id on re-pub or man cert on no rep. Unknown state.')
         return rc
 
-    if man_cert_pem_string != '' and man_cert_id != '':
-        topic = '/cert-rotation/create-man-cert/{}/rspn'.\
-            format(serial_number)
-        logging.info('cr_rule_create_man_cert(): topic = {}'.format(topic))
-
-        message = {}
-        message.update({'pem':man_cert_pem_string})
-        message.update({'cert_id':man_cert_id})
-
+    topic = '/cert-rotation/create-man-cert/{}/rspn'.\
+        format(serial_number)
+    logging.info('cr_rule_create_man_cert(): topic = {}, path = {}'.format(topic, path))
+    logging.info('cr_rule_create_man_cert(): response = {:.80}'.format(response))
 
-        logging.info('cr_rule_create_man_cert(): pem = {:.60}'.format(message.get('pem', None)))
-        logging.info('cr_rule_create_man_cert(): cert_id = {:.10}'.format(message.get('cert_id', None)))
-
-        try:
-            client = boto3.client('iot-data', config=pub_retries)
-            client.publish(topic=topic, qos=1, payload=json.dumps(message))
-            rc = True
-        except Exception as e:
-            logging.error('cr_rule_create_man_cert(): Failed to publish message: {}'.format(str(e)))
+    rc = publish_response(topic, response)
+    metrics.count('Requests', {'Rule':'create', 'Path':path})
 
     return rc
 
 '''
     cr_rule_ack_man_cert():
+        detach, deactivate, and delete the vendor cert
+        remove the vendor cert id and write CR_CERT_ROTATION_COMPLETED to DB
+            in one conditional update
+        publish ack to '/cert-rotation/ack-man-cert/{}/rspn'
+
+        With CR_CLEANUP_QUEUE_URL set, writes CR_CERT_ROTATION_COMPLETED,
+        then publishes the ack while queueing the vendor cert teardown.
+
+        device_record is the invocation's DeviceRecord, read here if not given.
 '''
-def cr_rule_ack_man_cert(serial_number, msg_cert_id, re_pub=False):
+def cr_rule_ack_man_cert(serial_number, msg_cert_id, re_pub=False, device_record=None):
 
     logging.info('Enter cr_rule_ack_man_cert')
 
     rc = False
     thing_name = serial_number
+    device_record = device_record or DeviceRecord.load(serial_number)
+    if not device_record.read_ok:
+        return rc
 
     man_cert_arn = ''
     man_cert_pem_string = ''
     man_cert_key_string = ''
 
-    man_cert_id = read_man_cert_id(serial_number)
+    man_cert_id = device_record.man_cert_id
     if man_cert_id == msg_cert_id:
 
-        vendor_cert_id = read_vendor_cert_id(serial_number)
-        vendor_cert_arn = get_cert_arn(vendor_cert_id)
-
-        logging.info('vendor_cert_id = {}'.format(vendor_cert_id))
-        logging.info('vendor_cert_arn = {}'.format(vendor_cert_arn))
-        logging.info('thing_name = {}'.format(thing_name))
-
-        try:
-            client = boto3.client('iot')
-        except Exception as e:
-            logging.error('cr_rule_ack_man_cert(): Failed to boto3.client: {}'.format(str(e)))
-            return rc
-
-        try:
-            result = client.detach_thing_principal(thingName=thing_name, principal=vendor_cert_arn)
-        except Exception as e:
-            logging.error('cr_rule_ack_man_cert(): Failed detach_thing_principal(): {}'.format(str(e)))
-            return rc
-
-        try:
-            client.update_certificate(certificateId=vendor_cert_id, newStatus='INACTIVE')
-        except Exception as e:
-            logging.error('cr_rule_ack_man_cert(): Failed update_certificate(): {}'.format(str(e)))
-            return rc
-
-        try:
-            client.delete_certificate(certificateId=vendor_cert_id, forceDelete=True)
-        except Exception as e:
-            logging.error('cr_rule_ack_man_cert(): Failed delete_certificate(): {}'.format(str(e)))
-            return rc
-
-        # Delete the si vendor cert id entry from the db.
-        write_vendor_cert_id(serial_number, None)
+        if not re_pub and CR_CLEANUP_QUEUE_URL:
+            # Durable once CR_CERT_ROTATION_COMPLETED is written. VendorCertId
+            # stays on the row until cleanup_handler.py has deleted the cert.
+            result = device_record.transition(CR_CERT_ROTATION_COMPLETED,
+                {'ManCertResponse':None}, expected_state=CR_MAN_CERT_CREATED)
+            if result.status != UPDATE_OK:
+                return rc
+
+        # On re-pub the vendor cert is already gone, just publish again. The
+        # ack payload is the ManufacturerCertId already on the row.
+        elif not re_pub:
+            vendor_cert_id = device_record.vendor_cert_id
+            vendor_cert_arn = device_record.vendor_cert_arn or get_cert_arn(vendor_cert_id)
+
+            logging.info('vendor_cert_id = {}'.format(vendor_cert_id))
+            logging.info('vendor_cert_arn = {}'.format(vendor_cert_arn))
+            logging.info('thing_name = {}'.format(thing_name))
+
+            try:
+                client = get_client('iot')
+            except Exception as e:
+                logging.error('cr_rule_ack_man_cert(): Failed to get_client: {}'.format(str(e)))
+                return rc
+
+            try:
+                result = client.detach_thing_principal(thingName=thing_name, principal=vendor_cert_arn)
+            except Exception as e:
+                logging.error('cr_rule_ack_man_cert(): Failed detach_thing_principal(): {}'.format(str(e)))
+                return rc
+
+            try:
+                client.update_certificate(certificateId=vendor_cert_id, newStatus='INACTIVE')
+            except Exception as e:
+                logging.error('cr_rule_ack_man_cert(): Failed update_certificate(): {}'.format(str(e)))
+                return rc
+
+            try:
+                client.delete_certificate(certificateId=vendor_cert_id, forceDelete=True)
+            except Exception as e:
+                logging.error('cr_rule_ack_man_cert(): Failed delete_certificate(): {}'.format(str(e)))
+                return rc
+
+            # Delete the si vendor cert id entry from the db.
+            result = device_record.transition(CR_CERT_ROTATION_COMPLETED,
+                {'VendorCertId':None, 'VendorCertArn':None, 'ManCertResponse':None},
+                expected_state=CR_MAN_CERT_CREATED)
+            if result.status != UPDATE_OK:
+                return rc
 
         topic = '/cert-rotation/ack-man-cert/{}/rspn'.\
             format(serial_number)
@@ -157,12 +258,17 @@ def cr_rule_ack_man_cert(serial_number, msg_cert_id, re_pub=False):
         message = {'cert_id':man_cert_id}
 
         logging.info('cr_rule_ack_man_cert(): cert_id = {:.10}'.format(message.get('cert_id', None)))
-
-        try:
-            client = boto3.client('iot-data', config=pub_retries)
-            client.publish(topic=topic, qos=1, payload=json.dumps(message))
-            rc = True
-        except Exception as e:
-            logging.error('cr_rule_ack_man_cert(): Failed to publish message: {}'.format(str(e)))
+        metrics.count('Requests', {'Rule':'ack', 'Path':'replay' if re_pub else 'first'})
+
+        vendor_cert_id = device_record.vendor_cert_id
+        if CR_CLEANUP_QUEUE_URL and vendor_cert_id:
+            # Queued again on re-pub in case the first send_message failed
+            published, queued = run_overlapped(
+                lambda: publish_response(topic, message),
+                lambda: enqueue_cleanup(serial_number, vendor_cert_id,
+                    device_record.vendor_cert_arn or None))
+            rc = published and queued
+        else:
+            rc = publish_response(topic, message)
 
     return rc
@@ -19,57 +19,131 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 #
 
-import boto3
 import logging
 from config import *
+from clients import get_client, get_region, error_code
 from certs import *
 import os
 import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-def get_ca_cert_id(cert_id):
-    client = boto3.client('iot')
-    ca_cert_id = None
-    try:
-        result = client.describe_certificate(certificateId=cert_id)
-        ca_cert_id = result['certificateDescription']['caCertificateId']
+io_pool = None
+io_pool_lock = threading.Lock()
 
-    except Exception as e:
-        logging.error('jitr_iot_rule(): Failed describe_certifiacte(): {}'.format(str(e)))
-    
-    return ca_cert_id
+'''
+    Pool shared by all requests in the container for overlapping
+    independent AWS calls within one request
+'''
+def get_io_pool():
+    global io_pool
+    if not io_pool:
+        with io_pool_lock:
+            if not io_pool:
+                io_pool = ThreadPoolExecutor(max_workers=CR_IO_WORKERS)
+    return io_pool
 
+'''
+    Run the zero argument functions at the same time and return their
+    results in order. A function that raises returns False.
+'''
+def run_overlapped(*funcs):
+    futures = [get_io_pool().submit(func) for func in funcs]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logging.error('run_overlapped(): Exception = {}'.format(str(e)))
+            results.append(False)
+    return results
 
-def get_cert_arn(cert_id):
-    cert_arn = None
-    client = boto3.client('iot')
-    try:
-        result = client.describe_certificate(certificateId=cert_id)
-    except Exception as e:
-        logging.error('get_cert_arn(): Failed describe_certifiacte(): {}'.format(str(e)))
+'''
+    Partition, region, and account for building ARNs without a describe
+    call, seeded from the lambda context by seed_arn_parts()
+'''
+arn_parts = {}
+arn_parts_tried = False
 
-    try:
-        cert_arn = result['certificateDescription']['certificateArn']
+'''
+    Per-container cache of describe_certificate results by cert id
+'''
+cert_cache = OrderedDict()
+cert_cache_lock = threading.Lock()
 
+'''
+    Take partition, region, and account from the lambda context's
+    invoked_function_arn, 'arn:aws:lambda:us-east-1:123456789012:function:name'
+'''
+def seed_arn_parts(context):
+    if arn_parts or context is None:
+        return
+    try:
+        arn = context.invoked_function_arn.split(':')
+        arn_parts.update({'partition':arn[1], 'region':arn[3], 'account':arn[4]})
     except Exception as e:
-        logging.error('get_cert_arn(): Failed result[certificateDescription][certificateArn]: {}'.format(str(e)))
+        logging.error('seed_arn_parts(): Exception = {}'.format(str(e)))
 
-    return cert_arn
+'''
+    ARN parts, asking sts for the account once if no context seeded them.
+    {} if they can't be found.
+'''
+def get_arn_parts():
+    global arn_parts_tried
+    if not arn_parts and not arn_parts_tried:
+        arn_parts_tried = True
+        try:
+            region = get_aws_region()
+            partition = 'aws-cn' if region.startswith('cn-') else \
+                'aws-us-gov' if region.startswith('us-gov-') else 'aws'
+            arn_parts.update({'partition':partition, 'region':region, 'account':get_account_id()})
+        except Exception as e:
+            logging.error('get_arn_parts(): Exception = {}'.format(str(e)))
+    return arn_parts
+
+'''
+    Certificate description for cert_id, from the cache or describe_certificate.
+    {} on failure.
+'''
+def describe_cert(cert_id):
+    description = cert_cache.get(cert_id, None)
+    if description:
+        return description
 
-def get_cert_pem(cert_id):
-    cert_pem = None
-    client = boto3.client('iot')
     try:
+        client = get_client('iot')
         result = client.describe_certificate(certificateId=cert_id)
+        description = result['certificateDescription']
     except Exception as e:
-        logging.error('get_cert_arn(): Failed describe_certifiacte(): {}'.format(str(e)))
+        logging.error('describe_cert(): Failed describe_certificate(): {}'.format(str(e)))
+        return {}
 
-    try:
-        cert_pem = result['certificateDescription']['certificatePem']
+    with cert_cache_lock:
+        cert_cache[cert_id] = description
+        while len(cert_cache) > CERT_CACHE_SIZE:
+            cert_cache.popitem(last=False)
+    return description
 
-    except Exception as e:
-        logging.error('get_cert_pem(): Failed result[certificateDescription][certificatePem]: {}'.format(str(e)))
+def uncache_cert(cert_id):
+    with cert_cache_lock:
+        cert_cache.pop(cert_id, None)
 
-    return cert_pem
+def get_ca_cert_id(cert_id):
+    return describe_cert(cert_id).get('caCertificateId', None)
+
+'''
+    Cert ARN, built locally when the account is known
+'''
+def get_cert_arn(cert_id):
+    parts = get_arn_parts()
+    if parts:
+        return 'arn:{}:iot:{}:{}:cert/{}'.format(parts['partition'], parts['region'],
+            parts['account'], cert_id)
+    return describe_cert(cert_id).get('certificateArn', None)
+
+def get_cert_pem(cert_id):
+    return describe_cert(cert_id).get('certificatePem', None)
 
 '''
     Detach Cert Policy from Cert
@@ -80,7 +154,7 @@ def detach_policy(cert_id, policy_name):
 
     cert_arn = get_cert_arn(cert_id)
 
-    client = boto3.client('iot')
+    client = get_client('iot')
     try:
         result = client.detach_policy(policyName=policy_name, target=cert_arn)
         logging.info('detach_policy(): result = {}'.format(result))
@@ -89,21 +163,35 @@ def detach_policy(cert_id, policy_name):
         logging.error('detach_policy(): Failed describe_certifiacte(): {}'.format(str(e)))
 
 '''
-    Attach Cert Policy to Cert
+    Attach Cert Policy to Cert. Pass cert_arn when known to skip
+    describe_certificate. Returns True on success.
 '''
-def attach_policy(cert_id, policy_name):
+def attach_policy(cert_id, policy_name, cert_arn=None):
 
     logging.info('attach_policy(): cert_id = {}, policy_name = {}'.format(cert_id, policy_name))
 
-    cert_arn = get_cert_arn(cert_id)
+    cert_arn = cert_arn or get_cert_arn(cert_id)
 
-    client = boto3.client('iot')
+    client = get_client('iot')
 
     try:
         result = client.attach_policy(policyName=policy_name, target=cert_arn)
         logging.info('attach_policy(): result = {}'.format(result))
+        return True
     except Exception as e:
         logging.error('attach_cert_policy(): Failed attach_policy(): {}'.format(str(e)))
+    return False
+
+'''
+    Attach cert_arn to the thing. Returns True on success.
+'''
+def attach_thing_principal(thing_name, cert_arn):
+    try:
+        get_client('iot').attach_thing_principal(thingName=thing_name, principal=cert_arn)
+        return True
+    except Exception as e:
+        logging.error('attach_thing_principal(): Failed attach_thing_principal(): {}'.format(str(e)))
+    return False
 
 
 '''
@@ -111,19 +199,31 @@ def attach_policy(cert_id, policy_name):
     Attach policy to cert
     Return cert arn
 '''
-def create_man_cert(csr, serial_number):
+def create_man_cert(csr, serial_number, device_record=None):
+    man_cert_arn, man_cert_id, man_cert_pem_string = register_man_cert(csr, serial_number,
+        device_record)
+    if man_cert_id:
+        attach_policy(man_cert_id, cert_pol_name_complete, man_cert_arn)
+    return man_cert_arn, man_cert_id, man_cert_pem_string
+
+'''
+    Create a certificate based on CSR using the Manufacture CA and register
+    it, without attaching a policy. Return cert arn, id, and pem.
+'''
+def register_man_cert(csr, serial_number, device_record=None):
     # or just read the cert from an S3 bucket ... for now
     man_cert_arn = ''
     man_cert_id = ''
     man_cert_pem_string = ''
     man_cert_key_string = ''
 
-    man_ca_cert_pem_string = get_ca_cert_pem_string(serial_number)
-    man_cert_pem_string = create_cert_pem_string(serial_number, csr)
+    man_ca = get_man_ca(serial_number, device_record)
+    man_ca_cert_pem_string = man_ca.cert_pem if man_ca else ''
+    man_cert_pem_string = create_cert_pem_string(serial_number, csr, man_ca)
 
     if man_ca_cert_pem_string and man_cert_pem_string:
         try:
-            client = boto3.client('iot')
+            client = get_client('iot')
 
             response = client.register_certificate(
                 certificatePem=man_cert_pem_string,
@@ -136,30 +236,104 @@ def create_man_cert(csr, serial_number):
             logging.info('man_cert_arn = {}'.format(man_cert_arn))
             logging.info('man_cert_id = {}'.format(man_cert_id))
 
-            attach_policy(man_cert_id, cert_pol_name_complete)
-
         except Exception as e:
-            logging.error('create_man_cert(): Failed register_certificate(): {}'.format(str(e)))
+            # Each attempt signs a new cert with a random serial, so the pem
+            # is never already registered
+            logging.error('register_man_cert(): Failed register_certificate(): {}'.format(str(e)))
+            # The CA may have been rotated or deactivated, reload it next time
+            invalidate_ca_cache(man_ca.ca_cert_id)
         
     else:
-        logging.error('create_man_cert(): pem string.')
+        logging.error('register_man_cert(): pem string.')
         logging.error('\tman ca cert pem string = {}'.format(man_ca_cert_pem_string ))
         logging.error('\tman cert pem string = {}'.format(man_cert_pem_string ))
 
     return man_cert_arn, man_cert_id, man_cert_pem_string 
 
+'''
+    Run one IoT call of a cert teardown. A resource that is already gone
+    counts as done. Returns True on success.
+'''
+def cert_step(cert_id, operation_name, **kwargs):
+    try:
+        getattr(get_client('iot'), operation_name)(**kwargs)
+    except Exception as e:
+        if error_code(e) != 'ResourceNotFoundException':
+            logging.error('cert_step(): {} {} Exception = {}'.format(cert_id, operation_name, str(e)))
+            return False
+        logging.info('cert_step(): {} {} already done'.format(cert_id, operation_name))
+    return True
+
+'''
+    Detach cert_id from the thing, deactivate it, and delete it. Each step
+    runs even if the one before failed, so a cert that was never attached
+    to the thing is still deactivated and deleted. Returns True only when
+    the cert is gone.
+'''
+def delete_cert(thing_name, cert_id, cert_arn):
+    uncache_cert(cert_id)
+    if cert_arn:
+        cert_step(cert_id, 'detach_thing_principal', thingName=thing_name, principal=cert_arn)
+    cert_step(cert_id, 'update_certificate', certificateId=cert_id, newStatus='INACTIVE')
+    return cert_step(cert_id, 'delete_certificate', certificateId=cert_id, forceDelete=True)
+
+'''
+    Detach, deactivate, and delete a cert that lost a state transition race
+    or whose attaches failed. Returns True when the cert is gone.
+'''
+def discard_cert(thing_name, cert_arn, cert_id):
+    rc = delete_cert(thing_name, cert_id, cert_arn)
+    if not rc:
+        logging.error('discard_cert(): {} not deleted'.format(cert_id))
+    return rc
+
+'''
+    Detach, deactivate, and delete a vendor cert. A cert that is already
+    gone counts as done. Returns True when the cert is gone.
+'''
+def teardown_vendor_cert(thing_name, cert_id, cert_arn=None):
+    return delete_cert(thing_name, cert_id, cert_arn or get_cert_arn(cert_id))
+
+'''
+    Publish a response message, a dict or an already serialized payload,
+    to the device. Returns True on success.
+'''
+def publish_response(topic, message):
+    payload = message if isinstance(message, str) else json.dumps(message)
+    try:
+        client = get_client('iot-data')
+        client.publish(topic=topic, qos=1, payload=payload)
+        return True
+    except Exception as e:
+        logging.error('publish_response(): Failed to publish message: {}'.format(str(e)))
+    return False
+
+'''
+    Queue the vendor cert teardown for cleanup_handler.py. Returns True on success.
+'''
+def enqueue_cleanup(serial_number, vendor_cert_id, vendor_cert_arn=None):
+    message = {'action':'teardown_vendor_cert', 'serial_number':serial_number,
+        'cert_id':vendor_cert_id, 'cert_arn':vendor_cert_arn}
+    try:
+        get_client('sqs').send_message(QueueUrl=CR_CLEANUP_QUEUE_URL,
+            MessageBody=json.dumps(message))
+        logging.info('enqueue_cleanup(): {} cert_id = {:.10}'.format(serial_number, vendor_cert_id))
+        return True
+    except Exception as e:
+        logging.error('enqueue_cleanup(): Failed send_message(): {}'.format(str(e)))
+    return False
+
 def describe_endpoint():
-    client = boto3.client('iot')
+    client = get_client('iot')
     endpoint = client.describe_endpoint(endpointType='iot:Data-ATS')
     return endpoint['endpointAddress']
 
 def get_account_id():
-    client = boto3.client('sts')
+    client = get_client('sts')
     aws_account_id = client.get_caller_identity()['Account']
     return aws_account_id.strip('\n')
 
 def get_aws_region():
-    my_session = boto3.session.Session()
-    aws_region = my_session.region_name
+    aws_region = get_region()
     return aws_region.strip('\n')
 
@@ -36,11 +36,28 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
         - reads (e.g. get_item) rows based on SerialNumber
         - writes (e.g. put_item) the State in a row with a matching SerialNumber
           or VendorSerial value
+
+    Each lambda invocation reads its device row once into a DeviceRecord and
+    passes it down to the rules instead of calling the read_* functions.
+
+    Writes are single UpdateItem calls. State transitions set CrState and
+    any other attributes together, conditioned on the expected prior
+    CrState, and report a lost race as UPDATE_CONFLICT.
 '''
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
+from collections import namedtuple
 import logging
+import time
 from config import *
+import clients
+
+UPDATE_OK = 'OK'
+UPDATE_CONFLICT = 'CONFLICT' # no row, or CrState was not the expected state
+UPDATE_ERROR = 'ERROR'
+
+'''
+    status is one of UPDATE_*; item is the updated row when status is UPDATE_OK
+'''
+UpdateResult = namedtuple('UpdateResult', ['status', 'item'])
 
 # db_table_name must equal DDB_NAME in ../config.bash.
 # Cloud formation used DDB_NAME when creating the DDB table.
@@ -49,31 +66,218 @@ ddb_table_name = 'CertRotationDevices'
 def get_table():
     ddb_table = None
     try:
-        dynamodb = boto3.resource('dynamodb')
-        ddb_table = dynamodb.Table(ddb_table_name)
+        ddb_table = clients.get_table(ddb_table_name)
     except Exception as e:
         ddb_table = None
         logging.error("get_table(): Exception: {}".format(str(e)))
     return(ddb_table)
 
-def write_state(serial_number, state):
-    rc = False
-    if state in cr_states :
-        ddb_table = get_table()
-        try:
+'''
+    A device row read once per invocation, with only the attributes the
+    rotation rules use. Writes go to the table and update the record.
+    read_ok is False when the read failed, as opposed to finding no row;
+    the request should then be retried, not answered from an empty record.
+'''
+class DeviceRecord():
+    attributes = ['SerialNumber', 'CrState', 'ManufacturerCertId', 'ManufacturerCertArn',
+        'ManufacturerCaCertId', 'VendorCertId', 'VendorCertArn', 'ManCertResponse']
+
+    def __init__(self, serial_number, item=None, read_ok=True):
+        self.serial_number = serial_number
+        self.found = item is not None
+        self.read_ok = read_ok
+        self.item = item or {}
 
-            response = ddb_table.get_item(Key={'SerialNumber':serial_number})
+    @classmethod
+    def load(cls, serial_number, consistent_read=DDB_CONSISTENT_READ):
+        try:
+            response = get_table().get_item(Key={'SerialNumber':serial_number},
+                ProjectionExpression=', '.join(cls.attributes),
+                ConsistentRead=consistent_read)
             item = response.get('Item', None)
-            if item:
-                item.update({'CrState':state})
-                ddb_table.put_item(Item=item)
+            logging.info('DeviceRecord.load(): item = {}'.format(item))
+        except Exception as e:
+            logging.error('DeviceRecord.load(): Exception = {}'.format(str(e)))
+            return cls(serial_number, None, read_ok=False)
+        return cls(serial_number, item)
+
+    '''
+        DeviceRecords for many serial numbers with BatchGetItem, DDB_BATCH_GET_SIZE
+        keys per call. Returns {serial_number: DeviceRecord}; rows that can't be
+        read are left out, so the caller falls back to load().
+    '''
+    @classmethod
+    def load_many(cls, serial_numbers, consistent_read=DDB_CONSISTENT_READ):
+        records = {}
+        serial_numbers = list(dict.fromkeys(serial_numbers))
+        for i in range(0, len(serial_numbers), DDB_BATCH_GET_SIZE):
+            keys = [{'SerialNumber':sn} for sn in serial_numbers[i:i + DDB_BATCH_GET_SIZE]]
+            request = {ddb_table_name: {
+                'Keys': keys,
+                'ProjectionExpression': ', '.join(cls.attributes),
+                'ConsistentRead': consistent_read
+                }}
+            try:
+                for attempt in range(DDB_BATCH_GET_MAX_ATTEMPTS):
+                    response = clients.get_resource('dynamodb').batch_get_item(RequestItems=request)
+                    for item in response.get('Responses', {}).get(ddb_table_name, []):
+                        records[item['SerialNumber']] = cls(item['SerialNumber'], item)
+                    request = response.get('UnprocessedKeys', None)
+                    if not request:
+                        break
+                    time.sleep(DDB_BATCH_GET_BACKOFF * (2 ** attempt))
+            except Exception as e:
+                logging.error('DeviceRecord.load_many(): Exception = {}'.format(str(e)))
+                continue
+
+            # Keys still unread were not found, or are left to load()
+            for key in keys:
+                sn = key['SerialNumber']
+                if sn not in records and not request:
+                    records[sn] = cls(sn, None)
+
+        logging.info('DeviceRecord.load_many(): {} of {} read'.format(len(records), len(serial_numbers)))
+        return records
+
+    @property
+    def state(self):
+        return self.item.get('CrState', None)
+
+    @property
+    def man_cert_id(self):
+        return self.item.get('ManufacturerCertId', '')
+
+    @property
+    def man_cert_arn(self):
+        return self.item.get('ManufacturerCertArn', '')
+
+    @property
+    def man_ca_cert_id(self):
+        return self.item.get('ManufacturerCaCertId', '')
+
+    @property
+    def vendor_cert_id(self):
+        return self.item.get('VendorCertId', '')
+
+    @property
+    def vendor_cert_arn(self):
+        return self.item.get('VendorCertArn', '')
+
+    '''
+        create-man-cert response payload, as first published, so a repeated
+        request is answered without rebuilding it
+    '''
+    @property
+    def man_cert_response(self):
+        return self.item.get('ManCertResponse', '')
+
+    '''
+        Move from expected_state (default: the state read at load) to
+        new_state, setting attributes in the same call. Returns UpdateResult.
+    '''
+    def transition(self, new_state, attributes=None, expected_state=None):
+        attributes = dict(attributes or {})
+        attributes['CrState'] = new_state
+        result = update_device(self.serial_number, attributes,
+            expected_state=expected_state or self.state)
+        if result.status == UPDATE_OK:
+            self.update_item(attributes)
+        return result
+
+    def update_item(self, attributes):
+        for name, value in attributes.items():
+            if value is None:
+                self.item.pop(name, None)
             else:
-                logging.error('write_state(): get_item failed for serial_number = {}'.\
-                    format(serial_number))
+                self.item[name] = value
 
-        except Exception as e:
-            logging.error('write_state(): Exception = {}'.format(str(e)))
-            pass
+    def write_state(self, state):
+        result = write_state(self.serial_number, state)
+        if result.status == UPDATE_OK:
+            self.update_item({'CrState':state})
+        return result
+
+    def write_man_cert_id(self, cert_id):
+        result = write_man_cert_id(self.serial_number, cert_id)
+        if result.status == UPDATE_OK:
+            self.update_item({'ManufacturerCertId':cert_id})
+        return result
+
+    def write_vendor_cert_id(self, cert_id):
+        result = write_vendor_cert_id(self.serial_number, cert_id)
+        if result.status == UPDATE_OK:
+            self.update_item({'VendorCertId':cert_id})
+        return result
+
+'''
+    Set attributes on an existing device row in one UpdateItem call.
+    Attributes with a None value are removed. With expected_state (one
+    state or a list), the row's CrState must match or nothing is written.
+'''
+def update_device(serial_number, attributes, expected_state=None):
+    names = {}
+    values = {}
+    set_actions = []
+    remove_actions = []
+    for i, (name, value) in enumerate(sorted(attributes.items())):
+        names['#a{}'.format(i)] = name
+        if value is None:
+            remove_actions.append('#a{}'.format(i))
+        else:
+            values[':v{}'.format(i)] = value
+            set_actions.append('#a{} = :v{}'.format(i, i))
+
+    update_expression = ''
+    if set_actions:
+        update_expression += 'SET {} '.format(', '.join(set_actions))
+    if remove_actions:
+        update_expression += 'REMOVE {}'.format(', '.join(remove_actions))
+
+    condition = 'attribute_exists(SerialNumber)'
+    if expected_state:
+        expected_states = expected_state if isinstance(expected_state, list) else [expected_state]
+        names['#state'] = 'CrState'
+        for i, state in enumerate(expected_states):
+            values[':e{}'.format(i)] = state
+        condition += ' AND #state IN ({})'.format(
+            ', '.join(':e{}'.format(i) for i in range(len(expected_states))))
+
+    update_args = {
+        'Key':{'SerialNumber':serial_number},
+        'UpdateExpression':update_expression.strip(),
+        'ConditionExpression':condition,
+        'ExpressionAttributeNames':names,
+        'ReturnValues':'ALL_NEW'
+        }
+    if values:
+        update_args['ExpressionAttributeValues'] = values
+
+    try:
+        response = get_table().update_item(**update_args)
+        return UpdateResult(UPDATE_OK, response.get('Attributes', None))
+    except Exception as e:
+        if clients.error_code(e) == 'ConditionalCheckFailedException':
+            logging.info('update_device(): {} not in state {}, {} not written'.\
+                format(serial_number, expected_state, list(attributes)))
+            return UpdateResult(UPDATE_CONFLICT, None)
+        logging.error('update_device(): Exception = {}'.format(str(e)))
+    return UpdateResult(UPDATE_ERROR, None)
+
+'''
+    Move serial_number from expected_state to new_state, setting attributes
+    in the same call, e.g.
+        transition(sn, CR_WHITELISTED, CR_THING_CREATED, {'VendorCertId':cert_id})
+'''
+def transition(serial_number, expected_state, new_state, attributes=None):
+    attributes = dict(attributes or {})
+    attributes['CrState'] = new_state
+    return update_device(serial_number, attributes, expected_state=expected_state)
+
+def write_state(serial_number, state):
+    if state not in cr_states :
+        logging.error('write_state(): bad state = {}'.format(state))
+        return UpdateResult(UPDATE_ERROR, None)
+    return update_device(serial_number, {'CrState':state})
 
 
 def read_state(serial_number):
@@ -94,19 +298,7 @@ def read_state(serial_number):
     return CrState
 
 def write_man_cert_id(serial_number, cert_id):
-    ddb_table = get_table()
-    try:
-        response = ddb_table.get_item(Key={'SerialNumber':serial_number})
-        item = response.get('Item', None)
-        if item:
-            item.update({'ManufacturerCertId':cert_id})
-            ddb_table.put_item(Item=item)
-        else:
-            logging.error('write_man_cert_id(): get_item failed for serial_number = {}'.\
-                    format(serial_number))
-
-    except Exception as e:
-        logging.error('write_man_cert_id(): Exception = {}'.format(str(e)))
+    return update_device(serial_number, {'ManufacturerCertId':cert_id})
 
 def read_man_ca_cert_id(serial_number):
     cert_id = None
@@ -134,26 +326,11 @@ def read_man_cert_id(serial_number):
         logging.error('read_man_cert_id(): Exception = {}'.format(str(e)))
     return cert_id
 
+'''
+    A cert_id of None removes VendorCertId from the row
+'''
 def write_vendor_cert_id(serial_number, cert_id):
-    ddb_table = get_table()
-    try:
-        response = ddb_table.get_item(Key={'SerialNumber':serial_number})
-        item = response.get('Item', None)
-        if item:
-            if cert_id:
-                item.update({'VendorCertId':cert_id})
-                logging.info('write_vendor_cert_id(): update')
-            else:
-                # If no cert_id then remove VendorCertId this field from the entry
-                logging.error('write_vendor_cert_id(): pop')
-                item.pop('VendorCertId')
-            ddb_table.put_item(Item=item)
-        else:
-            logging.error('write_vendor_cert_id(): get_item failed for serial_number = {}'.\
-                    format(serial_number))
-
-    except Exception as e:
-        logging.error('write_vendor_cert_id(): Exception = {}'.format(str(e)))
+    return update_device(serial_number, {'VendorCertId':cert_id or None})
 
 def read_vendor_cert_id(serial_number):
     cert_id = None
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+
+'''
+    filename: local_queue.py
+
+    In-process stand-in for the SQS queue and lambda event source mapping
+    of cfn_cert_rotation_sqs.json, for running sqs_handler.py locally:
+
+        queue = LocalQueue()
+        queue.send_message(event)
+        queue.run(sqs_cert_rotation_lambda)
+
+    Messages a batch reports in batchItemFailures go back on the queue, and
+    after max_receive_count receives they move to queue.dead_letters, the
+    way the RedrivePolicy does. Pair it with clients.set_client() and
+    clients.set_resource() stubs to keep AWS out of the loop.
+'''
+import json
+import uuid
+from collections import deque
+import logging
+from config import *
+
+class LocalQueue():
+    def __init__(self, batch_size=10, max_receive_count=5):
+        self.batch_size = batch_size
+        self.max_receive_count = max_receive_count
+        self.messages = deque()
+        self.receive_counts = {}
+        self.dead_letters = []
+
+    def __len__(self):
+        return len(self.messages)
+
+    '''
+        Queue event the way the IoT rule Sqs action does, as a JSON body.
+        Returns the message id.
+    '''
+    def send_message(self, event):
+        message_id = str(uuid.uuid4())
+        self.messages.append({
+            'messageId': message_id,
+            'receiptHandle': message_id,
+            'body': json.dumps(event),
+            'attributes': {},
+            'eventSource': 'aws:sqs'
+            })
+        return message_id
+
+    '''
+        Take up to batch_size messages as a lambda SQS event
+    '''
+    def receive_batch(self):
+        records = []
+        while self.messages and len(records) < self.batch_size:
+            record = self.messages.popleft()
+            count = self.receive_counts.get(record['messageId'], 0) + 1
+            self.receive_counts[record['messageId']] = count
+            record['attributes'] = {'ApproximateReceiveCount': str(count)}
+            records.append(record)
+        return {'Records': records}
+
+    '''
+        Requeue the batch's reported failures, or dead letter them once
+        they have been received max_receive_count times
+    '''
+    def complete_batch(self, sqs_event, response):
+        failed = set(failure['itemIdentifier']
+            for failure in (response or {}).get('batchItemFailures', []))
+        for record in sqs_event['Records']:
+            message_id = record['messageId']
+            if message_id not in failed:
+                self.receive_counts.pop(message_id, None)
+            elif self.receive_counts[message_id] >= self.max_receive_count:
+                self.receive_counts.pop(message_id, None)
+                self.dead_letters.append(record)
+            else:
+                self.messages.append(record)
+        return len(failed)
+
+    '''
+        Feed batches to handler(event, context) until the queue is empty.
+        Returns the number of batches.
+    '''
+    def run(self, handler, context=None):
+        batches = 0
+        while self.messages:
+            sqs_event = self.receive_batch()
+            try:
+                response = handler(sqs_event, context)
+            except Exception as e:
+                # An unhandled error fails the whole batch
+                logging.error('LocalQueue.run(): Exception = {}'.format(str(e)))
+                response = {'batchItemFailures': [{'itemIdentifier': record['messageId']}
+                    for record in sqs_event['Records']]}
+            failed = self.complete_batch(sqs_event, response)
+            batches += 1
+            logging.info('LocalQueue.run(): batch {} of {}, {} failed, {} queued'.\
+                format(batches, len(sqs_event['Records']), failed, len(self.messages)))
+        return batches
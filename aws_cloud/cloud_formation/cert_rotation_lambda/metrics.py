@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: metrics.py
+
+    CloudWatch metrics written as Embedded Metric Format log lines. Lambda
+    sends stdout to CloudWatch Logs, which turns each line into metrics,
+    so no PutMetricData call is made on the request path.
+
+        metrics.count('Requests', {'Rule':'create', 'Path':'replay'})
+'''
+import json
+import sys
+import threading
+import time
+from config import *
+
+lock = threading.Lock()
+
+'''
+    Emit value for metric name with the given dimensions
+'''
+def put_metric(name, value, unit='Count', dimensions={}):
+    if not METRICS_ENABLED:
+        return
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [sorted(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit}]
+                }]
+            },
+        name: value
+        }
+    record.update(dimensions)
+    line = json.dumps(record)
+    with lock:
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+def count(name, dimensions={}):
+    put_metric(name, 1, 'Count', dimensions)
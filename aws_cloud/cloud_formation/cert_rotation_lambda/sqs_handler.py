@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+
+'''
+    filename: sqs_handler.py
+
+    Alternate entry point for cfn_cert_rotation_sqs.json. The IoT rules
+    send their events to an SQS queue and this lambda receives them in
+    batches, instead of one invocation per MQTT message.
+
+    Each SQS message body is the same event cert_rotation_lambda() gets.
+    A batch is processed as:
+        drop the events admission.admit() rejects, failing the ones it
+            can't decide on; redelivered messages aren't rate limited again
+        group the events by serial number, keeping queue order
+        process the registered events, which move rows to CR_THING_CREATED
+        read all the device rows with BatchGetItem
+        process the groups on up to SQS_MAX_WORKERS threads, each
+            group's events one after the other
+        return the message ids that failed as batchItemFailures, so SQS
+            delivers only those again
+
+    Once an event for a serial number fails, the events after it in the
+    batch for that serial number are failed too, so they are delivered
+    again in order.
+'''
+import json
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from config import *
+from dyn_db import DeviceRecord
+from cert_rotation_lambda import process_event, get_event_serial_number
+from cr_rules_misc import seed_arn_parts
+from admission import admit
+
+'''
+    Parse the batch into [(message_id, event)]. A body that isn't JSON can
+    never succeed, so it is logged and dropped rather than retried.
+'''
+def get_batch_events(sqs_event):
+    events = []
+    for record in sqs_event.get('Records', []):
+        message_id = record.get('messageId', None)
+        try:
+            events.append((message_id, json.loads(record.get('body', ''))))
+        except Exception as e:
+            logging.error('get_batch_events(): dropping {}: {}'.format(message_id, str(e)))
+    return events
+
+'''
+    Message ids SQS has delivered before, i.e. ApproximateReceiveCount > 1
+'''
+def get_redelivered_ids(sqs_event):
+    redelivered = set()
+    for record in sqs_event.get('Records', []):
+        try:
+            receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+        except ValueError:
+            receive_count = 1
+        if receive_count > 1:
+            redelivered.add(record.get('messageId', None))
+    return redelivered
+
+'''
+    Group [(message_id, event)] by serial number, keeping queue order within
+    each group. Registered events carry no serial number; each is its own group.
+'''
+def group_events(events):
+    groups = {}
+    for message_id, event in events:
+        serial_number = get_event_serial_number(event)
+        key = serial_number if serial_number else 'msg:{}'.format(message_id)
+        groups.setdefault(key, []).append((message_id, event))
+    return groups
+
+'''
+    Process one serial number's events in order. Returns the failed message ids.
+'''
+def process_group(group, device_record):
+    failed = []
+    for message_id, event in group:
+        if failed:
+            failed.append(message_id)
+            continue
+        try:
+            rc = process_event(event, device_record=device_record, admitted=True)
+        except Exception as e:
+            logging.error('process_group(): {} Exception = {}'.format(message_id, str(e)))
+            rc = False
+        if not rc:
+            failed.append(message_id)
+        # The rules' transitions update device_record, so the next event for
+        # this serial number sees this one's writes without another read
+    return failed
+
+'''
+    Run [(message_id, event)] through admission.admit(). Returns (admitted
+    events, failed message ids). An event admit() raises on is failed, with
+    the events after it for the same serial number, so they are retried.
+    Events whose message id is in redelivered skip the rate limit.
+'''
+def admit_events(events, redelivered=()):
+    admitted = []
+    failed = []
+    failed_serial_numbers = set()
+    for message_id, event in events:
+        serial_number = get_event_serial_number(event)
+        if serial_number and serial_number in failed_serial_numbers:
+            failed.append(message_id)
+            continue
+        try:
+            if not admit(event, serial_number, message_id in redelivered):
+                admitted.append((message_id, event))
+        except Exception as e:
+            logging.error('admit_events(): {} Exception = {}'.format(message_id, str(e)))
+            failed.append(message_id)
+            failed_serial_numbers.add(serial_number)
+    return admitted, failed
+
+def sqs_cert_rotation_lambda(event, context):
+    seed_arn_parts(context)
+    events = get_batch_events(event)
+    # Rejected events are deleted from the queue, before their rows are read
+    admitted, failed = admit_events(events, get_redelivered_ids(event))
+    rejected = len(events) - len(admitted) - len(failed)
+    groups = group_events(admitted)
+    serial_numbers = [key for key in groups if not key.startswith('msg:')]
+
+    with ThreadPoolExecutor(max_workers=SQS_MAX_WORKERS) as executor:
+        # Registered events first, so a create request in the same batch
+        # reads the row they wrote
+        futures = [executor.submit(process_group, group, None)
+            for key, group in groups.items() if key.startswith('msg:')]
+        for future in futures:
+            failed.extend(future.result())
+
+        records = DeviceRecord.load_many(serial_numbers)
+        futures = [executor.submit(process_group, groups[key], records.get(key, None))
+            for key in serial_numbers]
+        for future in futures:
+            failed.extend(future.result())
+
+    logging.info('sqs_cert_rotation_lambda(): {} events, {} rejected, {} serial numbers, {} failed'.\
+        format(len(events), rejected, len(serial_numbers), len(failed)))
+
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]}
@@ -0,0 +1,209 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: conftest.py
+
+    pytest setup for the cert rotation lambda. The lambda's modules import
+    each other by name, so its directory goes first on sys.path. The aws
+    fixture installs load_test/fake_aws.py's stand-ins with the clients.py
+    test hooks; aws_ca also registers a Manufacturer CA in the fake IoT and
+    SSM, and needs a pyOpenSSL that still signs CSRs.
+
+    Usage:
+        > python -m pytest aws_cloud/cloud_formation/cert_rotation_lambda/tests
+'''
+import os
+import sys
+import pytest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+lambda_dir = os.path.dirname(tests_dir)
+repo_dir = os.path.dirname(os.path.dirname(os.path.dirname(lambda_dir)))
+load_test_dir = os.path.join(repo_dir, 'load_test')
+
+'''
+    Forget modules another directory of the repo loaded under the same name
+    (config, local_json, ...) so this directory's are imported instead
+'''
+def forget_other_modules(component_dir):
+    for name, module in list(sys.modules.items()):
+        module_dir = os.path.dirname(getattr(module, '__file__', None) or '')
+        if module_dir.startswith(repo_dir) and module_dir != component_dir and \
+                os.path.basename(module_dir) != 'tests':
+            del sys.modules[name]
+
+# This directory's modules, kept for its tests when several directories
+# are collected in one session
+component_modules = {}
+
+'''
+    Put this directory's modules back in sys.modules and its paths first on
+    sys.path. Process pool workers unpickle functions by module name.
+'''
+def use_component():
+    forget_other_modules(lambda_dir)
+    sys.modules.update(component_modules)
+    for path in [load_test_dir, lambda_dir]:
+        if path in sys.path:
+            sys.path.remove(path)
+        sys.path.insert(0, path)
+
+def pytest_collectstart(collector):
+    if str(collector.path).startswith(tests_dir):
+        use_component()
+
+def keep_component_modules():
+    for name, module in list(sys.modules.items()):
+        if os.path.dirname(getattr(module, '__file__', None) or '') == lambda_dir:
+            component_modules[name] = module
+
+def pytest_collectreport(report):
+    keep_component_modules()
+
+@pytest.fixture(autouse=True)
+def component():
+    use_component()
+
+use_component()
+
+import admission
+import certs
+import clients
+import cr_rules_misc
+import dyn_db
+import fake_aws
+keep_component_modules()
+
+def pytest_configure(config):
+    # Deprecated, not yet removed, on the pyOpenSSL versions that have it
+    config.addinivalue_line('filterwarnings',
+        'ignore:CSR support in pyOpenSSL is deprecated:DeprecationWarning')
+
+'''
+    pyOpenSSL with the X509Req API the lambda signs CSRs with, or skip
+'''
+def get_crypto():
+    crypto = pytest.importorskip('OpenSSL.crypto')
+    if not hasattr(crypto, 'load_certificate_request'):
+        pytest.skip('pyOpenSSL {} has no load_certificate_request'.format(
+            sys.modules['OpenSSL'].__version__))
+    return crypto
+
+class Publishes:
+    """
+    Broker for FakeIotData: keeps (topic, payload) of each publish
+    """
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload, qos):
+        self.messages.append((topic, payload))
+
+    def topics(self):
+        return [topic for topic, payload in self.messages]
+
+class Ca:
+    """
+    A self-signed CA and its key; the key also serves as every device key
+    """
+    def __init__(self, crypto, cn):
+        self.crypto = crypto
+        self.key = crypto.PKey()
+        self.key.generate_key(crypto.TYPE_RSA, 2048)
+        self.key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, self.key).decode()
+        self.cert = self.sign(self.key, cn, self_signed=True)
+        self.cert_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, self.cert).decode()
+
+    def sign(self, pubkey, cn, self_signed=False):
+        cert = self.crypto.X509()
+        cert.get_subject().CN = cn
+        cert.set_serial_number(int.from_bytes(os.urandom(8), 'big'))
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(24 * 60 * 60)
+        cert.set_issuer(cert.get_subject() if self_signed else self.cert.get_subject())
+        cert.set_pubkey(pubkey)
+        cert.sign(self.key, 'sha256')
+        return cert
+
+    def cert_pem_for(self, cn):
+        return self.crypto.dump_certificate(self.crypto.FILETYPE_PEM, self.sign(self.key, cn)).decode()
+
+    def csr_pem(self, cn, key=None):
+        req = self.crypto.X509Req()
+        req.get_subject().CN = cn
+        req.set_pubkey(key or self.key)
+        req.sign(key or self.key, 'sha256')
+        return self.crypto.dump_certificate_request(self.crypto.FILETYPE_PEM, req).decode()
+
+@pytest.fixture(scope='session')
+def man_ca():
+    return Ca(get_crypto(), 'TestManufacturerCA')
+
+class Aws:
+    """
+    The installed fakes, with helpers to seed device rows and vendor certs
+    """
+    def __init__(self):
+        self.table = fake_aws.FakeTable(dyn_db.ddb_table_name)
+        self.iot = fake_aws.FakeIot()
+        self.ssm = fake_aws.FakeSsm()
+        self.publishes = Publishes()
+        self.man_ca = None
+        self.man_ca_id = None
+
+    def add_man_ca(self, man_ca):
+        self.man_ca = man_ca
+        self.man_ca_id = self.iot.add_ca_certificate(man_ca.cert_pem)
+        self.ssm.parameters['cr-ca-key-{}'.format(self.man_ca_id)] = man_ca.key_pem
+
+    def add_device(self, serial_number, state, **attributes):
+        row = {'SerialNumber':serial_number, 'CrState':state}
+        if self.man_ca_id:
+            row['ManufacturerCaCertId'] = self.man_ca_id
+        row.update(attributes)
+        self.table.rows[serial_number] = row
+        return row
+
+    def add_vendor_cert(self, serial_number):
+        return self.iot.add_certificate(self.man_ca.cert_pem_for(serial_number), None,
+            'PENDING_ACTIVATION')
+
+@pytest.fixture
+def aws():
+    fakes = Aws()
+    clients.reset()
+    clients.set_resource('dynamodb', fake_aws.FakeDynamoDB({fakes.table.table_name: fakes.table}))
+    clients.set_table(fakes.table.table_name, fakes.table)
+    clients.set_client('iot', fakes.iot)
+    clients.set_client('ssm', fakes.ssm)
+    clients.set_client('iot-data', fake_aws.FakeIotData(fakes.publishes))
+
+    certs.invalidate_ca_cache()
+    cr_rules_misc.cert_cache.clear()
+    cr_rules_misc.arn_parts.clear()
+    cr_rules_misc.arn_parts.update({'partition':'aws', 'region':fake_aws.REGION,
+        'account':fake_aws.ACCOUNT})
+    admission.request_counts.clear()
+    yield fakes
+    clients.reset()
+
+@pytest.fixture
+def aws_ca(aws, man_ca):
+    aws.add_man_ca(man_ca)
+    return aws
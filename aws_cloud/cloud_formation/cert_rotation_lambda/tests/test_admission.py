@@ -0,0 +1,102 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_admission.py
+
+    CSR reject reasons and the per serial number rate limit
+'''
+import pytest
+import admission
+from admission import *
+from config import *
+
+def create_event(serial_number, csr):
+    return {'topic':'/cert-rotation/create-man-cert/{}/rqst'.format(serial_number),
+        'data':{'serial_number':serial_number, 'csr':csr}}
+
+def ack_event(serial_number):
+    return {'topic':'/cert-rotation/ack-man-cert/{}/rqst'.format(serial_number),
+        'data':{'serial_number':serial_number, 'cert_id':'c1'}}
+
+@pytest.fixture(autouse=True)
+def clear_counts():
+    admission.request_counts.clear()
+
+def new_key(crypto, key_type, bits):
+    key = crypto.PKey()
+    key.generate_key(key_type, bits)
+    return key
+
+def test_csr_accepted(man_ca):
+    assert check_csr('SN1', man_ca.csr_pem('SN1')) is None
+
+def test_csr_missing_or_too_large():
+    assert check_csr('SN1', None) == REJECT_NO_CSR
+    assert check_csr('SN1', {'pem':'not a string'}) == REJECT_NO_CSR
+    assert check_csr('SN1', 'A' * (ADMISSION_MAX_CSR_BYTES + 1)) == REJECT_CSR_SIZE
+
+def test_csr_malformed(man_ca):
+    assert check_csr('SN1', 'not a csr') == REJECT_CSR_MALFORMED
+    truncated = man_ca.csr_pem('SN1').splitlines()
+    assert check_csr('SN1', '\n'.join(truncated[:3] + truncated[-1:])) == REJECT_CSR_MALFORMED
+
+def test_csr_signed_by_another_key(man_ca):
+    crypto = man_ca.crypto
+    req = crypto.X509Req()
+    req.get_subject().CN = 'SN1'
+    req.set_pubkey(new_key(crypto, crypto.TYPE_RSA, 2048))
+    req.sign(man_ca.key, 'sha256')
+    csr = crypto.dump_certificate_request(crypto.FILETYPE_PEM, req).decode()
+
+    assert check_csr('SN1', csr) == REJECT_CSR_SIGNATURE
+
+def test_csr_cn_mismatch(man_ca):
+    assert check_csr('SN1', man_ca.csr_pem('SN2')) == REJECT_CN
+
+def test_csr_key_not_allowed(man_ca):
+    crypto = man_ca.crypto
+    assert check_csr('SN1', man_ca.csr_pem('SN1', new_key(crypto, crypto.TYPE_RSA, 1024))) == \
+        REJECT_KEY
+
+def test_rate_limit_per_serial_number():
+    for i in range(ADMISSION_RATE_MAX):
+        assert admit(ack_event('SN1'), 'SN1') is None
+    assert admit(ack_event('SN1'), 'SN1') == REJECT_RATE
+    assert admit(ack_event('SN2'), 'SN2') is None
+
+def test_rate_limit_window_expires():
+    now = 1000.0
+    for i in range(ADMISSION_RATE_MAX):
+        assert count_request('SN1', now)
+    assert not count_request('SN1', now + 1)
+    assert count_request('SN1', now + ADMISSION_RATE_WINDOW)
+
+def test_redeliveries_are_not_counted():
+    for i in range(ADMISSION_RATE_MAX):
+        assert admit(ack_event('SN1'), 'SN1') is None
+    assert admit(ack_event('SN1'), 'SN1', redelivered=True) is None
+    assert admit(ack_event('SN1'), 'SN1') == REJECT_RATE
+
+def test_redelivered_create_still_checks_csr():
+    assert admit(create_event('SN1', None), 'SN1', redelivered=True) == REJECT_NO_CSR
+
+def test_rate_limit_before_csr_parse(man_ca):
+    for i in range(ADMISSION_RATE_MAX):
+        admit(create_event('SN1', 'not a csr'), 'SN1')
+    assert admit(create_event('SN1', man_ca.csr_pem('SN1')), 'SN1') == REJECT_RATE
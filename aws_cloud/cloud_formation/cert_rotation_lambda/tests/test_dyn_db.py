@@ -0,0 +1,110 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_dyn_db.py
+
+    Conditional device row updates and DeviceRecord reads
+'''
+import clients
+import fake_aws
+from config import *
+from dyn_db import *
+
+class FailingTable:
+    def get_item(self, **kwargs):
+        raise fake_aws.FakeClientError('ProvisionedThroughputExceededException', 'GetItem')
+
+    def update_item(self, **kwargs):
+        raise fake_aws.FakeClientError('ProvisionedThroughputExceededException', 'UpdateItem')
+
+def test_update_device_ok_sets_and_removes(aws):
+    aws.add_device('SN1', CR_THING_CREATED, VendorCertId='v1')
+
+    result = update_device('SN1', {'ManufacturerCertId':'m1', 'VendorCertId':None},
+        expected_state=CR_THING_CREATED)
+
+    assert result.status == UPDATE_OK
+    assert result.item['ManufacturerCertId'] == 'm1'
+    assert 'VendorCertId' not in aws.table.rows['SN1']
+    assert aws.table.calls == {'UpdateItem': 1}
+
+def test_update_device_any_of_expected_states(aws):
+    aws.add_device('SN1', CR_MAN_CERT_CREATED)
+
+    result = update_device('SN1', {'CrState':CR_CERT_ROTATION_COMPLETED},
+        expected_state=[CR_THING_CREATED, CR_MAN_CERT_CREATED])
+
+    assert result.status == UPDATE_OK
+    assert aws.table.rows['SN1']['CrState'] == CR_CERT_ROTATION_COMPLETED
+
+def test_update_device_conflict_on_wrong_state(aws):
+    aws.add_device('SN1', CR_WHITELISTED)
+
+    result = transition('SN1', CR_THING_CREATED, CR_MAN_CERT_CREATED, {'ManufacturerCertId':'m1'})
+
+    assert result == UpdateResult(UPDATE_CONFLICT, None)
+    assert aws.table.rows['SN1']['CrState'] == CR_WHITELISTED
+    assert 'ManufacturerCertId' not in aws.table.rows['SN1']
+
+def test_update_device_conflict_on_missing_row(aws):
+    assert write_man_cert_id('SN1', 'm1').status == UPDATE_CONFLICT
+    assert 'SN1' not in aws.table.rows
+
+def test_update_device_error(aws):
+    clients.set_table(ddb_table_name, FailingTable())
+
+    assert update_device('SN1', {'CrState':CR_THING_CREATED}).status == UPDATE_ERROR
+
+def test_write_state_rejects_unknown_state(aws):
+    aws.add_device('SN1', CR_WHITELISTED)
+
+    assert write_state('SN1', 'CR_BOGUS').status == UPDATE_ERROR
+    assert aws.table.calls == {}
+
+def test_record_transition_updates_record_only_on_ok(aws):
+    aws.add_device('SN1', CR_THING_CREATED)
+    record = DeviceRecord.load('SN1')
+
+    assert record.transition(CR_MAN_CERT_CREATED, {'ManufacturerCertId':'m1'}).status == UPDATE_OK
+    assert (record.state, record.man_cert_id) == (CR_MAN_CERT_CREATED, 'm1')
+
+    # Expected state is now CR_MAN_CERT_CREATED; move the row behind the record's back
+    aws.table.rows['SN1']['CrState'] = CR_CERT_ROTATION_COMPLETED
+    assert record.transition(CR_CERT_ROTATION_COMPLETED, {'ManufacturerCertId':None}).status == \
+        UPDATE_CONFLICT
+    assert record.man_cert_id == 'm1'
+
+def test_load_missing_row_vs_failed_read(aws):
+    record = DeviceRecord.load('SN1')
+    assert (record.found, record.read_ok) == (False, True)
+
+    clients.set_table(ddb_table_name, FailingTable())
+    record = DeviceRecord.load('SN1')
+    assert (record.found, record.read_ok) == (False, False)
+
+def test_load_many_reads_found_and_missing_rows(aws):
+    aws.add_device('SN1', CR_THING_CREATED)
+    aws.add_device('SN2', CR_MAN_CERT_CREATED)
+
+    records = DeviceRecord.load_many(['SN1', 'SN2', 'SN3', 'SN1'])
+
+    assert {sn: record.state for sn, record in records.items()} == \
+        {'SN1': CR_THING_CREATED, 'SN2': CR_MAN_CERT_CREATED, 'SN3': None}
+    assert not records['SN3'].found
+    assert aws.table.calls == {'BatchGetItem': 1}
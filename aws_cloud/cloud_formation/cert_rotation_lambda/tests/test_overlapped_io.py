@@ -0,0 +1,141 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_overlapped_io.py
+
+    CR_OVERLAP_IO create-man-cert, discarding its cert on failure, and the
+    CR_CLEANUP_QUEUE_URL ack with its deferred vendor cert teardown
+'''
+import json
+import pytest
+import clients
+import cleanup_handler
+import cr_rules
+import cr_rules_misc
+import fake_aws
+from config import *
+from dyn_db import DeviceRecord
+
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/123456789012/cleanup'
+
+class ListQueue:
+    def __init__(self):
+        self.bodies = []
+
+    def send_body(self, body):
+        self.bodies.append(json.loads(body))
+        return 'q{}'.format(len(self.bodies))
+
+@pytest.fixture
+def overlap(aws_ca, monkeypatch):
+    monkeypatch.setattr(cr_rules, 'CR_OVERLAP_IO', True)
+    aws_ca.add_device('SN1', CR_THING_CREATED)
+    return aws_ca
+
+@pytest.fixture
+def cleanup_queue(aws, monkeypatch):
+    queue = ListQueue()
+    clients.set_client('sqs', fake_aws.FakeSqs({QUEUE_URL: queue}))
+    monkeypatch.setattr(cr_rules, 'CR_CLEANUP_QUEUE_URL', QUEUE_URL)
+    monkeypatch.setattr(cr_rules_misc, 'CR_CLEANUP_QUEUE_URL', QUEUE_URL)
+    return queue
+
+def fail(operation):
+    def call(**kwargs):
+        raise fake_aws.FakeClientError('ThrottlingException', operation)
+    return call
+
+def test_create_attaches_then_transitions(overlap):
+    assert cr_rules.cr_rule_create_man_cert(overlap.man_ca.csr_pem('SN1'), 'SN1')
+
+    row = overlap.table.rows['SN1']
+    assert row['CrState'] == CR_MAN_CERT_CREATED
+    cert = overlap.iot.certs[row['ManufacturerCertId']]
+    assert cert['policies'] == {cert_pol_name_complete}
+    assert overlap.iot.principals['SN1'] == {cert['certificateArn']}
+    assert json.loads(row['ManCertResponse'])['cert_id'] == row['ManufacturerCertId']
+    assert overlap.publishes.messages == [('/cert-rotation/create-man-cert/SN1/rspn',
+        row['ManCertResponse'])]
+
+def test_attach_failure_discards_cert(overlap, monkeypatch):
+    monkeypatch.setattr(overlap.iot, 'attach_thing_principal', fail('AttachThingPrincipal'))
+
+    assert not cr_rules.cr_rule_create_man_cert(overlap.man_ca.csr_pem('SN1'), 'SN1')
+
+    assert overlap.iot.certs == {}
+    assert overlap.table.rows['SN1']['CrState'] == CR_THING_CREATED
+    assert overlap.publishes.messages == []
+
+def test_lost_race_discards_cert(overlap):
+    record = DeviceRecord.load('SN1')
+    # A concurrent retry finished first
+    overlap.table.rows['SN1'].update({'CrState':CR_MAN_CERT_CREATED, 'ManufacturerCertId':'other'})
+
+    assert not cr_rules.cr_rule_create_man_cert(overlap.man_ca.csr_pem('SN1'), 'SN1',
+        device_record=record)
+
+    assert overlap.iot.certs == {}
+    assert overlap.iot.principals['SN1'] == set()
+    assert overlap.table.rows['SN1']['ManufacturerCertId'] == 'other'
+    assert overlap.publishes.messages == []
+
+def test_delete_cert_runs_every_step(aws_ca, monkeypatch):
+    cert_id = aws_ca.add_vendor_cert('SN1')
+    monkeypatch.setattr(aws_ca.iot, 'detach_thing_principal', fail('DetachThingPrincipal'))
+
+    assert cr_rules_misc.delete_cert('SN1', cert_id, fake_aws.cert_arn_of(cert_id))
+    assert aws_ca.iot.certs == {}
+
+    # Already gone counts as done
+    assert cr_rules_misc.delete_cert('SN1', cert_id, fake_aws.cert_arn_of(cert_id))
+
+def test_delete_cert_fails_when_delete_fails(aws_ca, monkeypatch):
+    cert_id = aws_ca.add_vendor_cert('SN1')
+    monkeypatch.setattr(aws_ca.iot, 'delete_certificate', fail('DeleteCertificate'))
+
+    assert not cr_rules_misc.delete_cert('SN1', cert_id, fake_aws.cert_arn_of(cert_id))
+    assert aws_ca.iot.certs[cert_id]['status'] == 'INACTIVE'
+
+def test_ack_queues_vendor_cert_teardown(aws_ca, cleanup_queue):
+    vendor_cert_id = aws_ca.add_vendor_cert('SN1')
+    aws_ca.add_device('SN1', CR_MAN_CERT_CREATED, ManufacturerCertId='m1',
+        VendorCertId=vendor_cert_id, ManCertResponse='{}')
+
+    assert cr_rules.cr_rule_ack_man_cert('SN1', 'm1')
+
+    row = aws_ca.table.rows['SN1']
+    assert row['CrState'] == CR_CERT_ROTATION_COMPLETED
+    assert 'ManCertResponse' not in row
+    # Torn down later, off the device's critical path
+    assert vendor_cert_id in aws_ca.iot.certs and row['VendorCertId'] == vendor_cert_id
+    assert aws_ca.publishes.topics() == ['/cert-rotation/ack-man-cert/SN1/rspn']
+    assert cleanup_queue.bodies == [{'action':'teardown_vendor_cert', 'serial_number':'SN1',
+        'cert_id':vendor_cert_id, 'cert_arn':None}]
+
+    assert cleanup_handler.process_cleanup(cleanup_queue.bodies[0])
+    assert vendor_cert_id not in aws_ca.iot.certs
+    assert 'VendorCertId' not in aws_ca.table.rows['SN1']
+
+def test_ack_fails_when_cleanup_not_queued(aws, cleanup_queue, monkeypatch):
+    monkeypatch.setattr(cr_rules_misc, 'CR_CLEANUP_QUEUE_URL', QUEUE_URL + '-missing')
+    aws.add_device('SN1', CR_MAN_CERT_CREATED, ManufacturerCertId='m1', VendorCertId='v1')
+
+    # Published, but failed so the request comes again and the send is retried
+    assert not cr_rules.cr_rule_ack_man_cert('SN1', 'm1')
+    assert aws.publishes.topics() == ['/cert-rotation/ack-man-cert/SN1/rspn']
@@ -0,0 +1,82 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_replay.py
+
+    Repeated create-man-cert and ack-man-cert requests: answered from the
+    stored response, or rebuilt from the cert for rows written without one
+'''
+import json
+import cert_rotation_lambda
+from config import *
+
+def create_event(serial_number, csr='unused on replay'):
+    return {'topic':'/cert-rotation/create-man-cert/{}/rqst'.format(serial_number),
+        'data':{'serial_number':serial_number, 'csr':csr}}
+
+def ack_event(serial_number, cert_id):
+    return {'topic':'/cert-rotation/ack-man-cert/{}/rqst'.format(serial_number),
+        'data':{'serial_number':serial_number, 'cert_id':cert_id}}
+
+def test_create_replay_publishes_stored_response(aws):
+    stored = json.dumps({'pem':'PEM', 'cert_id':'m1'})
+    aws.add_device('SN1', CR_MAN_CERT_CREATED, ManufacturerCertId='m1', ManCertResponse=stored)
+
+    assert cert_rotation_lambda.process_event(create_event('SN1'), admitted=True)
+
+    assert aws.publishes.messages == [('/cert-rotation/create-man-cert/SN1/rspn', stored)]
+    assert aws.iot.calls == {}
+    assert aws.table.calls == {'GetItem': 1}
+
+def test_create_replay_rebuilds_response_without_stored_one(aws_ca):
+    man_cert_pem = aws_ca.man_ca.cert_pem_for('SN1')
+    man_cert_id = aws_ca.iot.add_certificate(man_cert_pem, aws_ca.man_ca_id)
+    aws_ca.add_device('SN1', CR_MAN_CERT_CREATED, ManufacturerCertId=man_cert_id)
+
+    assert cert_rotation_lambda.process_event(create_event('SN1'), admitted=True)
+
+    topic, payload = aws_ca.publishes.messages[0]
+    assert topic == '/cert-rotation/create-man-cert/SN1/rspn'
+    assert json.loads(payload) == {'pem':man_cert_pem, 'cert_id':man_cert_id}
+    assert aws_ca.iot.calls == {'DescribeCertificate': 1}
+    # Nothing is registered or written again
+    assert aws_ca.table.calls == {'GetItem': 1}
+
+def test_create_replay_fails_when_cert_is_gone(aws):
+    aws.add_device('SN1', CR_MAN_CERT_CREATED, ManufacturerCertId='m1')
+
+    assert not cert_rotation_lambda.process_event(create_event('SN1'), admitted=True)
+    assert aws.publishes.messages == []
+
+def test_ack_replay_publishes_stored_cert_id(aws):
+    aws.add_device('SN1', CR_CERT_ROTATION_COMPLETED, ManufacturerCertId='m1')
+
+    assert cert_rotation_lambda.process_event(ack_event('SN1', 'm1'), admitted=True)
+
+    assert [(topic, json.loads(payload)) for topic, payload in aws.publishes.messages] == \
+        [('/cert-rotation/ack-man-cert/SN1/rspn', {'cert_id':'m1'})]
+    assert aws.iot.calls == {}
+    assert aws.table.calls == {'GetItem': 1}
+
+def test_ack_for_another_cert_is_not_answered(aws):
+    aws.add_device('SN1', CR_CERT_ROTATION_COMPLETED, ManufacturerCertId='m1')
+
+    cert_rotation_lambda.process_event(ack_event('SN1', 'm2'), admitted=True)
+
+    assert aws.publishes.messages == []
@@ -0,0 +1,156 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_sqs_handler.py
+
+    SQS batch parsing, grouping by serial number, and batchItemFailures
+'''
+import json
+import sqs_handler
+from config import *
+
+def create_event(serial_number, csr=None):
+    return {'topic':'/cert-rotation/create-man-cert/{}/rqst'.format(serial_number),
+        'data':{'serial_number':serial_number, 'csr':csr}}
+
+def ack_event(serial_number, cert_id):
+    return {'topic':'/cert-rotation/ack-man-cert/{}/rqst'.format(serial_number),
+        'data':{'serial_number':serial_number, 'cert_id':cert_id}}
+
+def registered_event(ca_cert_id, cert_id):
+    return {'topic':'$aws/events/certificates/registered/{}'.format(ca_cert_id),
+        'data':{'certificateId':cert_id, 'caCertificateId':ca_cert_id,
+            'certificateStatus':'PENDING_ACTIVATION'}}
+
+'''
+    SQS event with one record per body, message ids m0, m1, ...
+'''
+def sqs_event(*events, receive_count=1):
+    return {'Records': [{'messageId':'m{}'.format(i),
+        'body':event if isinstance(event, str) else json.dumps(event),
+        'attributes':{'ApproximateReceiveCount':str(receive_count)}}
+        for i, event in enumerate(events)]}
+
+def failed_ids(response):
+    return sorted(failure['itemIdentifier'] for failure in response['batchItemFailures'])
+
+def test_get_batch_events_drops_bodies_that_are_not_json():
+    events = sqs_handler.get_batch_events(sqs_event(ack_event('SN1', 'c1'), '{not json'))
+
+    assert events == [('m0', ack_event('SN1', 'c1'))]
+
+def test_group_events_by_serial_number_in_queue_order():
+    events = sqs_handler.get_batch_events(sqs_event(
+        create_event('SN1'), registered_event('ca', 'v1'), ack_event('SN2', 'c2'),
+        ack_event('SN1', 'c1'), registered_event('ca', 'v2')))
+
+    groups = sqs_handler.group_events(events)
+
+    assert {key: [message_id for message_id, event in group] for key, group in groups.items()} == \
+        {'SN1': ['m0', 'm3'], 'msg:m1': ['m1'], 'SN2': ['m2'], 'msg:m4': ['m4']}
+
+def test_failed_event_fails_later_events_for_its_serial_number(aws, monkeypatch):
+    processed = []
+    def process_event(event, device_record=None, admitted=False):
+        processed.append((event['data']['serial_number'], event['data']['cert_id']))
+        return event['data']['cert_id'] != 'fail'
+    monkeypatch.setattr(sqs_handler, 'process_event', process_event)
+
+    response = sqs_handler.sqs_cert_rotation_lambda(sqs_event(
+        ack_event('SN1', 'fail'), ack_event('SN2', 'ok'), ack_event('SN1', 'ok'),
+        ack_event('SN2', 'ok')), None)
+
+    assert failed_ids(response) == ['m0', 'm2']
+    assert sorted(processed) == [('SN1', 'fail'), ('SN2', 'ok'), ('SN2', 'ok')]
+
+def test_exception_fails_the_event(aws, monkeypatch):
+    def process_event(event, device_record=None, admitted=False):
+        raise RuntimeError('boom')
+    monkeypatch.setattr(sqs_handler, 'process_event', process_event)
+
+    response = sqs_handler.sqs_cert_rotation_lambda(sqs_event(ack_event('SN1', 'c1')), None)
+
+    assert failed_ids(response) == ['m0']
+
+def test_admission_error_fails_later_events_for_its_serial_number(aws, monkeypatch):
+    def admit(event, serial_number, redelivered=False):
+        if event['data']['cert_id'] == 'fail':
+            raise RuntimeError('boom')
+        return None
+    monkeypatch.setattr(sqs_handler, 'admit', admit)
+    monkeypatch.setattr(sqs_handler, 'process_event', lambda event, **kwargs: True)
+
+    response = sqs_handler.sqs_cert_rotation_lambda(sqs_event(
+        ack_event('SN1', 'fail'), ack_event('SN1', 'ok'), ack_event('SN2', 'ok')), None)
+
+    assert failed_ids(response) == ['m0', 'm1']
+
+def test_rejected_events_are_not_failed(aws):
+    aws.add_device('SN1', CR_THING_CREATED)
+
+    response = sqs_handler.sqs_cert_rotation_lambda(sqs_event(create_event('SN1', csr=None)), None)
+
+    assert failed_ids(response) == []
+    assert aws.table.calls == {}
+
+def test_ack_replays_read_with_one_batch_get(aws):
+    for sn in ['SN1', 'SN2']:
+        aws.add_device(sn, CR_CERT_ROTATION_COMPLETED, ManufacturerCertId='c{}'.format(sn))
+
+    response = sqs_handler.sqs_cert_rotation_lambda(sqs_event(
+        ack_event('SN1', 'cSN1'), ack_event('SN2', 'cSN2')), None)
+
+    assert failed_ids(response) == []
+    assert aws.table.calls == {'BatchGetItem': 1}
+    assert sorted(aws.publishes.topics()) == ['/cert-rotation/ack-man-cert/SN1/rspn',
+        '/cert-rotation/ack-man-cert/SN2/rspn']
+
+def test_create_before_registered_event_is_retried(aws_ca):
+    aws_ca.add_device('SN1', CR_WHITELISTED)
+    csr = aws_ca.man_ca.csr_pem('SN1')
+
+    response = sqs_handler.sqs_cert_rotation_lambda(sqs_event(create_event('SN1', csr)), None)
+
+    assert failed_ids(response) == ['m0']
+    assert aws_ca.table.rows['SN1']['CrState'] == CR_WHITELISTED
+
+def test_registered_event_runs_before_create_in_same_batch(aws_ca):
+    aws_ca.add_device('SN1', CR_WHITELISTED)
+    vendor_cert_id = aws_ca.add_vendor_cert('SN1')
+    csr = aws_ca.man_ca.csr_pem('SN1')
+
+    # The create request is first in the queue
+    response = sqs_handler.sqs_cert_rotation_lambda(sqs_event(
+        create_event('SN1', csr), registered_event('vendor-ca', vendor_cert_id)), None)
+
+    assert failed_ids(response) == []
+    row = aws_ca.table.rows['SN1']
+    assert row['CrState'] == CR_MAN_CERT_CREATED
+    assert row['VendorCertId'] == vendor_cert_id
+    assert aws_ca.publishes.topics() == ['/cert-rotation/create-man-cert/SN1/rspn']
+
+def test_redelivered_messages_skip_the_rate_limit(aws):
+    aws.add_device('SN1', CR_CERT_ROTATION_COMPLETED, ManufacturerCertId='c1')
+    events = [ack_event('SN1', 'c1')] * (ADMISSION_RATE_MAX + 2)
+
+    sqs_handler.sqs_cert_rotation_lambda(sqs_event(*events, receive_count=2), None)
+    assert len(aws.publishes.messages) == len(events)
+
+    sqs_handler.sqs_cert_rotation_lambda(sqs_event(*events), None)
+    assert len(aws.publishes.messages) == len(events) + ADMISSION_RATE_MAX
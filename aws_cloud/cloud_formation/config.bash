@@ -51,4 +51,7 @@ else
     CERT_ROTATION_LAMBDA_NAME=cert_rotation_lambda
     CERT_ROTATION_LAMBDA_ZIP_NAME=cert_rotation_lambda.zip
     S3_BUCKET=cert-roation-234112
+    # cfn_cert_rotation.json: IoT rules invoke the lambda per message
+    # cfn_cert_rotation_sqs.json: IoT rules queue to SQS, lambda takes batches
+    CF_TEMPLATE=cfn_cert_rotation.json
 fi
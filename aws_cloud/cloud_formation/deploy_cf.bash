@@ -64,7 +64,7 @@ else
 
     echo "Deploy CertRotation Cloudformation"
     aws cloudformation deploy \
-      --template-file cfn_cert_rotation.json \
+      --template-file ${CF_TEMPLATE} \
       --parameter-overrides \
         CertRotationLambdaName=${CERT_ROTATION_LAMBDA_NAME} \
         CertRotationLambdaZipName=${CERT_ROTATION_LAMBDA_ZIP_NAME} \
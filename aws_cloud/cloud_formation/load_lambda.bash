@@ -52,10 +52,16 @@ else
     echo ${lambda_func}
     cd ./${lambda_func}
     rm -f ${lambda_func}.zip
+    # Drop unused botocore models and stale bytecode, precompile .pyc
+    python3 ../prune_package.py ./package .
     cd ./package
     zip -r9 ${OLDPWD}/${lambda_func}.zip .
     cd $OLDPWD
     zip ${lambda_func}.zip *.py
+    # Only there when prune_package.py rebuilt it for the lambda runtime
+    if [ -d __pycache__ ] ; then
+        zip -r ${lambda_func}.zip __pycache__
+    fi
     aws lambda update-function-code --function-name ${lambda_func} --zip-file fileb://${lambda_func}.zip
     cd ..
 fi
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+
+'''
+    filename: prune_package.py
+
+    Packaging step for zip_lambda.bash. Shrinks a lambda's pip install
+    target (cert_rotation_lambda/package) before it is zipped:
+        - removes botocore and boto3 service models the lambda never
+          calls, if boto3 is installed into package/ rather than taken
+          from the lambda runtime
+        - removes bytecode compiled by other Python versions
+        - removes the lambda source dir's __pycache__, so .pyc files of
+          renamed or deleted modules aren't zipped
+        - precompiles .py to .pyc in __pycache__, only when run by the
+          same Python version as the lambda runtime, since the runtime
+          ignores .pyc files from any other version and can't write its
+          own to the read-only /var/task
+
+    Usage:
+        > python3 prune_package.py cert_rotation_lambda/package cert_rotation_lambda
+'''
+
+import argparse
+import compileall
+import os
+import shutil
+import sys
+import logging
+
+logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', level=logging.INFO)
+
+# Services cert_rotation_lambda/clients.py creates clients or resources for
+lambda_services = ['iot', 'iot-data', 'ssm', 'dynamodb', 'sts', 'sqs']
+
+# Matches "Runtime" in cfn_cert_rotation.json
+lambda_runtime = 'python3.6'
+
+'''
+    Remove service model dirs under data_dir not named in services. Files
+    at the top of data_dir (endpoints.json, ...) are kept.
+    Returns the number of bytes removed.
+'''
+def prune_models(data_dir, services):
+    removed = 0
+    if not os.path.isdir(data_dir):
+        return removed
+    for name in os.listdir(data_dir):
+        path = os.path.join(data_dir, name)
+        if os.path.isdir(path) and name not in services:
+            removed += dir_size(path)
+            shutil.rmtree(path)
+    logging.info('prune_models(): {} kept {}, removed {:.1f} MiB'.\
+        format(data_dir, sorted(set(services) & set(os.listdir(data_dir))), removed / 2**20))
+    return removed
+
+'''
+    Remove .pyc files whose cache tag isn't cache_tag, e.g. cpython-311
+    files left by a local pip install when the runtime is cpython-36
+'''
+def prune_bytecode(top_dir, cache_tag):
+    removed = 0
+    for dir_path, dir_names, file_names in os.walk(top_dir):
+        if os.path.basename(dir_path) != '__pycache__':
+            continue
+        for name in file_names:
+            if name.endswith('.pyc') and '.{}.'.format(cache_tag) not in name:
+                os.remove(os.path.join(dir_path, name))
+                removed += 1
+    logging.info('prune_bytecode(): {} removed {} .pyc files'.format(top_dir, removed))
+    return removed
+
+def dir_size(top_dir):
+    size = 0
+    for dir_path, dir_names, file_names in os.walk(top_dir):
+        for name in file_names:
+            size += os.path.getsize(os.path.join(dir_path, name))
+    return size
+
+'''
+    cache tag ('cpython-36') the lambda runtime ('python3.6') loads
+'''
+def runtime_cache_tag(runtime):
+    return 'cpython-{}'.format(runtime.replace('python', '').replace('.', ''))
+
+def main():
+    argp = argparse.ArgumentParser(description='Prune and precompile a lambda package dir')
+    argp.add_argument('dirs', nargs='+', help='package dir first, then any other source dirs to precompile')
+    argp.add_argument('--runtime', default=lambda_runtime, help='--runtime lambda runtime, e.g. python3.6')
+    argp.add_argument('--services', nargs='*', default=lambda_services, help='--services botocore service models to keep')
+    args = argp.parse_args()
+
+    cache_tag = runtime_cache_tag(args.runtime)
+    package_dir = args.dirs[0]
+    before = dir_size(package_dir)
+
+    prune_models(os.path.join(package_dir, 'botocore', 'data'), args.services)
+    prune_models(os.path.join(package_dir, 'boto3', 'data'), args.services)
+
+    for top_dir in args.dirs:
+        if top_dir != package_dir:
+            # Rebuilt below, or left out of the zip when not precompiling
+            shutil.rmtree(os.path.join(top_dir, '__pycache__'), ignore_errors=True)
+        prune_bytecode(top_dir, cache_tag)
+        if sys.implementation.cache_tag == cache_tag:
+            # Only __pycache__ pycs are loaded next to the .py files
+            compileall.compile_dir(top_dir, quiet=1, legacy=False,
+                maxlevels=0 if top_dir != package_dir else 10)
+        else:
+            logging.info('main(): {} is not {}, not precompiling {}'.\
+                format(sys.implementation.cache_tag, cache_tag, top_dir))
+
+    logging.info('main(): {} {:.1f} MiB -> {:.1f} MiB'.\
+        format(package_dir, before / 2**20, dir_size(package_dir) / 2**20))
+
+if __name__ == "__main__":
+    main()
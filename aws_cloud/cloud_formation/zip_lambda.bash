@@ -53,9 +53,15 @@ else
     cd ./${lambda_func}
     rm -f ${lambda_func}.zip
     rm -f ${lambda_func}.zip
+    # Drop unused botocore models and stale bytecode, precompile .pyc
+    python3 ../prune_package.py ./package .
     cd ./package
     zip -r9 ${OLDPWD}/${lambda_func}.zip .
     cd $OLDPWD
     zip ${lambda_func}.zip *.py
+    # Only there when prune_package.py rebuilt it for the lambda runtime
+    if [ -d __pycache__ ] ; then
+        zip -r ${lambda_func}.zip __pycache__
+    fi
     cd ..
 fi
@@ -47,8 +47,29 @@ manufacturer_device_cert_and_cacert_filename='{}ManufacturerDeviceCertAndCACert.
 vendor_cert_filename='{}{}_ven.pem'.format(data_dir, serial_number)
 vendor_key_filename='{}{}_ven.key'.format(data_dir, serial_number)
 
+# Key for the Manufacturer cert CSR:
+#   None - reuse the vendor key (_ven.key)
+#   'rsa' - new RSA 2048 key
+#   'ec' - new ECDSA P-256 key (smaller cert and faster TLS handshake)
+manufacturer_key_type=None
+manufacturer_key_filename='{}{}_man.key'.format(data_dir, serial_number)
+
 manufacturer_rootCA_filename='{}{}_rootCA.pem'.format(data_dir, manufacturer_ca_name)
 manufacturer_cert_filename='{}{}_man.pem'.format(data_dir, serial_number)
 
 aws_rootca_filename='{}RootCA.pem'.format(data_dir)
 
+# gateway.py: one directory per child device, named by its serial number,
+# holding that device's copies of the files above, and how many of them
+# may be connected at once
+gateway_data_dir='{}devices/'.format(data_dir)
+gateway_max_connections=50
+
+# mqtt_client.py retries (retry_policy.py). After failed attempt n the
+# device waits a random time between 0 and min(cap, base * 2**n) seconds.
+retry_base_seconds=2
+retry_cap_seconds=120
+
+# mqtt_client.py --rotate phase journal, so a restart resumes the rotation
+rotate_journal_filename='{}{}_rotate.json'.format(data_dir, serial_number)
+
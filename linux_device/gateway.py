@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+ filename: gateway.py
+
+ Gateway mode: rotates the certs of many child devices from one process.
+ Each device runs mqtt_client.py's --rotate state machine with its own
+ client id, credentials, and journal under gateway_data_dir/<serial>/.
+ One asyncio loop drives every device's MQTT socket through paho's
+ on_socket_* callbacks, so an active rotation costs a paho client and a
+ socket rather than a thread or an interpreter. At most
+ gateway_max_connections devices are connected at once.
+
+ python gateway.py [--serials SN1,SN2] [--max_connections 50]
+'''
+import os
+import ssl
+import json
+import time
+import asyncio
+import argparse
+import threading
+import logging
+from collections import namedtuple
+import paho.mqtt.client as mqtt
+from config import *
+from gen_csr import openssl_genkey_cmd
+from aws_acct_vals import get_endpoint
+from mqtt_client import *
+
+'''
+    A child device's files, named as config.py names the single device's
+'''
+DeviceFiles = namedtuple('DeviceFiles', ['vendor_chain', 'vendor_key', 'man_key',
+    'csr', 'man_cert', 'man_cert_id', 'man_chain', 'journal'])
+
+def device_files(serial_number, data_dir=gateway_data_dir):
+    device_dir = '{}{}/'.format(data_dir, serial_number)
+    return DeviceFiles(
+        vendor_chain='{}VendorDeviceCertAndCACert.pem'.format(device_dir),
+        vendor_key='{}{}_ven.key'.format(device_dir, serial_number),
+        man_key='{}{}_man.key'.format(device_dir, serial_number),
+        csr='{}{}.csr'.format(device_dir, serial_number),
+        man_cert='{}{}_man.pem'.format(device_dir, serial_number),
+        man_cert_id='{}{}_man_cert_id.txt'.format(device_dir, serial_number),
+        man_chain='{}ManufacturerDeviceCertAndCACert.pem'.format(device_dir),
+        journal='{}{}_rotate.json'.format(device_dir, serial_number))
+
+'''
+    Serial numbers of the devices under data_dir
+'''
+def list_serial_numbers(data_dir=gateway_data_dir):
+    try:
+        return sorted([name for name in os.listdir(data_dir)
+            if os.path.isdir(os.path.join(data_dir, name))])
+    except FileNotFoundError:
+        return []
+
+class AsyncioHelper:
+    """
+    Drives a paho client's socket from the asyncio loop, in place of
+    loop_start()'s thread. paho calls on_socket_open/close when the
+    socket comes and goes, and on_socket_(un)register_write when it has
+    (no more) data to send. loop_misc() runs once a second for keepalive.
+
+    connect() runs in an executor thread, so callbacks from it are moved
+    onto the loop. Callbacks on the loop run right away, since paho
+    closes the socket as soon as on_socket_close returns.
+    """
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.client = client
+        self.misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def call(self, func, *args):
+        if threading.get_ident() == self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.call(self.open, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.call(self.close, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call(self.loop.add_writer, sock, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call(self.loop.remove_writer, sock)
+
+    def open(self, sock):
+        self.loop.add_reader(sock, self.read, sock)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def close(self, sock):
+        try:
+            self.loop.remove_reader(sock)
+            self.loop.remove_writer(sock)
+        except Exception as e:
+            logging.error('AsyncioHelper.close(): Exception = {}'.format(str(e)))
+        if self.misc:
+            self.misc.cancel()
+
+    def read(self, sock):
+        self.client.loop_read()
+        # TLS can hold decrypted bytes the selector won't report
+        while self.client.socket() is sock and getattr(sock, 'pending', None) and sock.pending():
+            self.client.loop_read()
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+class GatewayDevice:
+    """
+    One child device: its client id, files, rotation phase, and, while
+    connected, its paho client. acks and responses are the futures the
+    paho callbacks resolve, keyed by mid and by response topic.
+
+    paho sends DISCONNECT from the loop's writer, so a client's
+    on_disconnect can run after the next connect has begun. Callbacks
+    from a client other than self.mqttc are ignored.
+    """
+    def __init__(self, gateway, serial_number):
+        self.gateway = gateway
+        self.loop = gateway.loop
+        self.serial_number = serial_number
+        self.files = device_files(serial_number, gateway.data_dir)
+        self.phase = ROTATE_START
+        self.mqttc = None
+        self.connected = None
+        self.connect_flag = False
+        self.acks = {}
+        self.responses = {}
+
+    def on_connect(self, mqttc, obj, flags, rc):
+        if mqttc is not self.mqttc:
+            return
+        logging.info('{}: on_connect(): rc = {}'.format(self.serial_number, rc))
+        self.connect_flag = rc == 0
+        if self.connected and not self.connected.done():
+            self.connected.set_result(rc)
+
+    def on_disconnect(self, mqttc, obj, rc):
+        if mqttc is not self.mqttc:
+            return
+        logging.info('{}: on_disconnect(): rc = {}'.format(self.serial_number, rc))
+        self.connect_flag = False
+        # Nothing more will arrive on this connection
+        for future in [self.connected] + list(self.acks.values()) + \
+            [f for f, key in self.responses.values()]:
+            if future and not future.done():
+                future.set_result(None)
+        self.acks = {}
+
+    def on_ack(self, mqttc, obj, mid, *args):
+        if mqttc is not self.mqttc:
+            return
+        future = self.acks.pop(mid, None)
+        if future and not future.done():
+            future.set_result(True)
+
+    def on_message(self, mqttc, obj, msg):
+        if mqttc is not self.mqttc:
+            return
+        future, key = self.responses.get(msg.topic, (None, None))
+        try:
+            payload_dict = json.loads(msg.payload)
+        except Exception as e:
+            logging.error('{}: on_message(): Exception = {}'.format(self.serial_number, str(e)))
+            return
+        logging.info('{}: on_message(): topic = {}, keys = {}'.\
+            format(self.serial_number, msg.topic, list(payload_dict.keys())))
+        if future and not future.done() and key in payload_dict:
+            future.set_result(payload_dict)
+
+    async def wait(self, future, timeout):
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def wait_ack(self, result, mid, timeout):
+        """
+        Wait for the SUBACK or PUBACK of mid. paho writes the packet from
+        the loop thread, so its ack can't arrive before the future is made.
+        """
+        if result != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        self.acks[mid] = self.loop.create_future()
+        return bool(await self.wait(self.acks[mid], timeout))
+
+    async def connect(self, cert_filename, key_filename):
+        start = time.monotonic()
+        self.mqttc = mqtt.Client(client_id=self.serial_number)
+        AsyncioHelper(self.loop, self.mqttc)
+        self.mqttc.on_connect = self.on_connect
+        self.mqttc.on_disconnect = self.on_disconnect
+        self.mqttc.on_message = self.on_message
+        self.mqttc.on_publish = self.on_ack
+        self.mqttc.on_subscribe = self.on_ack
+        self.connected = self.loop.create_future()
+        rc = None
+        try:
+            if self.gateway.tls:
+                self.mqttc.tls_set(certfile=cert_filename, keyfile=key_filename, ca_certs=aws_rootca_filename, cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLSv1_2, ciphers=None)
+            # The TCP connect and TLS handshake block, so they run off the loop
+            await self.loop.run_in_executor(None, self.mqttc.connect,
+                self.gateway.endpoint, self.gateway.port, 120)
+            rc = await self.wait(self.connected, WAIT_CONNECT)
+        except Exception as e:
+            logging.error('{}: connect(): Exception = {}'.format(self.serial_number, str(e)))
+        record_phase('connect', start, rc == 0)
+        if rc != 0:
+            self.disconnect()
+            return False
+        return True
+
+    def disconnect(self):
+        if self.mqttc:
+            self.mqttc.disconnect()
+            self.mqttc = None
+
+    async def request(self, sub_topic, pub_topic, value, key):
+        """
+        Subscribe to sub_topic, then publish value to pub_topic until a
+        response with key arrives. Returns the response, or None.
+        """
+        start = time.monotonic()
+        result, mid = self.mqttc.subscribe(sub_topic, qos=1)
+        rc = await self.wait_ack(result, mid, WAIT_SUB)
+        record_phase('subscribe', start, rc)
+        if not rc:
+            return None
+
+        for i in range(MAN_CERT_RETRY.attempts):
+            response = self.loop.create_future()
+            self.responses[sub_topic] = (response, key)
+            start = time.monotonic()
+            info = self.mqttc.publish(pub_topic, json.dumps(value), qos=1)
+            rc = await self.wait_ack(info.rc, info.mid, WAIT_PUB)
+            record_phase('publish', start, rc)
+            if rc:
+                start = time.monotonic()
+                payload_dict = await self.wait(response, WAIT_MAN_CERT_ATTEMPT)
+                record_phase('response', start, payload_dict)
+                if payload_dict:
+                    return payload_dict
+            if not self.connect_flag or i + 1 == MAN_CERT_RETRY.attempts:
+                break
+            await asyncio.sleep(MAN_CERT_RETRY.delay(i))
+        return None
+
+    async def with_connection(self, cert_filename, key_filename, retry_policy, func):
+        """
+        Connect, await func(), and disconnect, holding one of the gateway's
+        connections meanwhile. Retried as retry_policy says, with the
+        connection given up during the wait. Returns func()'s result.
+        """
+        for i in range(retry_policy.attempts):
+            result = None
+            async with self.gateway.connections:
+                if await self.connect(cert_filename, key_filename):
+                    try:
+                        result = await func()
+                    finally:
+                        self.disconnect()
+            if result:
+                return result
+            logging.info('{}: attempt {} failed in phase {}'.format(self.serial_number, i, self.phase))
+            if i + 1 < retry_policy.attempts:
+                await asyncio.sleep(retry_policy.delay(i))
+        return None
+
+    async def run_cmd(self, cmd):
+        process = await asyncio.create_subprocess_shell(cmd,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            logging.error('{}: run_cmd(): {} failed: {}'.format(self.serial_number, cmd, stderr.decode()))
+        return process.returncode == 0
+
+    def get_man_key_filename(self):
+        return self.files.man_key if manufacturer_key_type else self.files.vendor_key
+
+    async def gen_csr(self):
+        """
+        gen_csr.gen_cert_info() for this device
+        """
+        key_filename = self.get_man_key_filename()
+        if manufacturer_key_type:
+            if not await self.run_cmd(openssl_genkey_cmd(key_filename, manufacturer_key_type)):
+                return False
+        return await self.run_cmd('openssl req -new -key {} -out {} -subj "{}"'.\
+            format(key_filename, self.files.csr, manufacture_subj_str.format(self.serial_number)))
+
+    async def create_man_cert(self):
+        """
+        On the vendor cert connection: JITP is done once it's up, then
+        send the CSR and save the Manufacturer cert
+        """
+        if self.phase == ROTATE_START:
+            self.phase = write_rotate_phase(ROTATE_JITP, self.files.journal, self.serial_number)
+        if self.phase == ROTATE_JITP:
+            if not await self.gen_csr():
+                return False
+            self.phase = write_rotate_phase(ROTATE_CSR, self.files.journal, self.serial_number)
+
+        with open(self.files.csr, 'r') as f:
+            csr_text = f.read()
+        payload_dict = await self.request(
+            '/cert-rotation/create-man-cert/{}/rspn'.format(self.serial_number),
+            '/cert-rotation/create-man-cert/{}/rqst'.format(self.serial_number),
+            {'csr':csr_text}, 'pem')
+        if not payload_dict:
+            return False
+
+        with open(self.files.man_cert_id, 'w') as f:
+            f.write(payload_dict['cert_id'])
+        with open(self.files.man_cert, 'w') as f:
+            f.write(payload_dict['pem'])
+        write_man_cert_chain(self.files.man_cert, self.files.man_chain)
+        self.phase = write_rotate_phase(ROTATE_MAN_CERT, self.files.journal, self.serial_number)
+        return True
+
+    async def ack_man_cert(self):
+        with open(self.files.man_cert_id, 'r') as f:
+            cert_id_text = f.read().replace('\n', '')
+        payload_dict = await self.request(
+            '/cert-rotation/ack-man-cert/{}/rspn'.format(self.serial_number),
+            '/cert-rotation/ack-man-cert/{}/rqst'.format(self.serial_number),
+            {'cert_id':cert_id_text}, 'cert_id')
+        if not payload_dict:
+            return False
+        self.phase = write_rotate_phase(ROTATE_COMPLETED, self.files.journal, self.serial_number)
+        return True
+
+    async def rotate(self):
+        """
+        mqtt_client.rotate() for this device, resuming from its journal
+        """
+        self.phase = read_rotate_phase(self.files.journal)
+        logging.info('{}: rotate start, phase = {}'.format(self.serial_number, self.phase))
+        if self.phase == ROTATE_COMPLETED:
+            return True
+        if self.phase != ROTATE_MAN_CERT:
+            if not await self.with_connection(self.files.vendor_chain, self.files.vendor_key,
+                JITP_RETRY, self.create_man_cert):
+                return False
+        rc = await self.with_connection(self.files.man_chain, self.get_man_key_filename(),
+            MAN_CERT_RETRY, self.ack_man_cert)
+        logging.info('{}: rotate {}'.format(self.serial_number, 'success' if rc else 'failed'))
+        return bool(rc)
+
+class Gateway:
+    """
+    The child devices and the loop and connection limit they share.
+    endpoint defaults to the account's IoT endpoint. A local test broker
+    can be given with its port and tls=False (see load_test/).
+    """
+    def __init__(self, loop, serial_numbers, max_connections=gateway_max_connections,
+        data_dir=gateway_data_dir, endpoint=None, port=8883, tls=True):
+        self.loop = loop
+        self.max_connections = max_connections
+        self.data_dir = data_dir
+        self.endpoint = endpoint
+        self.port = port
+        self.tls = tls
+        self.connections = None
+        self.devices = [GatewayDevice(self, sn) for sn in serial_numbers]
+
+    async def rotate(self):
+        """
+        Rotate every device at once. Returns {serial_number: True/False}.
+        """
+        self.connections = asyncio.Semaphore(self.max_connections)
+        if not self.endpoint:
+            self.endpoint = await self.loop.run_in_executor(None, get_endpoint)
+        results = await asyncio.gather(*[device.rotate() for device in self.devices],
+            return_exceptions=True)
+        for device, result in zip(self.devices, results):
+            if isinstance(result, Exception):
+                logging.error('{}: rotate(): Exception = {}'.format(device.serial_number, str(result)))
+        return {device.serial_number: result is True
+            for device, result in zip(self.devices, results)}
+
+def main():
+    argp = argparse.ArgumentParser(description='AWS Cert Rotation Blog gateway')
+    argp.add_argument('--serials', default=None, help='--serials SN1,SN2 - Devices to rotate, default all in {}'.format(gateway_data_dir))
+    argp.add_argument('--max_connections', type=int, default=gateway_max_connections, help='--max_connections N - Devices connected at once')
+    argp.add_argument('--timing_file', default=None, help='--timing_file FILE - Write the timing report as JSON')
+    args = argp.parse_args()
+
+    serial_numbers = args.serials.split(',') if args.serials else list_serial_numbers()
+    logging.info('gateway: {} devices, max_connections = {}'.format(len(serial_numbers), args.max_connections))
+
+    start = time.monotonic()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    gateway = Gateway(loop, serial_numbers, args.max_connections)
+    try:
+        results = loop.run_until_complete(gateway.rotate())
+    finally:
+        loop.close()
+
+    failed = sorted([sn for sn, rc in results.items() if not rc])
+    logging.info('gateway: {} rotated, {} failed {}'.format(len(results) - len(failed), len(failed), failed))
+    timing_report('gateway', time.monotonic() - start, args.timing_file)
+
+if __name__ == "__main__":
+    main()
@@ -22,20 +22,42 @@ import os
 import logging
 from config import *
 
+'''
+    openssl command to generate a private key of key_type
+'''
+def openssl_genkey_cmd(key_filename, key_type):
+    if key_type == 'ec':
+        return 'openssl ecparam -name prime256v1 -genkey -noout -out {}'.format(key_filename)
+    return 'openssl genrsa -out {} 2048'.format(key_filename)
+
+'''
+    Key used for the Manufacturer cert CSR and connection 3
+'''
+def get_manufacturer_key_filename():
+    if manufacturer_key_type:
+        return manufacturer_key_filename
+    return vendor_key_filename
+
 '''
     Create CSR, cert, private key
 '''
 def gen_cert_info():
 
     dev = serial_number
-    existing_private_key = serial_number
     ca_name = manufacturer_ca_name
     dev_subj_str = manufacture_subj_str.format(dev)
     days = 365*10
 
     try: 
-        gen_dev_csr_cmd = 'openssl req -new -key {}{}_ven.key -out {}{}.csr -subj \"{}\">> {} 2>> {}  '.\
-            format(data_dir, existing_private_key, data_dir, dev, dev_subj_str, ssl_stdout, ssl_stderr)
+        key_filename = get_manufacturer_key_filename()
+        if manufacturer_key_type:
+            gen_dev_key_cmd = '{} >> {} 2>> {} '.format(
+                openssl_genkey_cmd(key_filename, manufacturer_key_type), ssl_stdout, ssl_stderr)
+            logging.info('gen key cmd = {}'.format(gen_dev_key_cmd))
+            os.system(gen_dev_key_cmd)
+
+        gen_dev_csr_cmd = 'openssl req -new -key {} -out {}{}.csr -subj \"{}\">> {} 2>> {}  '.\
+            format(key_filename, data_dir, dev, dev_subj_str, ssl_stdout, ssl_stderr)
         logging.info('gen csr cmd = {}'.format(gen_dev_csr_cmd))
         os.system(gen_dev_csr_cmd)
 
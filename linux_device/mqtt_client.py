@@ -29,6 +29,7 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 '''
 import time
+import threading
 import argparse
 import datetime
 import os
@@ -40,16 +41,42 @@ import logging
 from config import *
 from gen_csr import *
 from aws_acct_vals import get_endpoint
+from retry_policy import RetryPolicy
 
 #############################
-WAIT_SUB = 5 # Give time for MQTT sub to complete
-WAIT_PUB = 10 # Give time for MQTT pub to complete
-WAIT_CONNECT = 10 # Give time for MQTT connect to complete
-WAIT_JITP_ATTEMPT = 10 # Wait between JITP attempts
-WAIT_MAN_CERT_ATTEMPT = 10 # Wait between MAN_CERT attempts
+# Each wait returns as soon as its paho callback fires; these are timeouts
+WAIT_SUB = 5 # Timeout for a MQTT sub or unsub to be acked
+WAIT_PUB = 10 # Timeout for a MQTT pub to be acked
+WAIT_CONNECT = 10 # Timeout for the MQTT connect to complete
+WAIT_MAN_CERT_ATTEMPT = 10 # Timeout for a MAN_CERT response
 JITP_ATTEMPTS = 10 # JITP attempts 
 MAN_CERT_ATTEMPTS = 5 # MAN_CERT attempts
 
+# Waits between attempts, see retry_policy.py
+JITP_RETRY = RetryPolicy(JITP_ATTEMPTS)
+MAN_CERT_RETRY = RetryPolicy(MAN_CERT_ATTEMPTS)
+
+#############################
+# Time the fixed sleeps used to take on the happy path, per phase, for the
+# timing report. Subscribe slept WAIT_SUB in mqtt_sub() and again after it.
+SLEEP_PHASES = {
+    'connect': WAIT_CONNECT,
+    'subscribe': 2 * WAIT_SUB,
+    'publish': WAIT_PUB,
+    'response': WAIT_MAN_CERT_ATTEMPT
+    }
+
+# (phase, seconds, ok) for every wait in this run
+phase_timings = []
+
+#############################
+# --rotate phases, in order, as written to rotate_journal_filename
+ROTATE_START = 'start'
+ROTATE_JITP = 'jitp'            # Vendor cert connected, JITP done
+ROTATE_CSR = 'csr'              # CSR (and key) written to data_dir
+ROTATE_MAN_CERT = 'man_cert'    # Manufacturer cert and id written to data_dir
+ROTATE_COMPLETED = 'completed'  # Manufacturer cert acked
+
 class MQTTClient(mqtt.Client):
     """ 
     Class for Thing MQTT connection 
@@ -58,8 +85,11 @@ class MQTTClient(mqtt.Client):
     connection connection closes the first connection. MQTT only allows one
     connection for a client id at a time.
 
+    The paho callbacks run on the loop_start() thread. Each one updates its
+    flags, then notifies self.cond so the waiting caller wakes right away.
+
     """
-    def __init__(self, client_id, cert_filename):
+    def __init__(self, client_id, cert_filename, key_filename=vendor_key_filename):
         """
         Create the mqtt connection for a Thing
         """
@@ -75,6 +105,9 @@ class MQTTClient(mqtt.Client):
         self.pub_msg_count=0
         self.rcv_msg_count=0
         self.sub_topics = []
+        self.cond = threading.Condition()
+        self.acked_mids = set()
+        start = time.monotonic()
         try :
             self.mqttc = mqtt.Client(client_id=client_id)
 
@@ -87,10 +120,10 @@ class MQTTClient(mqtt.Client):
             self.mqttc.on_unsubscribe = self.on_unsubscribe
 
             logging.info('__init__(): MQTT connection: key = {}, cert = {}, ca = {}'.\
-                format(cert_filename, vendor_key_filename, \
+                format(key_filename, cert_filename, \
                 aws_rootca_filename))
 
-            rc = self.mqttc.tls_set(certfile=cert_filename, keyfile=vendor_key_filename, ca_certs=aws_rootca_filename, cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLSv1_2, ciphers=None)
+            rc = self.mqttc.tls_set(certfile=cert_filename, keyfile=key_filename, ca_certs=aws_rootca_filename, cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLSv1_2, ciphers=None)
 
             logging.info('__init__(): MQTT tls_set rc = {}'.format(rc))
 
@@ -99,18 +132,53 @@ class MQTTClient(mqtt.Client):
             logging.info('__init__(): MQTT Connect rc = {}'.format(rc))
 
             self.mqttc.loop_start()
-            time.sleep(WAIT_CONNECT)
+            # A refused connect (e.g. JITP registering the cert) ends the wait
+            # through on_disconnect
+            self.wait_for(lambda: self.connect_flag or self.disconnect_flag, WAIT_CONNECT)
         except Exception as e:
             logging.error("__init__(): MQTT connect exception: {}".format(str(e)))
             self.mqttc = None
+        record_phase('connect', start, self.connect_flag)
+
+    def wait_for(self, predicate, timeout):
+        """
+        Wait until predicate() is true or timeout seconds pass. Returns
+        predicate()'s last value.
+        """
+        with self.cond:
+            return self.cond.wait_for(predicate, timeout)
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def wait_for_mids(self, mids, timeout):
+        """
+        Wait for the broker to ack each of the sub, unsub, or pub mids.
+        The ack can come before subscribe() or publish() returns the mid,
+        so acked mids are kept rather than waited on one at a time.
+        """
+        return self.wait_for(lambda: self.acked_mids.issuperset(mids), timeout)
+
+    def disconnect(self):
+        """
+        Close the connection and stop the network loop, so it doesn't
+        reconnect with the same client id and close the next attempt's
+        connection.
+        """
+        if self.mqttc:
+            self.mqttc.disconnect()
+            self.mqttc.loop_stop()
 
     def on_connect(self, mqttc, obj, flags, rc): 
         if self.sub_topics:
-            self.mqtt_sub(self.sub_topics)
+            # On the loop thread, so the SUBACKs can't be waited on here
+            self.mqtt_sub(self.sub_topics, wait=False)
         if rc == 0:
             self.connect_flag=True
             self.disconnect_flag=False
         logging.info('on_connect(): rc = {}'.format(rc))
+        self.notify()
 
     def on_disconnect(self, mqttc, obj, rc): 
         self.disconnect_flag=True
@@ -119,6 +187,7 @@ class MQTTClient(mqtt.Client):
         self.pub_flag = False
 
         logging.info('on_disconnect(): rc = {}'.format(rc))
+        self.notify()
 
     def on_message_ack_man_cert(self, msg):
         payload_dict = json.loads(msg.payload)
@@ -133,7 +202,6 @@ class MQTTClient(mqtt.Client):
         payload_dict = json.loads(msg.payload)
         logging.info('on_message_create_man_cert: payload dict keys = {}'.format(payload_dict.keys()))
         if 'pem' in payload_dict:
-            self.create_man_cert_flag = True
             self.man_cert_pem = payload_dict['pem']
             self.man_cert_id = payload_dict['cert_id']
             self.create_man_cert_flag = True
@@ -154,80 +222,129 @@ class MQTTClient(mqtt.Client):
         logging.info('on_message(): ********************************')
         logging.info('on_message(): topic = {}, qos = {}, msg = {}'.
             format (msg.topic, msg.qos, msg.payload))
+        self.notify()
 
     def on_publish(self, mqttc, obj, mid):
         self.pub_msg_count += 1
         self.pub_flag=False
+        self.acked_mids.add(mid)
         logging.info('on_publish(): mid: {}'.format(mid))
+        self.notify()
 
     def on_subscribe(self, mqttc, obj, mid, granted_qos):
         self.sub_flag=True
+        self.acked_mids.add(mid)
         logging.info('on_subscribe(): mid = {}, granted qos = {}'.
             format(mid, granted_qos))
+        self.notify()
 
     def on_unsubscribe(self, mqttc, userdata, mid):
         self.sub_flag=False
+        self.acked_mids.add(mid)
         logging.info('on_subscribe(): userdata = {}, mid = {}'.
             format(userdata ,mid))
+        self.notify()
 
     def on_log(self, mqttc, obj, level, string):
-        if 'CONNACK' in string:
-            self.connect_flag = True
         logging.info('on_log(): msg: {}'.format(string))
         logging.info('log flags: connect {}, disconnect {}, pub = {}, sub = {}, rcv cnt = {}, pub cnt = {}, '.format(self.connect_flag, self.disconnect_flag, self.pub_flag, self.sub_flag, self.rcv_msg_count, self.pub_msg_count))
 
-    def mqtt_sub(self, sub_topics):
+    def mqtt_sub(self, sub_topics, wait=True):
         """
-        Subscribe to topics
+        Subscribe to topics. Returns True once every SUBACK is in, or
+        right away without waiting when wait is False.
         """
-        if sub_topics:
-            self.sub_topics += sub_topics
+        for topic in sub_topics:
+            if topic not in self.sub_topics:
+                self.sub_topics.append(topic)
 
+        start = time.monotonic()
+        mids = []
         for topic in sub_topics:
             try:
                 logging.info('mqtt_sub(): {}'.format(topic))
                 result, mid = self.mqttc.subscribe(topic, qos=1)
                 logging.info('mqtt_sub(): result = {}, mid = {}'.\
                     format(result, mid))
-                time.sleep(WAIT_SUB)
+                if result != mqtt.MQTT_ERR_SUCCESS:
+                    return False
+                mids.append(mid)
             except Exception as e:
                 logging.error("mqtt_sub(): MQTT Sub connect execption: {}".format(str(e)))
+                return False
+
+        if not wait:
+            return True
+        rc = self.wait_for_mids(mids, WAIT_SUB)
+        record_phase('subscribe', start, rc)
+        return rc
 
     def mqtt_unsub(self):
         """
         Unsubscribe to topics
         """
+        mids = []
         for topic in self.sub_topics:
             try:
                 logging.info('mqtt_unsub(): {}'.format(topic))
                 self.sub_flag = False
-                self.mqttc.unsubscribe(topic)
-                time.sleep(WAIT_SUB)
+                result, mid = self.mqttc.unsubscribe(topic)
+                if result == mqtt.MQTT_ERR_SUCCESS:
+                    mids.append(mid)
             except Exception as e:
                 logging.error("mqtt_unsub(): MQTT unsub connect execption: {}".format(str(e)))
+        self.wait_for_mids(mids, WAIT_SUB)
         self.sub_topics = []
 
     def mqtt_pub(self, topic, msg):
         """
-        Publish msg to topic
+        Publish msg to topic. Returns True once the PUBACK is in.
         """
 
         if self.sub_topics:
-            while not self.sub_flag:
-                # wait for subscribe to complete
-                time.sleep(WAIT_PUB)
+            # wait for subscribe to complete
+            if not self.wait_for(lambda: self.sub_flag, WAIT_SUB):
+                logging.info('mqtt_pub(): not subscribed, topic = {}'.format(topic))
+                return False
 
+        start = time.monotonic()
         try:
             logging.info('mqtt pub: topic = {}'.format(topic))
             self.pub_flag = True
-            self.mqttc.publish(topic, json.dumps(msg), qos=1)
-            time.sleep(WAIT_PUB)
+            info = self.mqttc.publish(topic, json.dumps(msg), qos=1)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                logging.info('mqtt_pub(): publish rc = {}'.format(info.rc))
+                return False
+            rc = self.wait_for_mids([info.mid], WAIT_PUB)
         except Exception as e:
             logging.error("MQTT Pub connect execption: {}".format(str(e)))
+            return False
+        record_phase('publish', start, rc)
+        return rc
 
-    def create_man_cert(self):
+    def request(self, sub_topics, pub_topic, value, flag_name):
+        """
+        Publish value to pub_topic until the response handler sets
+        flag_name, waiting up to WAIT_MAN_CERT_ATTEMPT for each response,
+        then MAN_CERT_RETRY's backoff before publishing again.
+        """
         rc = False
+        for i in range(MAN_CERT_RETRY.attempts):
+            # Man Cert Pub attempts
+            setattr(self, flag_name, False)
+            if not self.sub_flag:
+                self.mqtt_sub(sub_topics)
+            if self.sub_flag and self.mqtt_pub(pub_topic, value):
+                start = time.monotonic()
+                self.wait_for(lambda: getattr(self, flag_name), WAIT_MAN_CERT_ATTEMPT)
+                record_phase('response', start, getattr(self, flag_name))
+            if getattr(self, flag_name):
+                rc = True
+                break
+            MAN_CERT_RETRY.sleep(i)
+        return rc
 
+    def create_man_cert(self):
         sub_topics = ['/cert-rotation/create-man-cert/{}/rspn'.\
                 format(serial_number)]
 
@@ -240,23 +357,9 @@ class MQTTClient(mqtt.Client):
         logging.info('csr = {:.40}'.format(csr_text))
 
         value = {'csr':'{}'.format(csr_text)}
-        for i in range(MAN_CERT_ATTEMPTS):
-            # Man Cert Pub attempts
-            self.create_man_cert_flag = False
-            if not self.sub_flag:
-                self.mqtt_sub(sub_topics)
-                time.sleep(WAIT_SUB)
-            if self.sub_flag:
-                self.mqtt_pub(pub_topic, value)
-            time.sleep(WAIT_MAN_CERT_ATTEMPT)
-            if self.create_man_cert_flag:
-                rc = True
-                break
-        return rc
+        return self.request(sub_topics, pub_topic, value, 'create_man_cert_flag')
 
     def ack_man_cert(self):
-        rc = False
-
         sub_topics = ['/cert-rotation/ack-man-cert/{}/rspn'.\
                 format(serial_number)]
 
@@ -268,26 +371,64 @@ class MQTTClient(mqtt.Client):
 
         logging.info('man cert id = {}'.format(cert_id_text))
         value = {'cert_id':'{}'.format(cert_id_text)}
-        for i in range(MAN_CERT_ATTEMPTS):
-            # Man Cert Pub attempts
-            self.ack_man_cert_flag = False
-            if not self.sub_flag:
-                self.mqtt_sub(sub_topics)
-                time.sleep(WAIT_SUB)
-            if self.sub_flag:
-                self.mqtt_pub(pub_topic, value)
-            time.sleep(WAIT_MAN_CERT_ATTEMPT)
-            if self.ack_man_cert_flag :
-                rc = True
-                break
-        return rc
+        return self.request(sub_topics, pub_topic, value, 'ack_man_cert_flag')
+
+'''
+    Time since start for a phase of the connection, for timing_report()
+'''
+def record_phase(phase, start, ok):
+    seconds = time.monotonic() - start
+    phase_timings.append((phase, seconds, bool(ok)))
+    logging.info('record_phase(): {} {:.3f}s ok = {}'.format(phase, seconds, ok))
+
+'''
+    Per-phase latency of this run next to what the fixed sleeps the
+    phases used to take would have cost for the same attempts.
+    Logged, and written as JSON to timing_filename when given.
+'''
+def timing_report(command, elapsed, timing_filename=None):
+    phases = []
+    for phase in ['connect', 'subscribe', 'publish', 'response']:
+        timings = [t for t in phase_timings if t[0] == phase]
+        if not timings:
+            continue
+        phases.append({
+            'phase': phase,
+            'count': len(timings),
+            'failed': len([t for t in timings if not t[2]]),
+            'seconds': round(sum([t[1] for t in timings]), 3),
+            'max_seconds': round(max([t[1] for t in timings]), 3),
+            'sleep_seconds': SLEEP_PHASES[phase] * len(timings)
+            })
+    report = {
+        'command': command,
+        'serial_number': serial_number,
+        'elapsed_seconds': round(elapsed, 3),
+        'wait_seconds': round(sum([p['seconds'] for p in phases]), 3),
+        'sleep_seconds': sum([p['sleep_seconds'] for p in phases]),
+        'phases': phases
+        }
+
+    logging.info('timing_report(): {} {:.3f}s elapsed'.format(command, elapsed))
+    logging.info('timing_report(): {:<10} {:>5} {:>6} {:>10} {:>10} {:>10}'.\
+        format('phase', 'count', 'failed', 'event (s)', 'max (s)', 'sleep (s)'))
+    for p in phases:
+        logging.info('timing_report(): {:<10} {:>5} {:>6} {:>10.3f} {:>10.3f} {:>10}'.\
+            format(p['phase'], p['count'], p['failed'], p['seconds'], p['max_seconds'], p['sleep_seconds']))
+    logging.info('timing_report(): {:<10} {:>5} {:>6} {:>10.3f} {:>10} {:>10}'.\
+        format('total', '', '', report['wait_seconds'], '', report['sleep_seconds']))
+
+    if timing_filename:
+        with open(timing_filename, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
 
 '''
     Just-in-time-provisioning - activate cert, attach policy, create thing, attach cert to thing
 '''
 def jitp():
     logging.info('*********** Start JITP  ***********')
-    for i in range(JITP_ATTEMPTS):
+    for i in range(JITP_RETRY.attempts):
         mqtt_client = MQTTClient(serial_number, \
             vendor_device_cert_and_cacert_filename)
         if mqtt_client.connect_flag:
@@ -296,7 +437,8 @@ def jitp():
             break
         else:
             logging.info('---------JITP attempt {} failed --------.'.format(i))
-            time.sleep(WAIT_JITP_ATTEMPT)
+            mqtt_client.disconnect()
+            JITP_RETRY.sleep(i)
     mqtt_client.disconnect()
 
 '''
@@ -305,71 +447,195 @@ def jitp():
 def create_cert():
     logging.info('************* Manufacturer Cert Create start ************')
     gen_cert_info()
-    for i in range(MAN_CERT_ATTEMPTS):
+    for i in range(MAN_CERT_RETRY.attempts):
         # Connection attempts
         mqtt_client = MQTTClient(serial_number, \
             vendor_device_cert_and_cacert_filename)
         if mqtt_client.connect_flag:
             if mqtt_client.create_man_cert():
                 logging.info('*********** Manufacturer Cert Create Success **************')
-                logging.info('pem = {:.20}'.format(mqtt_client.man_cert_pem))
-                logging.info('cert_id = {:.10}'.format(mqtt_client.man_cert_id))
-                with open('{}{}_man_cert_id.txt'.format(data_dir, serial_number), 'w') as f:
-                    f.write(mqtt_client.man_cert_id)
-
-                with open('{}{}_man.pem'.format(data_dir, serial_number), 'w') as f:
-                    f.write(mqtt_client.man_cert_pem)
-
+                write_man_cert(mqtt_client)
+                mqtt_client.disconnect()
                 break
         logging.info('--------- Manufacturer Cert Create attempt {} failed --------.'.format(i))
         mqtt_client.disconnect()
-        time.sleep(WAIT_MAN_CERT_ATTEMPT)
+        MAN_CERT_RETRY.sleep(i)
 
 '''
     Connection 3: Connect with new cert
 '''
 def ack_cert():
     logging.info('************* Manufacturer Cert ACK start ************')
-    cat_cmd = 'cat ./data_io/{}_man.pem ./data_io/Manucfacturer_rootCA.pem > ./data_io/ManufacturerDeviceCertAndCACert.pem'.format(serial_number)
-    os.system(cat_cmd)
+    write_man_cert_chain()
 
-    for i in range(MAN_CERT_ATTEMPTS):
+    for i in range(MAN_CERT_RETRY.attempts):
         # Connection attempts
         mqtt_client = MQTTClient(serial_number, \
-            manufacturer_device_cert_and_cacert_filename)
+            manufacturer_device_cert_and_cacert_filename, \
+            get_manufacturer_key_filename())
         if mqtt_client.connect_flag:
             if mqtt_client.ack_man_cert():
                 logging.info('*********** Manufacturer Cert ACK Success **************')
                 logging.info('cert_id = {:.20}'.format(mqtt_client.man_cert_id))
+                mqtt_client.disconnect()
                 break
         logging.info('--------- Manufacturer Cert ACK attempt {} failed --------.'.format(i))
         mqtt_client.disconnect()
-        time.sleep(WAIT_MAN_CERT_ATTEMPT)
+        MAN_CERT_RETRY.sleep(i)
+
+'''
+    Write the Manufacturer cert and its id received on mqtt_client
+'''
+def write_man_cert(mqtt_client):
+    logging.info('pem = {:.20}'.format(mqtt_client.man_cert_pem))
+    logging.info('cert_id = {:.10}'.format(mqtt_client.man_cert_id))
+    with open('{}{}_man_cert_id.txt'.format(data_dir, serial_number), 'w') as f:
+        f.write(mqtt_client.man_cert_id)
+
+    with open(manufacturer_cert_filename, 'w') as f:
+        f.write(mqtt_client.man_cert_pem)
+
+'''
+    Manufacturer cert followed by the Manufacturer CA cert, for connection 3
+'''
+def write_man_cert_chain(cert_filename=manufacturer_cert_filename,
+    chain_filename=manufacturer_device_cert_and_cacert_filename):
+    chain = ''
+    for filename in [cert_filename, manufacturer_rootCA_filename]:
+        try:
+            with open(filename, 'r') as f:
+                chain += f.read()
+        except Exception as e:
+            logging.error('write_man_cert_chain(): Exception = {}'.format(str(e)))
+    with open(chain_filename, 'w') as f:
+        f.write(chain)
+
+'''
+    Last phase --rotate finished, ROTATE_START if none
+'''
+def read_rotate_phase(journal_filename=rotate_journal_filename):
+    try:
+        with open(journal_filename, 'r') as f:
+            return json.load(f).get('phase', ROTATE_START)
+    except FileNotFoundError:
+        return ROTATE_START
+    except Exception as e:
+        logging.error('read_rotate_phase(): Exception = {}'.format(str(e)))
+        return ROTATE_START
+
+'''
+    Record that phase is finished. Written to a temp file and renamed over
+    the journal, so a reboot mid write leaves the old phase or the new one.
+'''
+def write_rotate_phase(phase, journal_filename=rotate_journal_filename, device=serial_number):
+    tmp_filename = '{}.tmp'.format(journal_filename)
+    with open(tmp_filename, 'w') as f:
+        json.dump({'phase':phase, 'serial_number':device,
+            'time':datetime.datetime.utcnow().isoformat()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, journal_filename)
+    logging.info('write_rotate_phase(): {} phase = {}'.format(device, phase))
+    return phase
+
+'''
+    Connect with cert_filename, retrying as retry_policy says.
+    Returns the connected MQTTClient, or None.
+'''
+def connect_client(cert_filename, key_filename, retry_policy):
+    for i in range(retry_policy.attempts):
+        mqtt_client = MQTTClient(serial_number, cert_filename, key_filename)
+        if mqtt_client.connect_flag:
+            return mqtt_client
+        logging.info('connect_client(): attempt {} failed'.format(i))
+        mqtt_client.disconnect()
+        retry_policy.sleep(i)
+    return None
 
+'''
+    Connections 1, 2, and 3 in one run. The vendor cert connection does
+    JITP, then carries the CSR, so it is made once. Each finished phase is
+    written to the journal, and a rerun picks up after the last one: the
+    CSR isn't regenerated once sent, and the Manufacturer cert isn't
+    requested again once received. Returns True once the cert is acked.
+'''
+def rotate():
+    phase = read_rotate_phase()
+    logging.info('************* Rotate start, phase = {} ************'.format(phase))
+    if phase == ROTATE_COMPLETED:
+        logging.info('rotate(): already completed, remove {} to rotate again'.\
+            format(rotate_journal_filename))
+        return True
+
+    if phase != ROTATE_MAN_CERT:
+        mqtt_client = connect_client(vendor_device_cert_and_cacert_filename, vendor_key_filename,
+            JITP_RETRY)
+        if not mqtt_client:
+            logging.info('--------- Rotate JITP failed --------.')
+            return False
+        if phase == ROTATE_START:
+            phase = write_rotate_phase(ROTATE_JITP)
+        if phase == ROTATE_JITP:
+            gen_cert_info()
+            phase = write_rotate_phase(ROTATE_CSR)
+
+        rc = mqtt_client.create_man_cert()
+        mqtt_client.disconnect()
+        if not rc:
+            logging.info('--------- Rotate Manufacturer Cert Create failed --------.')
+            return False
+        write_man_cert(mqtt_client)
+        write_man_cert_chain()
+        phase = write_rotate_phase(ROTATE_MAN_CERT)
+
+    mqtt_client = connect_client(manufacturer_device_cert_and_cacert_filename,
+        get_manufacturer_key_filename(), MAN_CERT_RETRY)
+    if not mqtt_client:
+        logging.info('--------- Rotate Manufacturer Cert connect failed --------.')
+        return False
+    rc = mqtt_client.ack_man_cert()
+    mqtt_client.disconnect()
+    if not rc:
+        logging.info('--------- Rotate Manufacturer Cert ACK failed --------.')
+        return False
+    write_rotate_phase(ROTATE_COMPLETED)
+    logging.info('*********** Rotate Success, cert_id = {:.20} **************'.format(mqtt_client.man_cert_id))
+    return True
 
 def main():
     argp = argparse.ArgumentParser(description='AWS Cert Rotation Blog')
     argp.add_argument('--jitp', action='store_true', help='--jitp JITP')
     argp.add_argument('--create_cert', action='store_true', help='--create_cert - Create Man Cert')
     argp.add_argument('--ack_cert', action='store_true', help='--ack_cert - Ack Man Cert')
+    argp.add_argument('--rotate', action='store_true', help='--rotate - JITP, Create and Ack Man Cert, resuming a stopped rotation')
     argp.add_argument('--delete', action='store_true', help='--delete Delete and Cleanup')
+    argp.add_argument('--timing_file', default=None, help='--timing_file FILE - Write the timing report as JSON')
 
     args = argp.parse_args()
 
-    logging.info('jitp = {jitp}, create_cert = {create_cert}, ack_cert = {ack_cert}, delete = {delete}'.\
-        format(jitp=args.jitp, create_cert=args.create_cert, ack_cert=args.ack_cert, delete=args.delete))
+    logging.info('jitp = {jitp}, create_cert = {create_cert}, ack_cert = {ack_cert}, rotate = {rotate}, delete = {delete}'.\
+        format(jitp=args.jitp, create_cert=args.create_cert, ack_cert=args.ack_cert, rotate=args.rotate, delete=args.delete))
 
     if args.delete:
         cleanup()
     else :
-        if args.jitp and not args.create_cert and not args.ack_cert:
+        start = time.monotonic()
+        if args.rotate and not args.jitp and not args.create_cert and not args.ack_cert:
+            command = 'rotate'
+            rotate()
+        elif args.jitp and not args.create_cert and not args.ack_cert:
+            command = 'jitp'
             jitp()
         elif args.create_cert and not args.jitp and not args.ack_cert:
+            command = 'create_cert'
             create_cert()
         elif args.ack_cert and not args.jitp and not args.create_cert:
+            command = 'ack_cert'
             ack_cert()
         else:
             logging.info('No MQTT Connection')
+            return
+        timing_report(command, time.monotonic() - start, args.timing_file)
 
 if __name__ == "__main__":
     main()
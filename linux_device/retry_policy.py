@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+ filename: retry_policy.py
+
+ Retry waits for the MQTT client. Capped exponential backoff with full
+ jitter: the wait before retry n is random between 0 and
+ min(cap, base * 2**n) seconds, so a fleet of devices that fail together
+ (e.g. a site rebooting after a power event) spread their retries out
+ instead of all hitting IoT Core and the rotation lambda again at once.
+'''
+import time
+import random
+import logging
+from config import *
+
+class RetryPolicy:
+    """
+    attempts tries, with a full jitter wait between them. rng is the
+    random.Random to draw waits from, e.g. a seeded one for simulation.
+    """
+    def __init__(self, attempts, base=retry_base_seconds, cap=retry_cap_seconds, rng=None):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.rng = rng or random.Random()
+
+    def delay(self, attempt):
+        """
+        Wait in seconds after failed attempt (0 based)
+        """
+        return self.rng.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def sleep(self, attempt):
+        """
+        Sleep after failed attempt, unless it was the last one
+        """
+        if attempt + 1 >= self.attempts:
+            return 0
+        seconds = self.delay(attempt)
+        logging.info('RetryPolicy.sleep(): attempt {} failed, retry in {:.1f}s'.format(attempt, seconds))
+        time.sleep(seconds)
+        return seconds
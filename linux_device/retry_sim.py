@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+ filename: retry_sim.py
+
+ Simulates N devices that all start (or restart) at the same moment and
+ retry against a service that can take capacity requests per second,
+ e.g. IoT Core connects or the rotation lambda's concurrency. Requests
+ over capacity in a second fail and are retried. Prints the request
+ arrival distribution and completion times for the old fixed wait and
+ for retry_policy.py's full jitter backoff.
+
+ python retry_sim.py --devices 10000 --capacity 500
+'''
+import argparse
+import heapq
+import random
+from config import *
+from retry_policy import RetryPolicy
+
+class FixedPolicy:
+    """
+    The old retries: the same wait after every failed attempt
+    """
+    def __init__(self, attempts, wait):
+        self.attempts = attempts
+        self.wait = wait
+
+    def delay(self, attempt):
+        return self.wait
+
+'''
+    Run the fleet. Returns (arrivals, done, failed): arrival times of every
+    request, completion time of every device that got through, and the
+    number of devices that ran out of attempts.
+'''
+def simulate(policy, devices, capacity, rng):
+    # (time, attempt) of each device's next request. Devices start within
+    # the same second.
+    queue = [(rng.uniform(0, 1), 0) for i in range(devices)]
+    heapq.heapify(queue)
+    used = {}
+    arrivals = []
+    done = []
+    failed = 0
+    while queue:
+        t, attempt = heapq.heappop(queue)
+        arrivals.append(t)
+        second = int(t)
+        if used.get(second, 0) < capacity:
+            used[second] = used.get(second, 0) + 1
+            done.append(t)
+        elif attempt + 1 < policy.attempts:
+            heapq.heappush(queue, (t + policy.delay(attempt), attempt + 1))
+        else:
+            failed += 1
+    return arrivals, done, failed
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def report(name, arrivals, done, failed, devices, capacity, bucket, buckets):
+    print('{}: {} requests for {} devices, {} devices failed'.\
+        format(name, len(arrivals), devices, failed))
+    print('  completed p50 = {:.1f}s, p99 = {:.1f}s, max = {:.1f}s'.\
+        format(percentile(done, 50), percentile(done, 99), max(done) if done else 0))
+
+    counts = [0] * buckets
+    for t in arrivals:
+        if int(t / bucket) < buckets:
+            counts[int(t / bucket)] += 1
+    scale = max(counts) / 50 if max(counts) > 50 else 1
+    print('  requests per {}s (capacity {} per bucket):'.format(bucket, capacity * bucket))
+    for i, count in enumerate(counts):
+        print('  {:>5.0f}s {:>7} {}'.format(i * bucket, count, '#' * int(count / scale)))
+    print('')
+
+def main():
+    argp = argparse.ArgumentParser(description='Retry policy fleet simulation')
+    argp.add_argument('--devices', type=int, default=10000, help='Devices starting at once')
+    argp.add_argument('--capacity', type=int, default=500, help='Requests per second the service takes')
+    argp.add_argument('--attempts', type=int, default=10, help='Attempts per device')
+    argp.add_argument('--wait', type=float, default=10, help='Fixed policy wait, seconds')
+    argp.add_argument('--base', type=float, default=retry_base_seconds, help='Backoff base, seconds')
+    argp.add_argument('--cap', type=float, default=retry_cap_seconds, help='Backoff cap, seconds')
+    argp.add_argument('--bucket', type=int, default=5, help='Histogram bucket, seconds')
+    argp.add_argument('--buckets', type=int, default=24, help='Histogram buckets')
+    argp.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = argp.parse_args()
+
+    policies = [
+        ('fixed {}s'.format(args.wait), FixedPolicy(args.attempts, args.wait)),
+        ('full jitter base {}s cap {}s'.format(args.base, args.cap),
+            RetryPolicy(args.attempts, args.base, args.cap, random.Random(args.seed)))
+        ]
+    for name, policy in policies:
+        arrivals, done, failed = simulate(policy, args.devices, args.capacity,
+            random.Random(args.seed))
+        report(name, arrivals, done, failed, args.devices, args.capacity, args.bucket, args.buckets)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: conftest.py
+
+    pytest setup for the device client. Its modules import each other by
+    name, so this directory goes first on sys.path, with load_test/ for the
+    local MQTT broker. config.py's paths are relative to ./data_io/, so the
+    work_dir fixture runs each test in an empty temp directory with its own
+    data_io/.
+
+    Usage:
+        > python -m pytest linux_device/tests
+'''
+import os
+import sys
+import pytest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+device_dir = os.path.dirname(tests_dir)
+repo_dir = os.path.dirname(device_dir)
+load_test_dir = os.path.join(repo_dir, 'load_test')
+
+'''
+    Forget modules another directory of the repo loaded under the same name
+    (config, aws_acct_vals, ...) so this directory's are imported instead
+'''
+def forget_other_modules(component_dir):
+    for name, module in list(sys.modules.items()):
+        module_dir = os.path.dirname(getattr(module, '__file__', None) or '')
+        if module_dir.startswith(repo_dir) and module_dir != component_dir and \
+                os.path.basename(module_dir) != 'tests':
+            del sys.modules[name]
+
+# This directory's modules, kept for its tests when several directories
+# are collected in one session
+component_modules = {}
+
+'''
+    Put this directory's modules back in sys.modules and its paths first on
+    sys.path. Process pool workers unpickle functions by module name.
+'''
+def use_component():
+    forget_other_modules(device_dir)
+    sys.modules.update(component_modules)
+    for path in [load_test_dir, device_dir]:
+        if path in sys.path:
+            sys.path.remove(path)
+        sys.path.insert(0, path)
+
+def pytest_collectstart(collector):
+    if str(collector.path).startswith(tests_dir):
+        use_component()
+
+def keep_component_modules():
+    for name, module in list(sys.modules.items()):
+        if os.path.dirname(getattr(module, '__file__', None) or '') == device_dir:
+            component_modules[name] = module
+
+def pytest_collectreport(report):
+    keep_component_modules()
+
+@pytest.fixture(autouse=True)
+def component():
+    use_component()
+
+use_component()
+
+from config import data_dir
+keep_component_modules()
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(data_dir)
+    return tmp_path
@@ -0,0 +1,213 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_gateway.py
+
+    gateway.py against load_test/broker.py without TLS: the connection
+    limit, and the futures the paho callbacks resolve for connects, acks,
+    and responses
+'''
+import os
+import json
+import time
+import asyncio
+import pytest
+import gateway
+from gateway import Gateway, GatewayDevice, device_files
+from broker import MqttBroker
+from mqtt_client import write_rotate_phase, read_rotate_phase, ROTATE_MAN_CERT, \
+    ROTATE_COMPLETED
+from retry_policy import RetryPolicy
+
+'''
+    Answers create-man-cert and ack-man-cert requests like the lambda.
+    refuse holds client ids whose next connect is dropped, as JITP drops
+    a new vendor cert's first connect. mute holds request kinds
+    ('create-man-cert', 'ack-man-cert') left unanswered; hang_up holds
+    those answered by closing the connection instead.
+'''
+class Responder():
+    def __init__(self):
+        self.broker = MqttBroker(on_connect=self.on_connect, on_publish=self.on_publish)
+        self.refuse = set()
+        self.mute = set()
+        self.hang_up = set()
+        self.requests = []
+        self.connected = 0
+        self.max_connected = 0
+
+    def on_connect(self, client_id):
+        if client_id in self.refuse:
+            self.refuse.discard(client_id)
+            return False
+        return True
+
+    def on_publish(self, client_id, topic, payload):
+        levels = topic.split('/')
+        kind, serial_number = levels[2], levels[3]
+        self.requests.append((serial_number, kind))
+        if kind in self.mute:
+            return
+        if kind in self.hang_up:
+            self.broker.end_session(self.broker.sessions[client_id])
+            return
+        if kind == 'create-man-cert':
+            response = {'pem':'PEM {}'.format(serial_number), 'cert_id':'id-{}'.format(serial_number)}
+        else:
+            response = {'cert_id':json.loads(payload)['cert_id']}
+        rspn_topic = topic.replace('/rqst', '/rspn')
+        # A response without the expected key is not the answer
+        self.broker.publish(rspn_topic, json.dumps({'status':'working'}))
+        self.broker.publish(rspn_topic, json.dumps(response))
+
+'''
+    Count connected devices: connect() takes a connection, disconnect()
+    gives it back
+'''
+class CountingDevice(GatewayDevice):
+    async def connect(self, cert_filename, key_filename):
+        self.gateway.active += 1
+        self.gateway.max_active = max(self.gateway.max_active, self.gateway.active)
+        connected = await super().connect(cert_filename, key_filename)
+        if not connected:
+            self.gateway.active -= 1
+        return connected
+
+    def disconnect(self):
+        if self.mqttc:
+            self.gateway.active -= 1
+        super().disconnect()
+
+    async def gen_csr(self):
+        with open(self.files.csr, 'w') as f:
+            f.write('CSR {}'.format(self.serial_number))
+        return True
+
+@pytest.fixture
+def devices_dir(work_dir, monkeypatch):
+    monkeypatch.setattr(gateway, 'JITP_RETRY', RetryPolicy(3, base=0))
+    monkeypatch.setattr(gateway, 'MAN_CERT_RETRY', RetryPolicy(2, base=0))
+    monkeypatch.setattr(gateway, 'GatewayDevice', CountingDevice)
+    devices_dir = str(work_dir / 'devices') + '/'
+    return devices_dir
+
+def make_devices(devices_dir, count):
+    serial_numbers = ['SN{}'.format(i) for i in range(count)]
+    for serial_number in serial_numbers:
+        os.makedirs('{}{}'.format(devices_dir, serial_number))
+    return serial_numbers
+
+'''
+    Run the gateway for serial_numbers against responder's broker.
+    Returns (results, gateway).
+'''
+def run_gateway(responder, devices_dir, serial_numbers, max_connections=50):
+    async def run():
+        await responder.broker.start()
+        device_gateway = Gateway(loop, serial_numbers, max_connections, devices_dir,
+            endpoint='127.0.0.1', port=responder.broker.port, tls=False)
+        device_gateway.active = 0
+        device_gateway.max_active = 0
+        try:
+            return await asyncio.wait_for(device_gateway.rotate(), 30), device_gateway
+        finally:
+            responder.broker.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+def test_list_serial_numbers(work_dir):
+    devices_dir = str(work_dir / 'devices') + '/'
+    assert gateway.list_serial_numbers(devices_dir) == []
+    make_devices(devices_dir, 2)
+    open('{}notes.txt'.format(devices_dir), 'w').close()
+
+    assert gateway.list_serial_numbers(devices_dir) == ['SN0', 'SN1']
+
+def test_rotates_devices_within_the_connection_limit(devices_dir):
+    responder = Responder()
+    serial_numbers = make_devices(devices_dir, 12)
+
+    results, device_gateway = run_gateway(responder, devices_dir, serial_numbers, max_connections=3)
+
+    assert results == {sn: True for sn in serial_numbers}
+    assert 1 < device_gateway.max_active <= 3
+    assert device_gateway.active == 0
+    for sn in serial_numbers:
+        files = device_files(sn, devices_dir)
+        assert read_rotate_phase(files.journal) == ROTATE_COMPLETED
+        with open(files.man_cert, 'r') as f:
+            assert f.read() == 'PEM {}'.format(sn)
+        assert responder.requests.count((sn, 'create-man-cert')) == 1
+        assert responder.requests.count((sn, 'ack-man-cert')) == 1
+
+def test_dropped_connect_is_retried(devices_dir):
+    responder = Responder()
+    serial_numbers = make_devices(devices_dir, 2)
+    responder.refuse = set(serial_numbers)
+
+    start = time.monotonic()
+    results, device_gateway = run_gateway(responder, devices_dir, serial_numbers)
+
+    assert results == {'SN0': True, 'SN1': True}
+    # The drop resolved the connect future; WAIT_CONNECT didn't run out
+    assert time.monotonic() - start < gateway.WAIT_CONNECT
+    assert responder.broker.refused == 2
+
+def test_hang_up_resolves_the_pending_response(devices_dir):
+    responder = Responder()
+    serial_numbers = make_devices(devices_dir, 1)
+    responder.hang_up = {'create-man-cert'}
+
+    start = time.monotonic()
+    results, device_gateway = run_gateway(responder, devices_dir, serial_numbers)
+
+    assert results == {'SN0': False}
+    # Each attempt ended at the hang up, not after WAIT_MAN_CERT_ATTEMPT,
+    # and a disconnected device doesn't publish again on that connection
+    assert time.monotonic() - start < gateway.WAIT_MAN_CERT_ATTEMPT
+    assert responder.requests == [('SN0', 'create-man-cert')] * gateway.JITP_RETRY.attempts
+    assert device_gateway.active == 0
+
+def test_resumes_at_the_ack(devices_dir):
+    responder = Responder()
+    serial_numbers = make_devices(devices_dir, 1)
+    files = device_files('SN0', devices_dir)
+    with open(files.man_cert_id, 'w') as f:
+        f.write('id-SN0\n')
+    write_rotate_phase(ROTATE_MAN_CERT, files.journal, 'SN0')
+
+    results, device_gateway = run_gateway(responder, devices_dir, serial_numbers)
+
+    assert results == {'SN0': True}
+    assert responder.requests == [('SN0', 'ack-man-cert')]
+
+def test_one_device_failing_does_not_stop_the_others(devices_dir):
+    responder = Responder()
+    serial_numbers = make_devices(devices_dir, 3)
+    # No cert id to ack with
+    write_rotate_phase(ROTATE_MAN_CERT, device_files('SN1', devices_dir).journal, 'SN1')
+
+    results, device_gateway = run_gateway(responder, devices_dir, serial_numbers)
+
+    assert results == {'SN0': True, 'SN1': False, 'SN2': True}
+    assert device_gateway.active == 0
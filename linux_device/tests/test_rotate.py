@@ -0,0 +1,159 @@
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+    filename: test_rotate.py
+
+    mqtt_client.py --rotate with a stubbed MQTTClient: the phase journal,
+    and resuming a stopped rotation without repeating finished phases
+'''
+import os
+import json
+import pytest
+import mqtt_client
+from mqtt_client import *
+from retry_policy import RetryPolicy
+
+'''
+    Stands in for MQTTClient and the CSR step. Each connect, request, and
+    CSR is recorded; connect_results, create_results and ack_results are
+    popped to fail the next ones, and default to success.
+'''
+class FakeDevice():
+    def __init__(self):
+        self.connects = []
+        self.requests = []
+        self.csrs = 0
+        self.connect_results = []
+        self.create_results = []
+        self.ack_results = []
+
+    def gen_cert_info(self):
+        self.csrs += 1
+        with open('{}{}.csr'.format(data_dir, serial_number), 'w') as f:
+            f.write('CSR {}'.format(self.csrs))
+
+    def client(self, client_id, cert_filename, key_filename=vendor_key_filename):
+        return FakeClient(self, cert_filename)
+
+class FakeClient():
+    def __init__(self, device, cert_filename):
+        self.device = device
+        device.connects.append(cert_filename)
+        self.connect_flag = device.connect_results.pop(0) if device.connect_results else True
+        self.man_cert_pem = ''
+        self.man_cert_id = ''
+
+    def create_man_cert(self):
+        with open('{}{}.csr'.format(data_dir, serial_number), 'r') as f:
+            self.device.requests.append(('create', f.read()))
+        if self.device.create_results and not self.device.create_results.pop(0):
+            return False
+        self.man_cert_pem = 'MAN CERT PEM\n'
+        self.man_cert_id = 'man-cert-id'
+        return True
+
+    def ack_man_cert(self):
+        with open('{}{}_man_cert_id.txt'.format(data_dir, serial_number), 'r') as f:
+            self.device.requests.append(('ack', f.read()))
+        self.man_cert_id = 'man-cert-id'
+        return not self.device.ack_results or self.device.ack_results.pop(0)
+
+    def disconnect(self):
+        pass
+
+@pytest.fixture
+def device(work_dir, monkeypatch):
+    device = FakeDevice()
+    monkeypatch.setattr(mqtt_client, 'MQTTClient', device.client)
+    monkeypatch.setattr(mqtt_client, 'gen_cert_info', device.gen_cert_info)
+    monkeypatch.setattr(mqtt_client, 'JITP_RETRY', RetryPolicy(3, base=0))
+    monkeypatch.setattr(mqtt_client, 'MAN_CERT_RETRY', RetryPolicy(2, base=0))
+    return device
+
+def test_phase_journal(work_dir):
+    assert read_rotate_phase() == ROTATE_START
+
+    write_rotate_phase(ROTATE_CSR)
+
+    assert read_rotate_phase() == ROTATE_CSR
+    with open(rotate_journal_filename, 'r') as f:
+        assert json.load(f)['serial_number'] == serial_number
+    assert not os.path.exists('{}.tmp'.format(rotate_journal_filename))
+
+    with open(rotate_journal_filename, 'w') as f:
+        f.write('{"phase": "cs')
+    assert read_rotate_phase() == ROTATE_START
+
+def test_rotate_in_one_run(device):
+    with open(manufacturer_rootCA_filename, 'w') as f:
+        f.write('MAN CA PEM\n')
+
+    assert rotate()
+
+    # One vendor cert connection does JITP and carries the CSR
+    assert device.connects == [vendor_device_cert_and_cacert_filename,
+        manufacturer_device_cert_and_cacert_filename]
+    assert device.requests == [('create', 'CSR 1'), ('ack', 'man-cert-id')]
+    assert read_rotate_phase() == ROTATE_COMPLETED
+    with open(manufacturer_device_cert_and_cacert_filename, 'r') as f:
+        assert f.read() == 'MAN CERT PEM\nMAN CA PEM\n'
+
+def test_jitp_connect_is_retried(device):
+    device.connect_results = [False, False]
+
+    assert rotate()
+    assert device.connects.count(vendor_device_cert_and_cacert_filename) == 3
+
+def test_jitp_failure_leaves_the_phase_unchanged(device):
+    device.connect_results = [False] * 3
+
+    assert not rotate()
+    assert read_rotate_phase() == ROTATE_START
+    assert device.csrs == 0
+
+def test_create_failure_resumes_without_a_new_csr(device):
+    device.create_results = [False]
+
+    assert not rotate()
+    assert read_rotate_phase() == ROTATE_CSR
+
+    assert rotate()
+    # JITP is redone on reconnect, but the sent CSR is sent again as is
+    assert device.csrs == 1
+    assert device.requests[:2] == [('create', 'CSR 1'), ('create', 'CSR 1')]
+    assert read_rotate_phase() == ROTATE_COMPLETED
+
+def test_ack_failure_resumes_with_the_manufacturer_cert(device):
+    device.ack_results = [False]
+
+    assert not rotate()
+    assert read_rotate_phase() == ROTATE_MAN_CERT
+    device.connects = []
+    device.requests = []
+
+    assert rotate()
+    assert device.connects == [manufacturer_device_cert_and_cacert_filename]
+    assert device.requests == [('ack', 'man-cert-id')]
+    assert device.csrs == 1
+
+def test_completed_rotation_is_not_repeated(device):
+    write_rotate_phase(ROTATE_COMPLETED)
+
+    assert rotate()
+    assert device.connects == []
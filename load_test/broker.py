@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+ filename: broker.py
+
+ Minimal MQTT 3.1.1 broker for the load test. Enough of the protocol for
+ mqtt_client.py and gateway.py: CONNECT, SUBSCRIBE, UNSUBSCRIBE, PUBLISH at
+ QoS 0 and 1, PINGREQ, and DISCONNECT. No TLS, retained messages,
+ persistent sessions, or QoS 2.
+
+ on_connect(client_id) returns False to drop a connection without a
+ CONNACK, the way IoT Core drops a JITP device's first connection.
+ on_publish(client_id, topic, payload) sees every PUBLISH, for the rule
+ bridge. publish() may be called from any thread.
+'''
+import asyncio
+import struct
+import logging
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+'''
+    True if topic matches the subscription filter, with + and # wildcards
+'''
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    if topic.startswith('$') and not topic_filter.startswith('$'):
+        return False
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+def encode_length(length):
+    encoded = b''
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded += bytes([byte | (0x80 if length else 0)])
+        if not length:
+            return encoded
+
+def encode_string(string):
+    encoded = string.encode()
+    return struct.pack('!H', len(encoded)) + encoded
+
+def packet(packet_type, flags, body):
+    return bytes([(packet_type << 4) | flags]) + encode_length(len(body)) + body
+
+class Session:
+    """
+    One client connection
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = None
+        self.filters = set()
+        self.mid = 0
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def send_publish(self, topic, payload, qos):
+        body = encode_string(topic)
+        if qos:
+            self.mid = self.mid % 65535 + 1
+            body += struct.pack('!H', self.mid)
+        self.send(packet(PUBLISH, qos << 1, body + payload))
+
+class MqttBroker:
+    def __init__(self, host='127.0.0.1', port=0, on_connect=None, on_publish=None):
+        self.host = host
+        self.port = port
+        self.on_connect = on_connect
+        self.on_publish = on_publish
+        self.loop = None
+        self.server = None
+        self.sessions = {}
+        # Exact topic subscriptions are a dict lookup, wildcards are scanned
+        self.exact = {}
+        self.wildcards = {}
+        self.connects = 0
+        self.refused = 0
+        self.publishes = 0
+
+    async def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, backlog=4096)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info('MqttBroker.start(): listening on {}:{}'.format(self.host, self.port))
+
+    def close(self):
+        if self.server:
+            self.server.close()
+        for session in list(self.sessions.values()):
+            session.writer.close()
+
+    def publish(self, topic, payload, qos=1):
+        """
+        Deliver payload to topic's subscribers. Thread safe.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.loop.call_soon_threadsafe(self.route, topic, payload, qos)
+
+    def route(self, topic, payload, qos=1):
+        sessions = set(self.exact.get(topic, ()))
+        for topic_filter, subscribers in self.wildcards.items():
+            if topic_matches(topic_filter, topic):
+                sessions |= subscribers
+        for session in sessions:
+            session.send_publish(topic, payload, qos)
+
+    def subscribe(self, session, topic_filter):
+        subscriptions = self.wildcards if '+' in topic_filter or '#' in topic_filter else self.exact
+        subscriptions.setdefault(topic_filter, set()).add(session)
+        session.filters.add(topic_filter)
+
+    def unsubscribe(self, session, topic_filter):
+        for subscriptions in [self.exact, self.wildcards]:
+            subscribers = subscriptions.get(topic_filter, None)
+            if subscribers is not None:
+                subscribers.discard(session)
+                if not subscribers:
+                    del subscriptions[topic_filter]
+        session.filters.discard(topic_filter)
+
+    def end_session(self, session):
+        for topic_filter in list(session.filters):
+            self.unsubscribe(session, topic_filter)
+        if self.sessions.get(session.client_id, None) is session:
+            del self.sessions[session.client_id]
+        session.writer.close()
+
+    async def read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0f, await reader.readexactly(length)
+
+    def handle_connect(self, session, body):
+        protocol_length = struct.unpack('!H', body[:2])[0]
+        i = 2 + protocol_length + 4     # protocol name, level, flags, keepalive
+        client_id_length = struct.unpack('!H', body[i:i + 2])[0]
+        session.client_id = body[i + 2:i + 2 + client_id_length].decode()
+        self.connects += 1
+        if self.on_connect and self.on_connect(session.client_id) is False:
+            self.refused += 1
+            return False
+
+        # A second connection with the same client id closes the first
+        old = self.sessions.get(session.client_id, None)
+        if old:
+            self.end_session(old)
+        self.sessions[session.client_id] = session
+        session.send(packet(CONNACK, 0, b'\0\0'))
+        return True
+
+    def handle_publish(self, session, flags, body):
+        topic_length = struct.unpack('!H', body[:2])[0]
+        topic = body[2:2 + topic_length].decode()
+        qos = (flags >> 1) & 3
+        payload = body[2 + topic_length:]
+        if qos:
+            session.send(packet(PUBACK, 0, payload[:2]))
+            payload = payload[2:]
+        self.publishes += 1
+        self.route(topic, payload)
+        if self.on_publish:
+            self.on_publish(session.client_id, topic, payload)
+
+    def handle_subscribe(self, session, body):
+        granted = b''
+        i = 2
+        while i < len(body):
+            filter_length = struct.unpack('!H', body[i:i + 2])[0]
+            self.subscribe(session, body[i + 2:i + 2 + filter_length].decode())
+            i += 2 + filter_length + 1
+            granted += b'\1'
+        session.send(packet(SUBACK, 0, body[:2] + granted))
+
+    def handle_unsubscribe(self, session, body):
+        i = 2
+        while i < len(body):
+            filter_length = struct.unpack('!H', body[i:i + 2])[0]
+            self.unsubscribe(session, body[i + 2:i + 2 + filter_length].decode())
+            i += 2 + filter_length
+        session.send(packet(UNSUBACK, 0, body[:2]))
+
+    async def handle(self, reader, writer):
+        session = Session(writer)
+        try:
+            packet_type, flags, body = await self.read_packet(reader)
+            if packet_type != CONNECT or not self.handle_connect(session, body):
+                writer.close()
+                return
+            while True:
+                packet_type, flags, body = await self.read_packet(reader)
+                if packet_type == PUBLISH:
+                    self.handle_publish(session, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    self.handle_subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self.handle_unsubscribe(session, body)
+                elif packet_type == PINGREQ:
+                    session.send(packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.error('MqttBroker.handle(): {} Exception = {}'.format(session.client_id, str(e)))
+        self.end_session(session)
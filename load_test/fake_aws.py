@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+ filename: fake_aws.py
+
+ In-memory stand-ins for the AWS calls the cert rotation lambda makes, for
+ running it in-process under the load test. Installed with clients.py's
+ test hooks. Each keeps just enough state for the rotation flow:
+
+    FakeTable      DynamoDB Table: get_item, put_item, and the UpdateItem
+                   expressions dyn_db.update_device() writes
+    FakeDynamoDB   DynamoDB resource: batch_get_item
+    FakeIot        IoT: CA and device certs, policies, thing principals
+    FakeSsm        SSM: the Manufacturer CA key
+    FakeIotData    IoT data plane: publish, delivered by the local broker
+    FakeSqs        SQS: send_message, into the rule bridge's local queues
+
+ Errors carry a botocore style response, so clients.error_code() reads them.
+'''
+import re
+import ssl
+import copy
+import hashlib
+import threading
+
+ACCOUNT = '123456789012'
+REGION = 'us-east-1'
+
+class FakeClientError(Exception):
+    def __init__(self, code, operation):
+        super().__init__('An error occurred ({}) when calling the {} operation'.format(code, operation))
+        self.response = {'Error': {'Code': code, 'Message': code}}
+
+def cert_id_of(cert_pem):
+    return hashlib.sha256(ssl.PEM_cert_to_DER_cert(cert_pem)).hexdigest()
+
+def cert_arn_of(cert_id):
+    return 'arn:aws:iot:{}:{}:cert/{}'.format(REGION, ACCOUNT, cert_id)
+
+class FakeTable:
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.rows = {}
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def project(self, item, projection):
+        if not projection:
+            return copy.deepcopy(item)
+        return {name: copy.deepcopy(item[name]) for name in projection.split(', ') if name in item}
+
+    def get_item(self, Key, ProjectionExpression=None, ConsistentRead=False):
+        with self.lock:
+            self.count('GetItem')
+            item = self.rows.get(Key['SerialNumber'], None)
+            return {'Item': self.project(item, ProjectionExpression)} if item else {}
+
+    def put_item(self, Item, **kwargs):
+        with self.lock:
+            self.count('PutItem')
+            self.rows[Item['SerialNumber']] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None,
+        ExpressionAttributeNames={}, ExpressionAttributeValues={}, ReturnValues=None):
+        names = ExpressionAttributeNames
+        values = ExpressionAttributeValues
+        with self.lock:
+            self.count('UpdateItem')
+            row = self.rows.get(Key['SerialNumber'], None)
+            ok = row is not None or 'attribute_exists' not in (ConditionExpression or '')
+            states = re.search(r'#state IN \((.*)\)', ConditionExpression or '')
+            if ok and states:
+                ok = row.get('CrState', None) in [values[v.strip()] for v in states.group(1).split(',')]
+            if not ok:
+                raise FakeClientError('ConditionalCheckFailedException', 'UpdateItem')
+
+            row = row if row is not None else {'SerialNumber': Key['SerialNumber']}
+            set_actions = re.search(r'SET (.*?)( REMOVE|$)', UpdateExpression)
+            if set_actions:
+                for action in set_actions.group(1).split(', '):
+                    name, value = action.split(' = ')
+                    row[names.get(name, name)] = copy.deepcopy(values[value])
+            remove_actions = re.search(r'REMOVE (.*)', UpdateExpression)
+            if remove_actions:
+                for name in remove_actions.group(1).split(', '):
+                    row.pop(names.get(name, name), None)
+            self.rows[Key['SerialNumber']] = row
+            return {'Attributes': copy.deepcopy(row)}
+
+class FakeDynamoDB:
+    def __init__(self, tables):
+        self.tables = tables
+
+    def Table(self, table_name):
+        return self.tables[table_name]
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.tables[table_name]
+            with table.lock:
+                table.count('BatchGetItem')
+                responses[table_name] = [table.project(table.rows[key['SerialNumber']],
+                    request.get('ProjectionExpression', None))
+                    for key in request['Keys'] if key['SerialNumber'] in table.rows]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+class FakeIot:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ca_certs = {}
+        self.certs = {}
+        self.principals = {}
+        self.calls = {}
+
+    def count(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def add_ca_certificate(self, ca_cert_pem):
+        ca_cert_id = cert_id_of(ca_cert_pem)
+        self.ca_certs[ca_cert_id] = ca_cert_pem
+        return ca_cert_id
+
+    def add_certificate(self, cert_pem, ca_cert_id=None, status='ACTIVE'):
+        cert_id = cert_id_of(cert_pem)
+        with self.lock:
+            self.certs[cert_id] = {'certificateId': cert_id, 'certificateArn': cert_arn_of(cert_id),
+                'certificatePem': cert_pem, 'caCertificateId': ca_cert_id, 'status': status,
+                'policies': set()}
+        return cert_id
+
+    def cert(self, certificateId, operation):
+        cert = self.certs.get(certificateId, None)
+        if not cert:
+            raise FakeClientError('ResourceNotFoundException', operation)
+        return cert
+
+    def cert_by_arn(self, arn, operation):
+        return self.cert(arn.split('/')[-1], operation)
+
+    def describe_ca_certificate(self, certificateId):
+        self.count('DescribeCACertificate')
+        if certificateId not in self.ca_certs:
+            raise FakeClientError('ResourceNotFoundException', 'DescribeCACertificate')
+        return {'certificateDescription': {'certificateId': certificateId,
+            'certificatePem': self.ca_certs[certificateId], 'status': 'ACTIVE'}}
+
+    def describe_certificate(self, certificateId):
+        self.count('DescribeCertificate')
+        cert = self.cert(certificateId, 'DescribeCertificate')
+        return {'certificateDescription': {k: v for k, v in cert.items() if k != 'policies'}}
+
+    def register_certificate(self, certificatePem, caCertificatePem=None, setAsActive=False, status=None):
+        self.count('RegisterCertificate')
+        cert_id = cert_id_of(certificatePem)
+        if cert_id in self.certs:
+            raise FakeClientError('ResourceAlreadyExistsException', 'RegisterCertificate')
+        ca_cert_id = cert_id_of(caCertificatePem) if caCertificatePem else None
+        self.add_certificate(certificatePem, ca_cert_id, 'ACTIVE' if setAsActive else (status or 'INACTIVE'))
+        return {'certificateId': cert_id, 'certificateArn': cert_arn_of(cert_id)}
+
+    def attach_policy(self, policyName, target):
+        self.count('AttachPolicy')
+        self.cert_by_arn(target, 'AttachPolicy')['policies'].add(policyName)
+        return {}
+
+    def detach_policy(self, policyName, target):
+        self.count('DetachPolicy')
+        self.cert_by_arn(target, 'DetachPolicy')['policies'].discard(policyName)
+        return {}
+
+    def attach_thing_principal(self, thingName, principal):
+        self.count('AttachThingPrincipal')
+        with self.lock:
+            self.principals.setdefault(thingName, set()).add(principal)
+        return {}
+
+    def detach_thing_principal(self, thingName, principal):
+        self.count('DetachThingPrincipal')
+        with self.lock:
+            self.principals.get(thingName, set()).discard(principal)
+        return {}
+
+    def update_certificate(self, certificateId, newStatus):
+        self.count('UpdateCertificate')
+        self.cert(certificateId, 'UpdateCertificate')['status'] = newStatus
+        return {}
+
+    def delete_certificate(self, certificateId, forceDelete=False):
+        self.count('DeleteCertificate')
+        self.cert(certificateId, 'DeleteCertificate')
+        with self.lock:
+            del self.certs[certificateId]
+        return {}
+
+    def describe_endpoint(self, endpointType=None):
+        return {'endpointAddress': 'localhost'}
+
+class FakeSsm:
+    def __init__(self):
+        self.parameters = {}
+
+    def get_parameter(self, Name, WithDecryption=False):
+        if Name not in self.parameters:
+            raise FakeClientError('ParameterNotFound', 'GetParameter')
+        return {'Parameter': {'Name': Name, 'Value': self.parameters[Name]}}
+
+class FakeIotData:
+    def __init__(self, broker):
+        self.broker = broker
+        self.publishes = 0
+
+    def publish(self, topic, qos=0, payload=b''):
+        self.publishes += 1
+        self.broker.publish(topic, payload, qos)
+        return {}
+
+class FakeSqs:
+    def __init__(self, queues):
+        self.queues = queues
+
+    def send_message(self, QueueUrl, MessageBody):
+        if QueueUrl not in self.queues:
+            raise FakeClientError('AWS.SimpleQueueService.NonExistentQueue', 'SendMessage')
+        return {'MessageId': self.queues[QueueUrl].send_body(MessageBody)}
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+ filename: fleet_sim.py
+
+ End-to-end load test of the rotation flow on one machine. Starts the
+ local MQTT broker (broker.py) and the rule bridge (rule_bridge.py), which
+ runs the cert rotation lambda in this process against fake_aws.py's
+ stubbed AWS services. Then spawns device processes, each running an
+ asyncio gateway.Gateway of virtual devices that do the mqtt_client.py
+ --rotate protocol: connect (the first connect is dropped, as JITP does),
+ CSR, Manufacturer cert, reconnect, and ack.
+
+ Reports rotation throughput, p50/p95/p99 latency of each device phase
+ and of the lambda invocations, and error rates. Rotations not done by
+ --deadline count as failed, and any failed rotation exits with status 1.
+
+ Needs pyOpenSSL < 26 (the lambda's CSR calls), paho-mqtt < 2, boto3, and
+ the openssl command line; see the Load Test section of the README.
+
+ python fleet_sim.py --devices 2000 --processes 4 --connections 200
+ python fleet_sim.py --template cfn_cert_rotation_sqs.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import asyncio
+import logging
+import warnings
+import multiprocessing
+
+LOAD_TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(LOAD_TEST_DIR, '..', 'aws_cloud', 'cloud_formation', 'cert_rotation_lambda')
+DEVICE_DIR = os.path.join(LOAD_TEST_DIR, '..', 'linux_device')
+TEMPLATE_DIR = os.path.join(LOAD_TEST_DIR, '..', 'aws_cloud', 'cloud_formation')
+
+JITP_DELAY = 0.05 # Seconds from a dropped first connect to its registered event
+DRAIN_TIMEOUT = 30 # Seconds to wait for the lambda queues after the devices finish
+DEADLINE_GRACE = 30 # Seconds past the deadline before stuck device processes are killed
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def latency_summary(values):
+    return {'p50': round(percentile(values, 50), 4), 'p95': round(percentile(values, 95), 4),
+        'p99': round(percentile(values, 99), 4), 'max': round(max(values), 4) if values else 0}
+
+'''
+    Device process: rotate serial_numbers with one asyncio gateway against
+    the broker on port, until deadline (time.time()). Runs in a spawned
+    process, so the device code's config.py never meets the lambda's.
+'''
+def run_devices(serial_numbers, port, work_dir, connections, verbose, deadline):
+    # linux_device/config.py's paths are relative to the working directory
+    os.chdir(work_dir)
+    sys.path.insert(0, os.path.abspath(DEVICE_DIR))
+    import gateway
+    import mqtt_client
+    logging.getLogger().setLevel(logging.INFO if verbose else logging.WARNING)
+
+    rotations = []
+    async def timed_rotate(device, rotate):
+        start = time.monotonic()
+        rc = await rotate()
+        rotations.append((device.serial_number, time.monotonic() - start, bool(rc)))
+        return rc
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    device_gateway = gateway.Gateway(loop, serial_numbers, connections,
+        endpoint='127.0.0.1', port=port, tls=False)
+    for device in device_gateway.devices:
+        device.rotate = (lambda device, rotate: lambda: timed_rotate(device, rotate))(device, device.rotate)
+    start = time.monotonic()
+    try:
+        loop.run_until_complete(asyncio.wait_for(device_gateway.rotate(),
+            max(0, deadline - time.time())))
+    except asyncio.TimeoutError:
+        logging.warning('run_devices(): deadline reached')
+    finally:
+        loop.close()
+
+    # Devices cut off by the deadline failed
+    finished = set(r[0] for r in rotations)
+    unfinished = [sn for sn in serial_numbers if sn not in finished]
+    rotations += [(sn, time.monotonic() - start, False) for sn in unfinished]
+    return {'rotations': rotations, 'phases': mqtt_client.phase_timings,
+        'timed_out': len(unfinished)}
+
+'''
+    Fail fast when the lambda can't run here, rather than rejecting or
+    retrying every request until the deadline
+'''
+def check_dependencies():
+    from OpenSSL import crypto
+    import paho.mqtt
+    problems = []
+    with warnings.catch_warnings():
+        # pyOpenSSL 24+ warns on any CSR attribute
+        warnings.simplefilter('ignore')
+        has_csr_support = hasattr(crypto, 'load_certificate_request')
+    if not has_csr_support:
+        problems.append('pyOpenSSL {} has no crypto.load_certificate_request, install pyOpenSSL<26'.\
+            format(__import__('OpenSSL').__version__))
+    if int(paho.mqtt.__version__.split('.')[0]) >= 2:
+        problems.append('paho-mqtt {} is not supported, install paho-mqtt<2'.format(paho.mqtt.__version__))
+    if not shutil.which('openssl'):
+        problems.append('openssl command line not found')
+    return problems
+
+class Fleet:
+    """
+    The broker, rule bridge, lambda, and fake AWS services, all in this
+    process, and the devices' files
+    """
+    def __init__(self, args):
+        self.args = args
+        self.serial_numbers = ['SIM{:06d}'.format(i) for i in range(args.devices)]
+        self.work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='fleet_sim_'))
+        # Laid out as linux_device's data_io/ and gateway_data_dir
+        self.data_dir = os.path.join(self.work_dir, 'data_io', 'devices') + '/'
+        self.vendor_certs = {}
+        self.provisioned = set()
+
+    def start_lambda(self):
+        from broker import MqttBroker
+        from rule_bridge import RuleBridge
+        template = self.args.template
+        if not os.path.exists(template):
+            template = os.path.join(TEMPLATE_DIR, template)
+        self.broker = MqttBroker(on_connect=self.on_connect)
+        self.bridge = RuleBridge(template, os.path.abspath(LAMBDA_DIR), self.broker,
+            self.args.lambda_concurrency)
+        self.broker.on_publish = self.bridge.on_publish
+
+        # The lambda's config.py reads its environment at import
+        os.environ.update(self.bridge.environment())
+        sys.path.insert(0, os.path.abspath(LAMBDA_DIR))
+        import clients
+        import config as lambda_config
+        import dyn_db
+        import metrics
+        import local_queue
+        from fake_aws import FakeTable, FakeDynamoDB, FakeIot, FakeSsm, FakeIotData, FakeSqs
+        logging.getLogger().setLevel(logging.INFO if self.args.verbose else logging.WARNING)
+
+        self.table = FakeTable(dyn_db.ddb_table_name)
+        self.iot = FakeIot()
+        self.ssm = FakeSsm()
+        clients.set_resource('dynamodb', FakeDynamoDB({self.table.table_name: self.table}))
+        clients.set_table(self.table.table_name, self.table)
+        clients.set_client('iot', self.iot)
+        clients.set_client('ssm', self.ssm)
+        clients.set_client('iot-data', FakeIotData(self.broker))
+        clients.set_client('sqs', FakeSqs(self.bridge.queues))
+        metrics.put_metric = self.bridge.put_metric
+        self.lambda_config = lambda_config
+
+        self.seed()
+        self.bridge.start(local_queue.LocalQueue)
+
+        started = threading.Event()
+        def serve():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.broker.start())
+            started.set()
+            loop.run_forever()
+        threading.Thread(target=serve, daemon=True).start()
+        started.wait()
+
+    def make_cert(self, crypto, key, subject_cn, issuer=None, issuer_key=None):
+        cert = crypto.X509()
+        cert.get_subject().CN = subject_cn
+        cert.set_serial_number(int.from_bytes(os.urandom(8), 'big'))
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(365 * 24 * 60 * 60)
+        cert.set_issuer((issuer or cert).get_subject())
+        cert.set_pubkey(key)
+        cert.sign(issuer_key or key, 'sha256')
+        return cert
+
+    def seed(self):
+        """
+        Manufacturer CA and its key, a whitelisted row and a vendor cert
+        for each device, and the device files
+        """
+        from OpenSSL import crypto
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 2048)
+        key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, key).decode()
+
+        man_ca = self.make_cert(crypto, key, 'SimManufacturerCA')
+        man_ca_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, man_ca).decode()
+        man_ca_id = self.iot.add_ca_certificate(man_ca_pem)
+        os.makedirs(self.data_dir, exist_ok=True)
+        with open(os.path.join(self.work_dir, 'data_io', 'Manufacturer_rootCA.pem'), 'w') as f:
+            f.write(man_ca_pem)
+        self.ssm.parameters['cr-ca-key-{}'.format(man_ca_id)] = key_pem
+        vendor_ca = self.make_cert(crypto, key, 'SimVendorCA')
+        self.vendor_ca_id = self.iot.add_ca_certificate(crypto.dump_certificate(crypto.FILETYPE_PEM, vendor_ca).decode())
+
+        # One key serves every virtual device; key generation isn't under test
+        for sn in self.serial_numbers:
+            vendor_cert = self.make_cert(crypto, key, sn, vendor_ca, key)
+            self.vendor_certs[sn] = self.iot.add_certificate(
+                crypto.dump_certificate(crypto.FILETYPE_PEM, vendor_cert).decode(),
+                self.vendor_ca_id, 'PENDING_ACTIVATION')
+            self.table.rows[sn] = {'SerialNumber': sn, 'CrState': self.lambda_config.CR_WHITELISTED,
+                'ManufacturerCaCertId': man_ca_id}
+
+            device_dir = '{}{}/'.format(self.data_dir, sn)
+            os.makedirs(device_dir, exist_ok=True)
+            with open('{}{}_ven.key'.format(device_dir, sn), 'w') as f:
+                f.write(key_pem)
+            for name in ['_rotate.json', '.csr', '_man.pem', '_man_cert_id.txt']:
+                if os.path.exists('{}{}{}'.format(device_dir, sn, name)):
+                    os.remove('{}{}{}'.format(device_dir, sn, name))
+
+    def on_connect(self, client_id):
+        """
+        Broker hook. Like JITP, the first connect of a vendor cert is
+        dropped and its registered event goes through the rules.
+        """
+        cert_id = self.vendor_certs.get(client_id, None)
+        if not cert_id:
+            return True
+        self.bridge.principals[client_id] = cert_id
+        if client_id in self.provisioned:
+            return True
+        self.provisioned.add(client_id)
+        self.broker.loop.call_later(JITP_DELAY, self.bridge.trigger,
+            '$aws/events/certificates/registered/{}'.format(self.vendor_ca_id),
+            {'certificateId': cert_id, 'caCertificateId': self.vendor_ca_id,
+                'certificateStatus': 'PENDING_ACTIVATION', 'awsAccountId': '123456789012',
+                'timestamp': int(time.time() * 1000)})
+        return False
+
+    def run(self):
+        args = self.args
+        chunks = [self.serial_numbers[i::args.processes] for i in range(args.processes)]
+        chunks = [chunk for chunk in chunks if chunk]
+        context = multiprocessing.get_context('spawn')
+        start = time.monotonic()
+        deadline = time.time() + args.deadline
+        with context.Pool(len(chunks)) as pool:
+            pending = pool.starmap_async(run_devices, [(chunk, self.broker.port, self.work_dir,
+                args.connections, args.verbose, deadline) for chunk in chunks])
+            try:
+                results = pending.get(timeout=args.deadline + DEADLINE_GRACE)
+            except multiprocessing.TimeoutError:
+                # Leaving the with block kills the device processes
+                logging.error('run(): device processes stuck past the deadline')
+                results = [{'rotations': [(sn, args.deadline, False) for sn in chunk],
+                    'phases': [], 'timed_out': len(chunk)} for chunk in chunks]
+        devices_seconds = time.monotonic() - start
+
+        # Let queued work, e.g. vendor cert cleanup, finish
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while not self.bridge.idle() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.bridge.stop()
+        return self.report(results, devices_seconds)
+
+    def report(self, results, devices_seconds):
+        rotations = [r for result in results for r in result['rotations']]
+        phases = [p for result in results for p in result['phases']]
+        completed = [r for r in rotations if r[2]]
+
+        device_phases = {}
+        for phase in ['connect', 'subscribe', 'publish', 'response']:
+            timings = [p for p in phases if p[0] == phase]
+            device_phases[phase] = dict(latency_summary([p[1] for p in timings if p[2]]),
+                count=len(timings), errors=len([p for p in timings if not p[2]]))
+        device_phases['rotation'] = dict(latency_summary([r[1] for r in completed]),
+            count=len(rotations), errors=len(rotations) - len(completed))
+
+        lambdas = {}
+        for logical_id, stats in self.bridge.stats.items():
+            lambdas[logical_id] = dict(latency_summary(stats.durations),
+                invocations=stats.invocations, errors=stats.errors,
+                records=stats.records, record_failures=stats.record_failures)
+
+        states = {}
+        for row in self.table.rows.values():
+            states[row['CrState']] = states.get(row['CrState'], 0) + 1
+
+        return {
+            'template': os.path.basename(self.args.template),
+            'devices': len(self.serial_numbers),
+            'processes': self.args.processes,
+            'connections_per_process': self.args.connections,
+            'lambda_concurrency': self.args.lambda_concurrency,
+            'seconds': round(devices_seconds, 3),
+            'deadline': self.args.deadline,
+            'timed_out': sum(result['timed_out'] for result in results),
+            'rotations_per_second': round(len(completed) / devices_seconds, 2) if devices_seconds else 0,
+            'rotation_error_rate': round(1 - len(completed) / len(rotations), 4) if rotations else 0,
+            'device_phases': device_phases,
+            'lambda': lambdas,
+            'rules': dict(self.bridge.rule_counts),
+            'dead_letters': {q.name: len(q.local_queue.dead_letters)
+                for q in self.bridge.queues.values() if q.function},
+            'broker': {'connects': self.broker.connects, 'refused': self.broker.refused,
+                'publishes': self.broker.publishes},
+            'device_states': states,
+            'metrics': dict(self.bridge.metrics),
+            'aws_calls': dict(self.table.calls, **self.iot.calls)
+            }
+
+def print_report(report):
+    print('{devices} devices, {processes} processes x {connections_per_process} connections, '
+        '{template}, lambda concurrency {lambda_concurrency}'.format(**report))
+    print('{} s, {} rotations/s, rotation error rate {:.2%}'.format(report['seconds'],
+        report['rotations_per_second'], report['rotation_error_rate']))
+    if report['timed_out']:
+        print('deadline of {} s reached, {} rotations unfinished'.format(report['deadline'],
+            report['timed_out']))
+    print('connect errors include the dropped first connect of each device (JITP)')
+    print('')
+    row = '{:<28} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'
+    print(row.format('device phase (s)', 'count', 'errors', 'p50', 'p95', 'p99', 'max'))
+    for phase, p in report['device_phases'].items():
+        print(row.format(phase, p['count'], p['errors'], p['p50'], p['p95'], p['p99'], p['max']))
+    print('')
+    print(row.format('lambda (s)', 'invokes', 'errors', 'p50', 'p95', 'p99', 'max'))
+    for name, p in report['lambda'].items():
+        print(row.format(name, p['invocations'], p['errors'] + p['record_failures'],
+            p['p50'], p['p95'], p['p99'], p['max']))
+    print('')
+    for key in ['rules', 'dead_letters', 'broker', 'device_states', 'metrics', 'aws_calls']:
+        print('{}: {}'.format(key, json.dumps(report[key], sort_keys=True)))
+
+def main():
+    argp = argparse.ArgumentParser(description='Cert rotation fleet simulator and load test')
+    argp.add_argument('--devices', type=int, default=1000, help='Virtual devices')
+    argp.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='Device processes')
+    argp.add_argument('--connections', type=int, default=100, help='Connections at once per device process')
+    argp.add_argument('--lambda_concurrency', type=int, default=10, help='Lambda invocations at once')
+    argp.add_argument('--template', default='cfn_cert_rotation.json', help='Cloud formation template for the rules and lambda')
+    argp.add_argument('--work_dir', default=None, help='Directory for the device files, default a temp dir')
+    argp.add_argument('--deadline', type=float, default=600, help='Seconds before unfinished rotations count as failed')
+    argp.add_argument('--report_file', default=None, help='Write the report as JSON')
+    argp.add_argument('--verbose', action='store_true', help='INFO logging')
+    args = argp.parse_args()
+
+    problems = check_dependencies()
+    if problems:
+        for problem in problems:
+            print('fleet_sim: {}'.format(problem))
+        sys.exit(2)
+
+    fleet = Fleet(args)
+    try:
+        fleet.start_lambda()
+        report = fleet.run()
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(fleet.work_dir, ignore_errors=True)
+    print_report(report)
+    if args.report_file:
+        with open(args.report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    if report['rotation_error_rate']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+'''
+MIT No Attribution
+
+Copyright Amazon Web Services
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+'''
+ filename: rule_bridge.py
+
+ Local stand-in for the IoT rules engine and lambda service. Reads the
+ topic rules, lambda functions, SQS queues, and event source mappings from
+ a cloud formation template (cfn_cert_rotation.json or
+ cfn_cert_rotation_sqs.json), evaluates each rule's SQL against the local
+ broker's publishes, and runs the rule's action in-process:
+
+    Lambda  the function's handler is called in a thread pool of
+            lambda_concurrency threads, like concurrent lambda instances
+    Sqs     the event goes on a LocalQueue, and the queue's event source
+            mapping feeds it to its function in batches
+
+ Only the rule SQL the templates use is supported: SELECT of *, fields,
+ topic(), topic(n), clientId(), principal(), and timestamp(), each with an
+ optional alias, FROM a topic filter, with no WHERE clause.
+'''
+import os
+import re
+import sys
+import json
+import time
+import importlib
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from broker import topic_matches
+
+# Template parameters and pseudo parameters
+ACCOUNT = '123456789012'
+REGION = 'us-east-1'
+
+class RuleSqlError(Exception):
+    pass
+
+'''
+    The rule's SELECT list as (expression, alias) pairs and its topic filter
+'''
+def parse_rule_sql(sql):
+    match = re.match(r"\s*SELECT\s+(.*?)\s+FROM\s+'([^']*)'\s*(WHERE\s+.*)?$", sql,
+        re.IGNORECASE | re.DOTALL)
+    if not match:
+        raise RuleSqlError('Unsupported rule SQL: {}'.format(sql))
+    if match.group(3):
+        raise RuleSqlError('WHERE is not supported: {}'.format(sql))
+
+    select = []
+    for item in match.group(1).split(','):
+        parts = re.match(r'\s*(\S+?)\s*(?:\s+as\s+(\w+))?\s*$', item, re.IGNORECASE)
+        if not parts:
+            raise RuleSqlError('Unsupported SELECT item: {}'.format(item))
+        expression, alias = parts.group(1), parts.group(2)
+        if not re.match(r'^(\*|[\w.]+|\w+\(\d*\))$', expression):
+            raise RuleSqlError('Unsupported SELECT item: {}'.format(item))
+        select.append((expression, alias))
+    return select, match.group(2)
+
+'''
+    Value of one SELECT expression for a message
+'''
+def eval_expression(expression, payload, topic, client_id, principal):
+    name = expression.lower()
+    if name == 'topic()':
+        return topic
+    match = re.match(r'topic\((\d+)\)', name)
+    if match:
+        levels = topic.split('/')
+        n = int(match.group(1))
+        return levels[n - 1] if 0 < n <= len(levels) else None
+    if name == 'clientid()':
+        return client_id
+    if name == 'principal()':
+        return principal
+    if name == 'timestamp()':
+        return int(time.time() * 1000)
+    if name.endswith('()'):
+        raise RuleSqlError('Unsupported function: {}'.format(expression))
+    value = payload
+    for field in expression.split('.'):
+        value = value.get(field, None) if isinstance(value, dict) else None
+    return value
+
+class TopicRule:
+    def __init__(self, name, sql, actions):
+        self.name = name
+        self.sql = sql
+        self.select, self.topic_filter = parse_rule_sql(sql)
+        self.actions = actions
+
+    def matches(self, topic):
+        return topic_matches(self.topic_filter, topic)
+
+    def evaluate(self, payload, topic, client_id, principal):
+        """
+        The event the rule's actions get for one message
+        """
+        event = {}
+        for expression, alias in self.select:
+            if expression == '*':
+                if alias:
+                    event[alias] = payload
+                elif isinstance(payload, dict):
+                    event.update(payload)
+            else:
+                event[alias or expression.split('.')[-1]] = \
+                    eval_expression(expression, payload, topic, client_id, principal)
+        return event
+
+'''
+    Resolve the intrinsic functions the templates use. References to other
+    resources become 'local:<logical id>'.
+'''
+def resolve(value, parameters):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict) and 'Ref' in value:
+        return parameters.get(value['Ref'], 'local:{}'.format(value['Ref']))
+    if isinstance(value, dict) and 'Fn::Sub' in value:
+        return re.sub(r'\$\{([^}]+)\}', lambda m: parameters.get(m.group(1), 'local:{}'.format(m.group(1))),
+            value['Fn::Sub'])
+    if isinstance(value, dict) and 'Fn::GetAtt' in value:
+        return 'local:{}'.format(value['Fn::GetAtt'][0])
+    raise ValueError('Unsupported template value: {}'.format(value))
+
+class LambdaStats:
+    """
+    Invocation count, errors, and durations of one function
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.invocations = 0
+        self.errors = 0
+        self.records = 0
+        self.record_failures = 0
+        self.durations = []
+
+    def add(self, seconds, error, records=0, record_failures=0):
+        with self.lock:
+            self.invocations += 1
+            self.errors += 1 if error else 0
+            self.records += records
+            self.record_failures += record_failures
+            self.durations.append(seconds)
+
+class BridgeQueue:
+    """
+    A template SQS queue: a LocalQueue behind a lock, with the batch size
+    and batching window of the event source mapping that reads it
+    """
+    def __init__(self, name, local_queue, batch_size=10, batch_window=0):
+        self.name = name
+        self.local_queue = local_queue
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.lock = threading.Lock()
+        self.function = None
+        self.sent = 0
+
+    def send_body(self, body):
+        with self.lock:
+            self.sent += 1
+            return self.local_queue.send_message(json.loads(body))
+
+    def __len__(self):
+        with self.lock:
+            return len(self.local_queue)
+
+class RuleBridge:
+    def __init__(self, template_filename, lambda_dir, broker, lambda_concurrency=10,
+        lambda_name='cert_rotation_lambda'):
+        self.broker = broker
+        self.lambda_dir = lambda_dir
+        self.lambda_concurrency = lambda_concurrency
+        self.parameters = {'AWS::Region': REGION, 'AWS::AccountId': ACCOUNT,
+            'AWS::Partition': 'aws', 'CertRotationLambdaName': lambda_name}
+        self.pool = ThreadPoolExecutor(max_workers=lambda_concurrency)
+        self.running = True
+        self.pollers = []
+        self.principals = {}
+        self.stats = {}
+        self.rule_counts = {}
+        self.metrics = {}
+        self.metrics_lock = threading.Lock()
+        self.inflight = 0
+        self.inflight_lock = threading.Lock()
+        self.load_template(template_filename)
+
+    def load_template(self, template_filename):
+        with open(template_filename, 'r') as f:
+            resources = json.load(f)['Resources']
+
+        self.functions = {}
+        self.queues = {}
+        self.rules = []
+        for logical_id, resource in resources.items():
+            properties = resource.get('Properties', {})
+            if resource['Type'] == 'AWS::Lambda::Function':
+                variables = properties.get('Environment', {}).get('Variables', {})
+                self.functions[logical_id] = {
+                    'name': resolve(properties['FunctionName'], self.parameters),
+                    'handler': resolve(properties['Handler'], self.parameters),
+                    'environment': {k: resolve(v, self.parameters) for k, v in variables.items()},
+                    'handler_func': None
+                    }
+            elif resource['Type'] == 'AWS::SQS::Queue':
+                redrive = properties.get('RedrivePolicy', {})
+                self.queues['local:{}'.format(logical_id)] = (logical_id, redrive.get('maxReceiveCount', 0))
+
+        for logical_id, resource in resources.items():
+            properties = resource.get('Properties', {})
+            if resource['Type'] == 'AWS::IoT::TopicRule':
+                payload = properties['TopicRulePayload']
+                if payload.get('RuleDisabled', False):
+                    continue
+                self.rules.append(TopicRule(logical_id, payload['Sql'], payload['Actions']))
+                self.rule_counts[logical_id] = 0
+        self.mappings = [resource['Properties'] for resource in resources.values()
+            if resource['Type'] == 'AWS::Lambda::EventSourceMapping']
+        logging.info('RuleBridge: rules {}, functions {}, queues {}'.format(
+            [rule.name for rule in self.rules], list(self.functions), list(self.queues)))
+
+    def environment(self):
+        """
+        Every function's environment variables. The functions share one
+        interpreter, so config.py sees all of them.
+        """
+        variables = {}
+        for function in self.functions.values():
+            variables.update(function['environment'])
+        return variables
+
+    def start(self, local_queue_class):
+        """
+        Make the queues and start their pollers. Call after the lambda
+        environment is set, since local_queue_class imports the lambda's
+        config.py.
+        """
+        for logical_id in self.functions:
+            self.handler(logical_id)
+        for url, (logical_id, max_receive_count) in list(self.queues.items()):
+            self.queues[url] = BridgeQueue(logical_id, local_queue_class(max_receive_count=max_receive_count or 5))
+        for mapping in self.mappings:
+            queue = self.queues[resolve(mapping['EventSourceArn'], self.parameters)]
+            queue.batch_size = mapping.get('BatchSize', 10)
+            queue.local_queue.batch_size = queue.batch_size
+            queue.batch_window = mapping.get('MaximumBatchingWindowInSeconds', 0)
+            queue.function = self.function(resolve(mapping['FunctionName'], self.parameters))
+            thread = threading.Thread(target=self.poll, args=(queue,), daemon=True)
+            thread.start()
+            self.pollers.append(thread)
+
+    def stop(self):
+        self.running = False
+        self.pool.shutdown(wait=True)
+
+    def function(self, reference):
+        """
+        Function logical id for a 'local:<logical id>' reference or an ARN
+        """
+        if reference.startswith('local:'):
+            return reference[len('local:'):]
+        name = reference.split(':function:')[-1]
+        for logical_id, function in self.functions.items():
+            if function['name'] == name:
+                return logical_id
+        raise KeyError('No function {}'.format(reference))
+
+    def handler(self, logical_id):
+        function = self.functions[logical_id]
+        if not function['handler_func']:
+            if self.lambda_dir not in sys.path:
+                sys.path.insert(0, self.lambda_dir)
+            module_name, func_name = function['handler'].rsplit('.', 1)
+            function['handler_func'] = getattr(importlib.import_module(module_name), func_name)
+            self.stats[logical_id] = LambdaStats()
+        return function['handler_func']
+
+    def context(self, logical_id):
+        """
+        The parts of the lambda context the handlers read
+        """
+        class Context:
+            pass
+        context = Context()
+        context.function_name = self.functions[logical_id]['name']
+        context.invoked_function_arn = 'arn:aws:lambda:{}:{}:function:{}'.\
+            format(REGION, ACCOUNT, context.function_name)
+        return context
+
+    def put_metric(self, name, value, unit='Count', dimensions={}):
+        """
+        Tallies metrics.put_metric() instead of printing EMF lines
+        """
+        key = '{}{}'.format(name, ''.join(['/{}={}'.format(k, dimensions[k]) for k in sorted(dimensions)]))
+        with self.metrics_lock:
+            self.metrics[key] = self.metrics.get(key, 0) + value
+
+    def invoke(self, logical_id, event):
+        handler = self.handler(logical_id)
+        start = time.monotonic()
+        error = False
+        records = len(event.get('Records', [])) if isinstance(event, dict) else 0
+        response = None
+        try:
+            response = handler(event, self.context(logical_id))
+        except Exception as e:
+            logging.error('RuleBridge.invoke(): {} Exception = {}'.format(logical_id, str(e)))
+            error = True
+        failures = len((response or {}).get('batchItemFailures', [])) if records else 0
+        self.stats[logical_id].add(time.monotonic() - start, error, records, failures)
+        return response, error
+
+    def invoke_async(self, logical_id, event):
+        with self.inflight_lock:
+            self.inflight += 1
+        future = self.pool.submit(self.invoke, logical_id, event)
+        future.add_done_callback(lambda f: self.done())
+
+    def done(self):
+        with self.inflight_lock:
+            self.inflight -= 1
+
+    def poll(self, queue):
+        """
+        The event source mapping: feed queue's batches to its function, up
+        to lambda_concurrency batches at once
+        """
+        slots = threading.Semaphore(self.lambda_concurrency)
+        handler = self.handler(queue.function)
+        while self.running:
+            if not len(queue):
+                time.sleep(0.01)
+                continue
+            if len(queue) < queue.batch_size and queue.batch_window:
+                time.sleep(min(queue.batch_window, 0.05))
+            slots.acquire()
+            with queue.lock:
+                sqs_event = queue.local_queue.receive_batch()
+            if not sqs_event['Records']:
+                slots.release()
+                continue
+            with self.inflight_lock:
+                self.inflight += 1
+
+            def run(sqs_event=sqs_event):
+                response, error = self.invoke(queue.function, sqs_event)
+                if error:
+                    # An unhandled error fails the whole batch
+                    response = {'batchItemFailures': [{'itemIdentifier': record['messageId']}
+                        for record in sqs_event['Records']]}
+                with queue.lock:
+                    queue.local_queue.complete_batch(sqs_event, response)
+                slots.release()
+                self.done()
+            self.pool.submit(run)
+
+    def idle(self):
+        with self.inflight_lock:
+            return self.inflight == 0 and not any(len(q) for q in self.queues.values())
+
+    def trigger(self, topic, payload, client_id=None, principal=None):
+        """
+        Run every rule whose topic filter matches. payload is the message
+        bytes or an already decoded dict.
+        """
+        rules = [rule for rule in self.rules if rule.matches(topic)]
+        if not rules:
+            return
+        if not isinstance(payload, dict):
+            try:
+                payload = json.loads(payload)
+            except Exception:
+                logging.error('RuleBridge.trigger(): payload not JSON on {}'.format(topic))
+                return
+        for rule in rules:
+            self.rule_counts[rule.name] += 1
+            event = rule.evaluate(payload, topic, client_id, principal)
+            for action in rule.actions:
+                if 'Lambda' in action:
+                    self.invoke_async(self.function(resolve(action['Lambda']['FunctionArn'], self.parameters)),
+                        event)
+                elif 'Sqs' in action:
+                    self.queues[resolve(action['Sqs']['QueueUrl'], self.parameters)].send_body(json.dumps(event))
+                else:
+                    logging.error('RuleBridge.trigger(): unsupported action {}'.format(list(action)))
+
+    def on_publish(self, client_id, topic, payload):
+        """
+        Broker hook: every device publish goes through the rules
+        """
+        self.trigger(topic, payload, client_id, self.principals.get(client_id, None))